@@ -4,7 +4,9 @@ from urllib.parse import quote
 from models import Video
 from pydantic import BaseModel
 from typing import Union, Optional, overload
+from core.httpclient import http
 from core.logger import logger
+from core.providercache import provider_cache
 
 
 HEADERS = {
@@ -61,6 +63,30 @@ def get_from_Bangumi(video: Video) -> Optional[Bangumi_Model]: ...
 def get_from_Bangumi(title: str) -> Optional[Bangumi_Model]: ...
 
 
+@provider_cache.cached("bangumi")
+def lookup_bangumi(title: str) -> Optional[dict]:
+    """查詢 Bangumi 條目 查詢失敗時拋出例外 不快取 找不到時回傳 None"""
+    searchurl = (
+        f"https://api.bgm.tv/search/subject/{quote(title)}?type=2&responseGroup=small"
+    )
+    r = http.get(searchurl, headers=HEADERS)
+    if r.status_code == 404:
+        logger.info(f"No results found for title: {title}")
+        return None
+    r.raise_for_status()
+
+    data = r.json()
+    if not data or not data.get("list") or len(data["list"]) == 0:
+        logger.info(f"No results found for title: {title}")
+        return None
+
+    id = data["list"][0]["id"]
+    idsearchurl = f"https://api.bgm.tv/v0/subjects/{id}"
+    r = http.get(idsearchurl, headers=HEADERS)
+    r.raise_for_status()
+    return r.json()
+
+
 def get_from_Bangumi(video_or_title: Video | str) -> Optional[Bangumi_Model]:
     """搜尋 Bangumi API"""
     try:
@@ -69,28 +95,13 @@ def get_from_Bangumi(video_or_title: Video | str) -> Optional[Bangumi_Model]:
             if isinstance(video_or_title, Video)
             else video_or_title
         )
-
-        searchurl = f"https://api.bgm.tv/search/subject/{quote(title)}?type=2&responseGroup=small"
-        r = requests.get(searchurl, headers=HEADERS)
-        if r.status_code != 200:
-            logger.error(f"Bangumi API returned status code {r.status_code}")
+        data = lookup_bangumi(title)
+        if data is None:
             return None
-
-        data = r.json()
-        if not data or not data.get("list") or len(data["list"]) == 0:
-            logger.info(f"No results found for title: {title}")
-            return None
-
-        id = data["list"][0]["id"]
-        idsearchurl = f"https://api.bgm.tv/v0/subjects/{id}"
-        r = requests.get(idsearchurl, headers=HEADERS)
-        if r.status_code != 200:
-            logger.error(
-                f"Bangumi API detail request failed with status {r.status_code}"
-            )
-            return None
-
-        return Bangumi_Model.model_validate(r.json())
+        return Bangumi_Model.model_validate(data)
+    except requests.HTTPError as e:
+        logger.error(f"Bangumi API returned status code {e.response.status_code}")
+        return None
     except json.JSONDecodeError as e:
         logger.error(f"Failed to parse Bangumi API response: {str(e)}")
         return None
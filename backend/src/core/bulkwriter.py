@@ -0,0 +1,323 @@
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy import func, insert, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, select, union
+
+from core.enrichment import enqueue
+from core.fileparser import FileType
+from core.fingerprint import file_fingerprint
+from core.imagestore import pregenerate_thumbnails, save_placeholders
+from core.keyframes import keyframe_indexer
+from core.logger import logger
+from core.setting import load_setting
+from core.streamcache import stream_cache
+from core.syncfile import (
+    album_values,
+    music_file_values,
+    music_track_values,
+    sync_metadata,
+    text_file_values,
+    video_file_values,
+    video_values,
+)
+from models import (
+    Album,
+    AnimeSeries,
+    AnimeTag,
+    AnimeTagsLink,
+    EnrichmentKind,
+    FileFingerprint,
+    FileModal,
+    MusicTrack,
+    MusicTrackFile,
+    Video,
+    VideoFile,
+)
+
+
+class BulkWriter:
+    """
+    將解析結果累積成批次, 每批只用少數幾個多列 INSERT 寫入資料庫
+    已經存在的檔案 (內容有變動) 仍交給 sync_metadata 逐筆更新
+    使用:
+    writer = BulkWriter(db)
+    writer.add(metadata)
+    writer.flush()
+    """
+
+    def __init__(
+        self,
+        db: Session,
+        batch_size: Optional[int] = None,
+        on_error: Optional[Callable[[dict, Exception], None]] = None,
+        on_flush: Optional[Callable[[list[dict]], None]] = None,
+    ):
+        self.db = db
+        self.batch_size = batch_size or load_setting().scan_batch_size
+        self.on_error = on_error
+        # 每批寫入 (commit) 完成後呼叫 可用來記錄進度
+        self.on_flush = on_flush
+        self.batch: list[dict] = []
+
+    def add(self, metadata: dict) -> None:
+        self.batch.append(metadata)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        """寫入目前的批次 回傳處理的檔案數"""
+        batch, self.batch = self.batch, []
+        if not batch:
+            return 0
+
+        existing = self._existing_paths([m["file_path"] for m in batch])
+        new = [m for m in batch if m["file_path"] not in existing and self._valid(m)]
+        new_ids = {id(m) for m in new}
+        one_by_one = [m for m in batch if id(m) not in new_ids]
+        try:
+            self._write_music([m for m in new if m["file_type"] == FileType.MUSIC])
+            self._write_video([m for m in new if m["file_type"] == FileType.VIDEO])
+            self._write_text([m for m in new if m["file_type"] == FileType.TEXT])
+            self._write_fingerprints(new)
+            placeholders = {}
+            for metadata in new:
+                placeholders.update(metadata.get("placeholders") or {})
+            save_placeholders(placeholders, self.db)
+            self.db.commit()
+            pregenerate_thumbnails(placeholders)
+            if any(m["file_type"] == FileType.VIDEO for m in new):
+                keyframe_indexer.notify()
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Bulk write failed, retry one by one: {str(e)}")
+            one_by_one = batch
+
+        for metadata in one_by_one:
+            try:
+                sync_metadata(metadata, self.db)
+            except Exception as e:
+                logger.error(
+                    f"Error syncing file {metadata.get('file_path')} : {str(e)}"
+                )
+                if self.on_error:
+                    self.on_error(metadata, e)
+        for metadata in batch:
+            stream_cache.invalidate(metadata["file_path"])
+        if self.on_flush:
+            self.on_flush(batch)
+        return len(batch)
+
+    @staticmethod
+    def _valid(metadata: dict) -> bool:
+        """必填欄位缺少時交給逐筆寫入 讓錯誤只影響那一個檔案"""
+        if metadata.get("file_type") == FileType.MUSIC:
+            return bool(metadata.get("title") and metadata.get("artist"))
+        if metadata.get("file_type") == FileType.TEXT:
+            return bool(metadata.get("format"))
+        return metadata.get("file_type") == FileType.VIDEO
+
+    def _existing_paths(self, paths: list[str]) -> set[str]:
+        query = union(
+            select(MusicTrackFile.filepath).where(MusicTrackFile.filepath.in_(paths)),
+            select(VideoFile.filepath).where(VideoFile.filepath.in_(paths)),
+            select(FileModal.filepath).where(FileModal.filepath.in_(paths)),
+        )
+        return {row[0] for row in self.db.exec(query).all()}
+
+    def _write_music(self, rows: list[dict]) -> None:
+        if not rows:
+            return
+        albums = {}
+        for metadata in rows:
+            if metadata.get("album"):
+                values = album_values(metadata)
+                albums.setdefault((values["title"], values["album_artist"]), values)
+
+        album_ids: dict[tuple[str, str], int] = {}
+        if albums:
+            for album_id, title, album_artist in self.db.exec(
+                select(Album.id, Album.title, Album.album_artist).where(
+                    tuple_(Album.title, Album.album_artist).in_(list(albums))
+                )
+            ):
+                album_ids[(title, album_artist)] = album_id
+            missing = [v for k, v in albums.items() if k not in album_ids]
+            if missing:
+                for album_id, title, album_artist in self.db.exec(
+                    insert(Album).returning(Album.id, Album.title, Album.album_artist),
+                    params=missing,
+                ):
+                    album_ids[(title, album_artist)] = album_id
+
+        tracks = []
+        for metadata in rows:
+            album_id = None
+            if metadata.get("album"):
+                values = album_values(metadata)
+                album_id = album_ids[(values["title"], values["album_artist"])]
+            tracks.append({**music_track_values(metadata), "album_id": album_id})
+        track_ids = (
+            self.db.exec(
+                insert(MusicTrack).returning(
+                    MusicTrack.id, sort_by_parameter_order=True
+                ),
+                params=tracks,
+            )
+            .scalars()
+            .all()
+        )
+        enqueue(EnrichmentKind.MUSIC, track_ids, self.db)
+        self.db.exec(
+            insert(MusicTrackFile),
+            params=[
+                {**music_file_values(metadata), "track_id": track_id}
+                for metadata, track_id in zip(rows, track_ids)
+            ],
+        )
+
+        if album_ids:
+            # 每批只重新計算一次專輯曲目數
+            track_count = (
+                select(func.count(MusicTrack.id))
+                .where(MusicTrack.album_id == Album.id)
+                .correlate(Album)
+                .scalar_subquery()
+            )
+            self.db.exec(
+                update(Album)
+                .where(Album.id.in_(set(album_ids.values())))
+                .values(total_tracks=track_count, updated_at=datetime.now())
+            )
+
+    def _write_video(self, rows: list[dict]) -> None:
+        if not rows:
+            return
+        series = {}
+        tag_names = set()
+        for metadata in rows:
+            if metadata.get("isanime"):
+                series.setdefault(
+                    metadata["title"],
+                    {
+                        "title": metadata["title"],
+                        "description": metadata.get("description"),
+                        "season_number": metadata.get("season_number", 1),
+                        "release_date": metadata.get("date"),
+                    },
+                )
+                tag_names.update(metadata.get("tags") or [])
+
+        series_ids: dict[str, int] = {}
+        if series:
+            series_ids = dict(
+                (title, series_id)
+                for series_id, title in self.db.exec(
+                    select(AnimeSeries.id, AnimeSeries.title).where(
+                        AnimeSeries.title.in_(list(series))
+                    )
+                )
+            )
+            missing = [v for k, v in series.items() if k not in series_ids]
+            if missing:
+                for series_id, title in self.db.exec(
+                    insert(AnimeSeries).returning(AnimeSeries.id, AnimeSeries.title),
+                    params=missing,
+                ):
+                    series_ids[title] = series_id
+
+        if tag_names:
+            tag_ids = dict(
+                (name, tag_id)
+                for tag_id, name in self.db.exec(
+                    select(AnimeTag.id, AnimeTag.name).where(
+                        AnimeTag.name.in_(list(tag_names))
+                    )
+                )
+            )
+            missing = [{"name": name} for name in tag_names if name not in tag_ids]
+            if missing:
+                for tag_id, name in self.db.exec(
+                    insert(AnimeTag).returning(AnimeTag.id, AnimeTag.name),
+                    params=missing,
+                ):
+                    tag_ids[name] = tag_id
+            links = {
+                (series_ids[metadata["title"]], tag_ids[tag])
+                for metadata in rows
+                if metadata.get("isanime")
+                for tag in metadata.get("tags") or []
+            }
+            self.db.exec(
+                pg_insert(AnimeTagsLink).on_conflict_do_nothing(),
+                params=[
+                    {"series_id": series_id, "tag_id": tag_id}
+                    for series_id, tag_id in links
+                ],
+            )
+
+        video_ids = (
+            self.db.exec(
+                insert(Video).returning(Video.id, sort_by_parameter_order=True),
+                params=[
+                    {
+                        **video_values(metadata),
+                        "series_id": series_ids.get(metadata["title"])
+                        if metadata.get("isanime")
+                        else None,
+                    }
+                    for metadata in rows
+                ],
+            )
+            .scalars()
+            .all()
+        )
+        enqueue(EnrichmentKind.VIDEO, video_ids, self.db)
+        self.db.exec(
+            insert(VideoFile),
+            params=[
+                {**video_file_values(metadata), "video_id": video_id}
+                for metadata, video_id in zip(rows, video_ids)
+            ],
+        )
+
+    def _write_text(self, rows: list[dict]) -> None:
+        if not rows:
+            return
+        self.db.exec(
+            insert(FileModal),
+            params=[text_file_values(metadata) for metadata in rows],
+        )
+
+    def _write_fingerprints(self, rows: list[dict]) -> None:
+        if not rows:
+            return
+        with_hash = load_setting().scan_partial_hash
+        stmt = pg_insert(FileFingerprint)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FileFingerprint.filepath],
+            set_={
+                "file_type": stmt.excluded.file_type,
+                "size": stmt.excluded.size,
+                "mtime_ns": stmt.excluded.mtime_ns,
+                "inode": stmt.excluded.inode,
+                "device": stmt.excluded.device,
+                "partial_hash": stmt.excluded.partial_hash,
+                "updated_at": datetime.now(),
+            },
+        )
+        self.db.exec(
+            stmt,
+            params=[
+                {
+                    "filepath": metadata["file_path"],
+                    "file_type": FileType(metadata["file_type"]).value,
+                    **(
+                        metadata.get("fingerprint")
+                        or file_fingerprint(metadata["file_path"], with_hash)
+                    ),
+                }
+                for metadata in rows
+            ],
+        )
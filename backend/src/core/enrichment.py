@@ -0,0 +1,288 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+from threading import Event, Thread
+from typing import Iterable
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, select
+
+from db import engine
+from core.animeparser import Bangumi_Model, lookup_bangumi
+from core.fileparser import UNKNOWN_ARTIST, FileParser
+from core.filenameparse import parse_filename
+from core.httpclient import priority
+from core.imagestore import (
+    image_placeholders,
+    pregenerate_thumbnails,
+    save_placeholders,
+)
+from core.logger import logger
+from core.movieparser import MovieInfo, TMDBApi
+from core.musiclyrics import get_lrclib
+from core.musicparser import lookup_track, parse_track_info
+from core.setting import load_setting
+from models import (
+    AnimeSeries,
+    AnimeTag,
+    EnrichmentKind,
+    EnrichmentStatus,
+    EnrichmentTask,
+    MusicTrack,
+    Video,
+)
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = timedelta(seconds=30)
+# 使用者開啟的項目優先補資料
+OPEN_PRIORITY = 100
+
+
+def enqueue(
+    kind: EnrichmentKind, record_ids: Iterable[int], db: Session, priority: int = 0
+) -> None:
+    """加入待補資料的項目 (不 commit) 已存在的項目會重新排隊"""
+    rows = [
+        {"kind": kind, "record_id": record_id, "priority": priority}
+        for record_id in record_ids
+    ]
+    if not rows:
+        return
+    stmt = pg_insert(EnrichmentTask)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[EnrichmentTask.kind, EnrichmentTask.record_id],
+        set_={
+            "status": EnrichmentStatus.PENDING,
+            "attempts": 0,
+            "last_error": None,
+            "next_attempt_at": datetime.now(),
+            "updated_at": datetime.now(),
+        },
+    )
+    db.exec(stmt, params=rows)
+    enrichment.notify()
+
+
+def prioritize(kind: EnrichmentKind, record_id: int, db: Session) -> None:
+    """使用者開啟了尚未補完資料的項目 讓它排到最前面"""
+    result = db.exec(
+        update(EnrichmentTask)
+        .where(
+            EnrichmentTask.kind == kind,
+            EnrichmentTask.record_id == record_id,
+            EnrichmentTask.status == EnrichmentStatus.PENDING,
+            EnrichmentTask.priority < OPEN_PRIORITY,
+        )
+        .values(priority=OPEN_PRIORITY)
+    )
+    db.commit()
+    if result.rowcount:
+        enrichment.notify()
+
+
+def save_cover(url: str, db: Session) -> str:
+    """下載封面 預覽和補上的資料一起寫入 (不 commit)"""
+    image_id = FileParser.save_cover_art_from_url(url)
+    save_placeholders(image_placeholders(image_id), db)
+    pregenerate_thumbnails([image_id])
+    return image_id
+
+
+def enrich_track(track_id: int, db: Session) -> None:
+    """
+    補上 MusicBrainz 資料 / 封面 / 歌詞
+    直接呼叫會拋出例外的查詢 網路錯誤時由 worker 稍後重試 而不是當成找不到
+    """
+    track = db.get(MusicTrack, track_id)
+    if not track:
+        return
+    online_track = None
+    if track.title and track.artist and track.artist != UNKNOWN_ARTIST:
+        online_track = parse_track_info(lookup_track(track.title, track.artist))
+    if online_track:
+        track.vocals = [v.name for v in online_track.vocals]
+        track.arrangers = online_track.arrangers
+        track.mixers = online_track.mixers
+        track.release_date = track.release_date or online_track.first_release_date
+        if not track.cover_art and online_track.cover_art:
+            track.cover_art = save_cover(online_track.cover_art, db)
+            if track.album_ref and not track.album_ref.cover_art:
+                track.album_ref.cover_art = track.cover_art
+    if not track.lyrics:
+        track.lyrics = get_lrclib(track.album, track.artist, track.title)
+    track.updated_at = datetime.now()
+    db.add(track)
+    db.commit()
+
+
+def enrich_video(video_id: int, db: Session) -> None:
+    """用檔名查詢 Bangumi 找不到時改查 TMDB 查詢失敗時拋出例外 (稍後重試)"""
+    video = db.get(Video, video_id)
+    if not video or not video.file:
+        return
+    parse_file = parse_filename(Path(video.file.filepath).stem)
+    logger.info(
+        f"Parse file name status: {'failed' if parse_file.parse_failed else 'success'}"
+    )
+    if parse_file.parse_failed:
+        return
+    name = parse_file.name_zh or parse_file.name_jp or parse_file.name_en
+
+    logger.info("Getting info from bangumi")
+    bangumi_data = lookup_bangumi(name)
+    if bangumi_data:
+        bangumi_info = Bangumi_Model.model_validate(bangumi_data)
+        logger.debug(f"Bangumi info: {bangumi_info}")
+        title = bangumi_info.name_cn or bangumi_info.name
+        anime = db.exec(select(AnimeSeries).where(AnimeSeries.title == title)).first()
+        if not anime:
+            anime = AnimeSeries(
+                title=title,
+                description=bangumi_info.summary,
+                season_number=parse_file.season,
+                release_date=bangumi_info.date,
+            )
+            db.add(anime)
+        for tag in bangumi_info.tags:
+            anime_tag = db.exec(
+                select(AnimeTag).where(AnimeTag.name == tag.name)
+            ).first() or AnimeTag(name=tag.name)
+            if anime_tag not in anime.tags:
+                anime.tags.append(anime_tag)
+        video.thumbnail = save_cover(bangumi_info.images.large, db)
+        video.title = title
+        video.description = bangumi_info.summary
+        video.episode_number = parse_file.episode
+        video.series = anime
+    else:
+        logger.info("Getting info from TMDB")
+        apikey = load_setting().tmd_api_key
+        if apikey == "":
+            logger.error("TMDB API key not set")
+            return
+        tmdb_data = TMDBApi(apikey).lookup_movie(name, "zh-TW")
+        if not tmdb_data:
+            return
+        tmdb_info = MovieInfo.model_validate(tmdb_data)
+        logger.debug(f"TMDB info: {tmdb_info}")
+        video.thumbnail = save_cover(tmdb_info.poster_url, db)
+        video.title = tmdb_info.title
+        video.description = tmdb_info.overview
+
+    video.updated_at = datetime.now()
+    db.add(video)
+    db.commit()
+
+
+class EnrichmentQueue:
+    """
+    在背景補上線上資料 與掃描分開 掃描時檔案會先出現在資料庫
+    使用:
+    enrichment.start()
+    enrichment.progress()
+    enrichment.stop()
+    """
+
+    HANDLERS = {
+        EnrichmentKind.MUSIC: enrich_track,
+        EnrichmentKind.VIDEO: enrich_video,
+    }
+
+    def __init__(self):
+        self.stop_event = Event()
+        self.wakeup = Event()
+        self.threads: list[Thread] = []
+
+    def start(self) -> None:
+        with Session(engine) as db:
+            # 上次關閉時還在處理的項目
+            db.exec(
+                update(EnrichmentTask)
+                .where(EnrichmentTask.status == EnrichmentStatus.RUNNING)
+                .values(status=EnrichmentStatus.PENDING)
+            )
+            db.commit()
+        self.stop_event = Event()
+        self.threads = [
+            Thread(target=self._worker, daemon=True, name=f"enrichment-{i}")
+            for i in range(load_setting().enrich_workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout=10)
+        self.threads = []
+
+    def notify(self) -> None:
+        """有新的項目時叫醒閒置的 worker"""
+        self.wakeup.set()
+
+    def progress(self) -> dict[str, int]:
+        with Session(engine) as db:
+            counts = db.exec(
+                select(EnrichmentTask.status, func.count()).group_by(
+                    EnrichmentTask.status
+                )
+            ).all()
+        return {
+            **{status.value: 0 for status in EnrichmentStatus},
+            **{status.value: count for status, count in counts},
+        }
+
+    def _claim(self, db: Session):
+        task = db.exec(
+            select(EnrichmentTask)
+            .where(
+                EnrichmentTask.status == EnrichmentStatus.PENDING,
+                EnrichmentTask.next_attempt_at <= datetime.now(),
+            )
+            .order_by(EnrichmentTask.priority.desc(), EnrichmentTask.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).first()
+        if task:
+            task.status = EnrichmentStatus.RUNNING
+            task.attempts += 1
+            db.add(task)
+            db.commit()
+        return task
+
+    def run_once(self) -> bool:
+        """處理一個到期的項目 沒有項目時回傳 False"""
+        with Session(engine) as db:
+            task = self._claim(db)
+            if task is None:
+                return False
+            try:
+                with priority(task.priority):
+                    self.HANDLERS[task.kind](task.record_id, db)
+                task.status = EnrichmentStatus.DONE
+                task.last_error = None
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Enrich {task.kind} {task.record_id} failed: {str(e)}")
+                task.last_error = str(e)
+                if task.attempts >= MAX_ATTEMPTS:
+                    task.status = EnrichmentStatus.FAILED
+                else:
+                    task.status = EnrichmentStatus.PENDING
+                    task.next_attempt_at = datetime.now() + RETRY_DELAY * (
+                        2 ** (task.attempts - 1)
+                    )
+            task.updated_at = datetime.now()
+            db.add(task)
+            db.commit()
+        return True
+
+    def _worker(self) -> None:
+        while not self.stop_event.is_set():
+            if not self.run_once():
+                self.wakeup.wait(5)
+                self.wakeup.clear()
+
+
+enrichment = EnrichmentQueue()
@@ -1,26 +1,18 @@
+import io
 from datetime import datetime
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 from tinytag import TinyTag
 import av
 from enum import Enum
-from uuid import uuid4
 from ebooklib import epub
 from mobi import Mobi
 from PyPDF2 import PdfReader
+from core.httpclient import http
+from core.imagestore import IMAGES_DIR, image_placeholders, save_image
 from core.logger import logger
-from core.musiclyrics import get_lrclib
-from core.musicparser import (
-    search_track,
-    search_album,
-    parse_album_info,
-    parse_track_info,
-)
-from core.filenameparse import parse_filename
-from core.animeparser import get_from_Bangumi
-from core.movieparser import TMDBApi
-from core.setting import load_setting
-import requests
+
+UNKNOWN_ARTIST = "Unknown Artist"
 
 
 class FileType(str, Enum):
@@ -36,25 +28,17 @@ class FileParser:
     SUPPORT_VIDEO = {".mp4", ".mkv", ".webm", ".avi", ".flv", ".mov", ".wmv"}
     SUPPORT_TEXT = {".txt", ".pdf", ".epub", ".mobi"}
     SUPPORT_IMAGE = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
-    IMAGES_DIR = Path("data/images")
+    IMAGES_DIR = IMAGES_DIR
 
     @classmethod
     def save_cover_art(cls, image_data: bytes) -> str:
-        cls.IMAGES_DIR.mkdir(parents=True, exist_ok=True)
-        image_id = str(uuid4())
-        image_path = cls.IMAGES_DIR / f"{image_id}.jpg"
-        with open(image_path, "wb") as f:
-            f.write(image_data)
-        return image_id + ".jpg"
+        return save_image(image_data)
 
     @classmethod
     def save_cover_art_from_url(cls, image_url: str) -> str:
-        image_data = requests.get(image_url).content
-        image_id = str(uuid4())
-        image_path = cls.IMAGES_DIR / f"{image_id}.jpg"
-        with open(image_path, "wb") as f:
-            f.write(image_data)
-        return image_id + ".jpg"
+        response = http.get(image_url)
+        response.raise_for_status()
+        return save_image(response.content)
 
     @staticmethod
     def get_file_type(file_path: Union[str, Path]) -> FileType:
@@ -89,10 +73,15 @@ class FileParser:
             "updated_at": datetime.fromtimestamp(file_stat.st_mtime),
         }
 
+        # 預覽在這裡 (掃描的子程序) 產生 由主程序和資料一起寫入資料庫
         if file_type == FileType.MUSIC:
-            return {**base_info, **FileParser._parse_music(file_path)}
+            info = FileParser._parse_music(file_path)
+            placeholders = image_placeholders(info.get("cover_art"))
+            return {**base_info, **info, "placeholders": placeholders}
         elif file_type == FileType.VIDEO:
-            return {**base_info, **FileParser._parse_video(file_path)}
+            info = FileParser._parse_video(file_path)
+            placeholders = image_placeholders(info.get("thumbnail"))
+            return {**base_info, **info, "placeholders": placeholders}
         elif file_type == FileType.TEXT:
             return {**base_info, **FileParser._parse_text(file_path)}
         else:
@@ -140,56 +129,61 @@ class FileParser:
 
     @staticmethod
     def _parse_music(file_path: Path) -> dict:
+        """只讀取檔案內嵌的標籤 線上資料由 core.enrichment 之後補上"""
         try:
             tag = TinyTag.get(file_path, image=True)
             cover_art = tag.images.any
             cover_art_id = None
-            online_track = parse_track_info(search_track(tag.title, tag.artist))
             if cover_art and cover_art.data:
                 cover_art_id = FileParser.save_cover_art(cover_art.data)
-            elif online_track and online_track.cover_art:
-                cover_art_id = FileParser.save_cover_art_from_url(
-                    online_track.cover_art
-                )
-
-            lyrics = get_lrclib(tag.album, tag.artist, tag.title)
 
-            # TODO: 沒有時間修 以後再重構
             return {
-                "title": tag.title or online_track.title
-                if online_track
-                else file_path.stem,
+                "title": tag.title or file_path.stem,
                 "duration": int(tag.duration or 0),
                 "bitrate": tag.bitrate or 0,
                 "sample_rate": tag.samplerate or 0,
-                "artist": tag.artist or (online_track.artist if online_track else None),
+                "artist": tag.artist or UNKNOWN_ARTIST,
                 "album": tag.album,
-                "album_artist": (
-                    tag.albumartist
-                    or tag.artist
-                    or (online_track.artist if online_track else None)
-                ),
+                "album_artist": tag.albumartist or tag.artist,
                 "composer": tag.composer,
-                "vocals": [v.name for v in online_track.vocals] if online_track else [],
-                "arrangers": online_track.arrangers if online_track else [],
-                "mixers": online_track.mixers if online_track else [],
+                "vocals": [],
+                "arrangers": [],
+                "mixers": [],
                 "genre": tag.genre,
-                "date": tag.year
-                or (online_track.first_release_date if online_track else None),
+                "date": tag.year,
                 "track_number": tag.track,
                 "disc_number": tag.disc,
                 "audio_type": "stereo" if (tag.channels or 0) > 1 else "mono",
                 "codec": FileParser._get_audio_codec(file_path.suffix),
                 "cover_art": cover_art_id,
-                "lyrics": lyrics,
-                "online_id": online_track.id if online_track else None,
+                "lyrics": None,
             }
         except Exception as e:
             logger.error(f"Error parsing music file: {e}")
             return {}
 
+    @staticmethod
+    def save_video_frame(container: av.container.InputContainer) -> Optional[str]:
+        """擷取影片第一個畫面當作縮圖"""
+        try:
+            container.seek(0)
+            for frame in container.decode(video=0):
+                # 由 libswscale 直接縮小 不需要先轉出完整尺寸的 RGB 圖片
+                scale = min(500 / frame.width, 500 / frame.height, 1)
+                img = frame.to_image(
+                    width=max(round(frame.width * scale), 1),
+                    height=max(round(frame.height * scale), 1),
+                )
+                image_io = io.BytesIO()
+                img.save(image_io, "JPEG", quality=85)
+                return save_image(image_io.getvalue())
+        except Exception as e:
+            logger.error(f"Error extracting cover: {e}")
+        return None
+
     @staticmethod
     def _parse_video(file_path: Path) -> dict:
+        """只讀取容器資訊 Bangumi / TMDB 資料由 core.enrichment 之後補上"""
         try:
             logger.info(f"Parsing video file: {file_path}")
             file_path_str = str(file_path.resolve())
@@ -197,88 +191,6 @@ class FileParser:
             video_stream: av.VideoStream = next(
                 s for s in container.streams if s.type == "video"
             )
-            cover_path = None
-            image_id = str(uuid4())
-            title = file_path.stem
-            description = ""
-            season_number = ""
-            date = ""
-            episode_number = 1
-            tags = []
-            anime_success = False
-            movie_success = False
-            parse_file = parse_filename(file_path.stem)
-            logger.info(
-                f"Parse file name status: {'failed' if parse_file.parse_failed else 'success'}"
-            )
-            if parse_file.parse_failed:
-                try:
-                    container.seek(0)
-                    for frame in container.decode(video=0):
-                        img = frame.to_image()
-                        covers_dir = Path("data/images")
-                        covers_dir.mkdir(parents=True, exist_ok=True)
-                        cover_path = covers_dir / f"{image_id}.jpg"
-                        img.thumbnail((500, 500))
-                        img.save(str(cover_path), "JPEG", quality=85)
-                        break
-                    image_id = image_id + ".jpg"
-                except Exception as e:
-                    logger.error(f"Error extracting cover: {e}")
-            else:
-                logger.info("Getting info from bangumi")
-                bangumi_info = get_from_Bangumi(
-                    parse_file.name_zh or parse_file.name_jp or parse_file.name_en
-                )
-                if bangumi_info:
-                    logger.debug(f"Bangumi info: {bangumi_info}")
-                    logger.info("success getting info from bangumi")
-                    image_id = FileParser.save_cover_art_from_url(
-                        bangumi_info.images.large
-                    )
-                    title = bangumi_info.name_cn or bangumi_info.name
-                    description = bangumi_info.summary
-                    season_number = parse_file.season
-                    date = bangumi_info.date
-                    tags = [tag.name for tag in bangumi_info.tags]
-                    episode_number = parse_file.episode
-                    anime_success = True
-                else:
-                    logger.info("Getting info from TMDB")
-                    apikey = load_setting().tmd_api_key
-                    if apikey == "":
-                        logger.error("TMDB API key not set")
-                    else:
-                        tmdb_info = TMDBApi(apikey).search_movie(
-                            parse_file.name_zh
-                            or parse_file.name_jp
-                            or parse_file.name_en
-                        )
-                        if tmdb_info:
-                            logger.debug(f"TMDB info: {tmdb_info}")
-                            logger.info("success getting info from TMDB")
-                            image_id = FileParser.save_cover_art_from_url(
-                                tmdb_info.poster_path
-                            )
-                            title = tmdb_info.title
-                            description = tmdb_info.overview
-                            date = tmdb_info.release_date
-                            tags = tmdb_info.genres
-                            movie_success = True
-                        else:
-                            try:
-                                container.seek(0)
-                                for frame in container.decode(video=0):
-                                    img = frame.to_image()
-                                    covers_dir = Path("data/images")
-                                    covers_dir.mkdir(parents=True, exist_ok=True)
-                                    cover_path = covers_dir / f"{image_id}.jpg"
-                                    img.thumbnail((500, 500))
-                                    img.save(str(cover_path), "JPEG", quality=85)
-                                    break
-                                image_id = image_id + ".jpg"
-                            except Exception as e:
-                                logger.error(f"Error extracting cover: {e}")
 
             audio_tracks = []
             for stream in container.streams:
@@ -286,7 +198,7 @@ class FileParser:
                     audio_tracks.append(getattr(stream, "language", "und"))
 
             metadata = {
-                "title": title,
+                "title": file_path.stem,
                 "duration": int(float(container.duration) / 1000000)
                 if container.duration
                 else 0,
@@ -296,14 +208,11 @@ class FileParser:
                 "codec": video_stream.codec.name,
                 "format": file_path.suffix.lstrip("."),
                 "audio_tracks": audio_tracks,
-                "thumbnail": image_id,
-                "ismovie": movie_success,
-                "isanime": anime_success,
-                "description": description,
-                "season_number": season_number,
-                "date": date,
-                "tags": tags,
-                "episode_number": episode_number,
+                "thumbnail": FileParser.save_video_frame(container),
+                "ismovie": False,
+                "isanime": False,
+                "description": "",
+                "episode_number": 1,
             }
 
             container.close()
@@ -0,0 +1,243 @@
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from secrets import token_hex
+from typing import Optional
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import (
+    FileResponse,
+    PlainTextResponse,
+    RangeNotSatisfiable,
+    Response,
+)
+from starlette.types import Receive, Scope, Send
+
+# ASGI 擴充: 由伺服器呼叫 os.sendfile 資料直接從 page cache 送到 socket
+ZEROCOPY_SEND = "http.response.zerocopysend"
+# ASGI 擴充: 由伺服器直接送出整個檔案
+PATH_SEND = "http.response.pathsend"
+
+# 音樂 / 影片 / 一般檔案 重新掃描後內容可能改變 過期後以 ETag 確認
+MEDIA_CACHE_CONTROL = "private, max-age=3600"
+# 圖片以內容雜湊命名 同一個 ID 的內容永遠不變
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 舊版 uuid 命名的圖片
+IMAGE_CACHE_CONTROL = "public, max-age=86400"
+# 304 回應需要帶上的標頭
+VALIDATOR_HEADERS = ("etag", "last-modified", "cache-control", "vary")
+
+
+def file_etag(stat_result: os.stat_result) -> str:
+    """以檔案大小 / 修改時間 / inode 產生 strong ETag"""
+    return (
+        f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}-{stat_result.st_ino:x}"'
+    )
+
+
+def is_not_modified(
+    request_headers: Headers, etag: str, last_modified: Optional[str] = None
+) -> bool:
+    """
+    If-None-Match (weak 比對) / If-Modified-Since
+    有 If-None-Match 時忽略 If-Modified-Since (RFC 9110 13.2.2)
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag.removeprefix("W/") in tags
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(
+            last_modified
+        )
+    except (TypeError, ValueError):
+        return False
+
+
+def not_modified_response(headers: dict) -> Response:
+    """只帶驗證相關標頭的 304 回應"""
+    return Response(
+        status_code=304,
+        headers={k: v for k, v in headers.items() if k.lower() in VALIDATOR_HEADERS},
+    )
+
+
+class _RangeNotSatisfiable(Exception):
+    """starlette 的 416 回應 Content-Range 少了 bytes 單位 改由 SendfileResponse 產生"""
+
+    def __init__(self, file_size: int):
+        self.file_size = file_size
+
+
+def range_not_satisfiable_response(file_size: int) -> Response:
+    """416 回應 Content-Range 為 bytes */檔案大小 (RFC 9110 14.4)"""
+    return PlainTextResponse(
+        "Range not satisfiable.",
+        status_code=416,
+        headers={"Content-Range": f"bytes */{file_size}"},
+    )
+
+
+class SendfileResponse(FileResponse):
+    """
+    支援 Range (單一 / 多段 / 416) 與條件請求 (304 / If-Range) 的檔案回應
+    伺服器支援 zerocopysend / pathsend 擴充時 檔案內容不經過 Python
+    不支援時 在執行緒中讀取 不會阻塞 event loop
+    使用:
+    return SendfileResponse(path, media_type="audio/flac")
+    """
+
+    chunk_size = 1024 * 1024
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        extensions = scope.get("extensions") or {}
+        self.zerocopy = ZEROCOPY_SEND in extensions
+        self.pathsend = PATH_SEND in extensions
+        if self.stat_result is None:
+            try:
+                self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f"File at path {self.path} does not exist.")
+            self.set_stat_headers(self.stat_result)
+        if scope["method"].upper() in ("GET", "HEAD") and is_not_modified(
+            Headers(scope=scope),
+            self.headers["etag"],
+            self.headers["last-modified"],
+        ):
+            return await not_modified_response(dict(self.headers))(scope, receive, send)
+        try:
+            await super().__call__(scope, receive, send)
+        except _RangeNotSatisfiable as exc:
+            await range_not_satisfiable_response(exc.file_size)(scope, receive, send)
+
+    def set_stat_headers(self, stat_result: os.stat_result) -> None:
+        self.headers.setdefault("content-length", str(stat_result.st_size))
+        self.headers.setdefault(
+            "last-modified", formatdate(stat_result.st_mtime, usegmt=True)
+        )
+        self.headers.setdefault("etag", file_etag(stat_result))
+
+    @classmethod
+    def _should_use_range(cls, http_if_range: str, stat_result: os.stat_result) -> bool:
+        """If-Range 只接受 strong ETag 或完全相同的 Last-Modified"""
+        return http_if_range in (
+            file_etag(stat_result),
+            formatdate(stat_result.st_mtime, usegmt=True),
+        )
+
+    @staticmethod
+    def _parse_range_header(http_range: str, file_size: int) -> list[tuple[int, int]]:
+        try:
+            return FileResponse._parse_range_header(http_range, file_size)
+        except RangeNotSatisfiable:
+            raise _RangeNotSatisfiable(file_size)
+
+    async def _handle_simple(self, send: Send, send_header_only: bool) -> None:
+        if send_header_only or not (self.zerocopy or self.pathsend):
+            return await super()._handle_simple(send, send_header_only)
+        await self._start(send, self.status_code)
+        if self.pathsend:
+            await send({"type": PATH_SEND, "path": os.path.abspath(self.path)})
+            return
+        size = int(self.headers["content-length"])
+        await self._send_parts(send, [(b"", 0, size)])
+
+    async def _handle_single_range(
+        self, send: Send, start: int, end: int, file_size: int, send_header_only: bool
+    ) -> None:
+        if send_header_only or not self.zerocopy:
+            return await super()._handle_single_range(
+                send, start, end, file_size, send_header_only
+            )
+        self.headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+        self.headers["content-length"] = str(end - start)
+        await self._start(send, 206)
+        await self._send_parts(send, [(b"", start, end)])
+
+    async def _handle_multiple_ranges(
+        self,
+        send: Send,
+        ranges: list[tuple[int, int]],
+        file_size: int,
+        send_header_only: bool,
+    ) -> None:
+        # starlette 的多段回應 Content-Length 少算一個位元組 Content-Type 也不是
+        # multipart/byteranges 這裡依 RFC 9110 自己產生
+        boundary = token_hex(13)
+        content_type = self.headers["content-type"]
+        parts = [
+            (
+                (
+                    f"\r\n--{boundary}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Range: bytes {start}-{end - 1}/{file_size}\r\n"
+                    "\r\n"
+                ).encode("latin-1"),
+                start,
+                end,
+            )
+            for start, end in ranges
+        ]
+        trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        content_length = sum(len(head) + end - start for head, start, end in parts)
+        self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        self.headers["content-length"] = str(content_length + len(trailer))
+        await self._start(send, 206)
+        if send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        await self._send_parts(send, parts, trailer)
+
+    async def _start(self, send: Send, status: int) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": self.raw_headers,
+            }
+        )
+
+    async def _send_parts(
+        self, send: Send, parts: list[tuple[bytes, int, int]], trailer: bytes = b""
+    ) -> None:
+        """依序送出 parts 中每段的標頭與檔案內容 (start, end) 最後送出 trailer"""
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            for index, (head, start, end) in enumerate(parts):
+                more_body = bool(trailer) or index < len(parts) - 1
+                if head:
+                    await send(
+                        {"type": "http.response.body", "body": head, "more_body": True}
+                    )
+                if self.zerocopy:
+                    await send(
+                        {
+                            "type": ZEROCOPY_SEND,
+                            "file": file.wrapped,
+                            "offset": start,
+                            "count": end - start,
+                            "more_body": more_body,
+                        }
+                    )
+                    continue
+                await file.seek(start)
+                while start < end:
+                    chunk = await file.read(min(self.chunk_size, end - start))
+                    if not chunk:
+                        raise RuntimeError(f"File at path {self.path} was truncated.")
+                    start += len(chunk)
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": chunk,
+                            "more_body": more_body or start < end,
+                        }
+                    )
+            if trailer:
+                await send(
+                    {"type": "http.response.body", "body": trailer, "more_body": False}
+                )
@@ -0,0 +1,59 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+from models import FileFingerprint
+
+# 只讀取檔案頭尾各 64KiB 來計算部分雜湊
+PARTIAL_HASH_SIZE = 64 * 1024
+
+
+def partial_hash(file_path: Union[str, Path], size: Optional[int] = None) -> str:
+    """計算檔案大小 + 頭尾區塊的雜湊"""
+    if size is None:
+        size = os.stat(file_path).st_size
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file_path, "rb") as f:
+        digest.update(f.read(PARTIAL_HASH_SIZE))
+        if size > PARTIAL_HASH_SIZE * 2:
+            f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+            digest.update(f.read(PARTIAL_HASH_SIZE))
+    return digest.hexdigest()
+
+
+def file_fingerprint(
+    file_path: Union[str, Path],
+    with_hash: bool = False,
+    stat: Optional[os.stat_result] = None,
+) -> dict:
+    """取得檔案指紋"""
+    stat = stat or os.stat(file_path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "inode": stat.st_ino,
+        "device": stat.st_dev,
+        "partial_hash": partial_hash(file_path, stat.st_size) if with_hash else None,
+    }
+
+
+def is_changed(
+    record: FileFingerprint,
+    file_path: Union[str, Path],
+    stat: os.stat_result,
+    with_hash: bool = False,
+) -> bool:
+    """比對資料庫內的指紋與目前檔案狀態"""
+    if record.size != stat.st_size:
+        return True
+    if (
+        record.mtime_ns == stat.st_mtime_ns
+        and record.inode == stat.st_ino
+        and record.device == stat.st_dev
+    ):
+        return False
+    # 大小相同但時間或 inode 不同 (touch / 搬移 / 還原備份) 用部分雜湊確認內容
+    if with_hash and record.partial_hash:
+        return record.partial_hash != partial_hash(file_path, stat.st_size)
+    return True
@@ -0,0 +1,466 @@
+import asyncio
+import io
+import math
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from fractions import Fraction
+from functools import lru_cache
+from pathlib import Path
+from threading import Event, Lock
+from typing import Callable, Optional
+
+import av
+from pydantic import BaseModel
+
+from core.keyframes import keyframe_indexer, stored_keyframe_index
+from core.logger import logger
+from core.makehls import copyable_streams, create_resolutions
+from core.setting import load_setting
+from core.thumbnail import ThumbnailCache
+
+HLS_DIR = Path("data/hls")
+# 片段長度 有關鍵影格索引時切在這個時間之後的第一個關鍵影格
+SEGMENT_DURATION = 6.0
+# 播放中的片段之後先轉好的片段數
+LOOKAHEAD = 3
+# 超過這個時間沒有請求時 停止轉檔 (沒有人在看)
+IDLE_TIMEOUT = 30
+# 同時轉檔的片段數 x264 本身也會使用多個執行緒
+HLS_WORKERS = max(1, min(2, (os.cpu_count() or 1) // 2))
+AUDIO_SAMPLE_RATE = 48000
+AUDIO_BITRATE = 128_000
+# 所有片段的時間戳加上固定的位移 B 畫格的 DTS 才不會小於 0
+# (小於 0 時 muxer 只會位移那一個片段 片段之間就接不起來)
+TS_OFFSET = 1
+
+
+class SegmentCancelled(Exception):
+    """沒有人在看 片段不再需要"""
+
+
+class HlsPlan(BaseModel):
+    """
+    一部影片的 HLS 切法 所有畫質使用相同的切點
+    key 包含檔案大小與修改時間 檔案改變後不會用到舊的片段
+    還沒有關鍵影格索引時以固定長度切 (key 不同 不會混用兩種切法的片段)
+    """
+
+    key: str
+    source: str
+    duration: float
+    # 片段的起點 最後再加上影片長度
+    boundaries: list[float]
+    # 畫質名稱 (720p) -> (寬, 高)
+    renditions: dict[str, tuple[int, int]]
+    has_audio: bool
+    # 原始解析度可以直接複製影片串流時的畫質名稱
+    copy_rendition: Optional[str] = None
+    copy_audio: bool = False
+    # 原始檔案的平均位元率 (直接複製的畫質使用)
+    source_bitrate: int = 0
+
+    @property
+    def segment_count(self) -> int:
+        return len(self.boundaries) - 1
+
+    def segment_range(self, index: int) -> tuple[float, float]:
+        return self.boundaries[index], self.boundaries[index + 1]
+
+
+def rendition_bitrate(height: int) -> int:
+    """與 makehls 相同的位元率 (每 1p 2kbps)"""
+    return height * 2000
+
+
+def split_segments(
+    keyframes: list[float], duration: float, target: float = SEGMENT_DURATION
+) -> list[float]:
+    """在關鍵影格上切出長度至少 target 秒的片段 回傳起點與最後的結束時間"""
+    start = keyframes[0] if keyframes else 0.0
+    boundaries = [start]
+    for keyframe in keyframes:
+        if keyframe - boundaries[-1] >= target:
+            boundaries.append(keyframe)
+    # 最後一段太短時併入前一段
+    if len(boundaries) > 1 and duration - boundaries[-1] < target / 2:
+        boundaries.pop()
+    boundaries.append(max(duration, boundaries[-1] + 0.001))
+    return boundaries
+
+
+def fixed_segments(duration: float, target: float = SEGMENT_DURATION) -> list[float]:
+    """不依關鍵影格 每 target 秒切一段 (只能用在需要轉檔的畫質)"""
+    starts = [index * target for index in range(int(duration // target) + 1)]
+    return split_segments(starts, duration, target)
+
+
+def hls_plan(video_id: int, source: str, stat: os.stat_result) -> HlsPlan:
+    """依關鍵影格計算切點與畫質 不需要轉檔 也不會在請求中掃描整個檔案"""
+    return _hls_plan(video_id, source, stat.st_size, stat.st_mtime_ns)
+
+
+# 每個片段請求都需要切法 檔案沒有改變時不重新讀取
+@lru_cache(maxsize=64)
+def _hls_plan(video_id: int, source: str, size: int, mtime_ns: int) -> HlsPlan:
+    with av.open(source) as container:
+        if not container.streams.video:
+            raise ValueError("沒有影片串流")
+        stream = container.streams.video[0]
+        width, height = stream.width, stream.height
+        if container.duration:
+            duration = container.duration / av.time_base
+        else:
+            duration = float((stream.duration or 0) * stream.time_base)
+        has_audio = bool(container.streams.audio)
+        copy_video, copy_audio = copyable_streams(container)
+    key = f"{video_id}-{size:x}-{mtime_ns:x}"
+    index = stored_keyframe_index(source, size, mtime_ns)
+    if index is not None:
+        boundaries = split_segments(index.times(), duration)
+    else:
+        # 掃描整個檔案的關鍵影格太久 先以固定長度切 索引由 keyframe_indexer 在背景建立
+        # 切點不在關鍵影格上 原始畫質也需要轉檔
+        keyframe_indexer.notify()
+        boundaries = fixed_segments(duration)
+        key += "-fixed"
+        copy_video = False
+    return HlsPlan(
+        key=key,
+        source=source,
+        duration=duration,
+        boundaries=boundaries,
+        renditions={f"{h}p": (w, h) for w, h in create_resolutions(width, height)},
+        has_audio=has_audio,
+        copy_rendition=f"{height}p" if copy_video else None,
+        copy_audio=copy_audio,
+        source_bitrate=math.ceil(size * 8 / duration) if duration else 0,
+    )
+
+
+def master_playlist(plan: HlsPlan) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for name, (width, height) in plan.renditions.items():
+        if name == plan.copy_rendition:
+            bandwidth = plan.source_bitrate
+        else:
+            bandwidth = rendition_bitrate(height) + (
+                AUDIO_BITRATE if plan.has_audio else 0
+            )
+        lines.append(
+            f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={width}x{height}"
+        )
+        lines.append(f"{name}/index.m3u8")
+    return "\n".join(lines) + "\n"
+
+
+def media_playlist(plan: HlsPlan) -> str:
+    durations = [
+        end - start for start, end in zip(plan.boundaries, plan.boundaries[1:])
+    ]
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{math.ceil(max(durations))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for index, duration in enumerate(durations):
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(f"{index}.ts")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def transcode_segment(
+    source: str,
+    start: float,
+    end: float,
+    width: int,
+    height: int,
+    cancelled: Optional[Callable[[], bool]] = None,
+    copy_video: bool = False,
+    copy_audio: bool = False,
+) -> bytes:
+    """
+    轉出 [start, end) 的 MPEG-TS 片段
+    時間戳沿用原始影片的時間軸 各片段可以直接接在一起播放
+    copy_video 直接複製封包 不解碼也不編碼 (切點必須在關鍵影格上)
+    copy_audio 直接複製音訊封包
+    """
+    output = io.BytesIO()
+    with (
+        av.open(source) as container,
+        av.open(
+            output,
+            "w",
+            format="mpegts",
+            container_options={"output_ts_offset": str(TS_OFFSET)},
+        ) as out,
+    ):
+        video_in = container.streams.video[0]
+        video_in.thread_type = "AUTO"
+        audio_in = container.streams.audio[0] if container.streams.audio else None
+        frame_rate = Fraction(video_in.average_rate or video_in.guessed_rate or 24)
+        # 影片沿用解碼出來的時間戳 (可變幀率的影片也正確) 音訊以取樣數當作時間戳
+        audio_time_base = Fraction(1, AUDIO_SAMPLE_RATE)
+        if copy_video:
+            video_out = out.add_stream(template=video_in)
+        else:
+            video_out = out.add_stream("libx264", rate=frame_rate)
+            video_out.codec_context.time_base = video_in.time_base
+            video_out.width = width
+            video_out.height = height
+            video_out.pix_fmt = "yuv420p"
+            video_out.bit_rate = rendition_bitrate(height)
+            video_out.options = {"preset": "veryfast"}
+        audio_out = resampler = None
+        if audio_in is not None and copy_audio:
+            audio_out = out.add_stream(template=audio_in)
+        elif audio_in is not None:
+            audio_out = out.add_stream("aac", rate=AUDIO_SAMPLE_RATE)
+            audio_out.layout = "stereo"
+            audio_out.bit_rate = AUDIO_BITRATE
+            resampler = av.AudioResampler(
+                format="fltp", layout="stereo", rate=AUDIO_SAMPLE_RATE
+            )
+
+        # 從起點之前最近的關鍵影格開始解碼
+        container.seek(int(start / video_in.time_base), stream=video_in, backward=True)
+        last_pts = -1
+        audio_pts = round(start * AUDIO_SAMPLE_RATE)
+
+        def encode_video(frames) -> bool:
+            """回傳是否已經超過片段結尾"""
+            nonlocal last_pts
+            for frame in frames:
+                if frame.time is None or frame.time < start - 0.001:
+                    continue
+                if frame.time >= end - 0.001:
+                    return True
+                pts = frame.pts
+                if pts <= last_pts:
+                    continue
+                last_pts = pts
+                frame = frame.reformat(width=width, height=height, format="yuv420p")
+                frame.pts = pts
+                frame.time_base = video_in.time_base
+                out.mux(video_out.encode(frame))
+            return False
+
+        def encode_audio(frames) -> bool:
+            nonlocal audio_pts
+            for frame in frames:
+                if frame.time is None or frame.time < start - 0.001:
+                    continue
+                if frame.time >= end - 0.001:
+                    return True
+                for resampled in resampler.resample(frame):
+                    resampled.pts = audio_pts
+                    resampled.time_base = audio_time_base
+                    audio_pts += resampled.samples
+                    out.mux(audio_out.encode(resampled))
+            return False
+
+        video_started = False
+
+        def copy_packet(packet, output_stream) -> bool:
+            """回傳是否已經超過片段結尾"""
+            nonlocal video_started
+            if packet.dts is None or packet.pts is None:
+                return False
+            packet_time = float(packet.pts * packet.time_base)
+            if packet.stream is video_in:
+                # 從起點的關鍵影格開始 到下一段的關鍵影格為止 (依解碼順序)
+                if not video_started:
+                    if not packet.is_keyframe or packet_time < start - 0.001:
+                        return False
+                    video_started = True
+                elif packet.is_keyframe and packet_time >= end - 0.001:
+                    return True
+            elif packet_time < start - 0.001:
+                return False
+            elif packet_time >= end - 0.001:
+                return True
+            packet.stream = output_stream
+            out.mux(packet)
+            return False
+
+        video_done = False
+        audio_done = audio_in is None
+        streams = [video_in] + ([audio_in] if audio_in is not None else [])
+        for packet in container.demux(*streams):
+            if cancelled is not None and cancelled():
+                raise SegmentCancelled()
+            if video_done and audio_done:
+                break
+            # demux 最後會送出空的封包 讓解碼器送出剩下的畫面
+            if packet.stream is video_in and not video_done:
+                if copy_video:
+                    video_done = copy_packet(packet, video_out)
+                else:
+                    video_done = encode_video(packet.decode())
+            elif packet.stream is audio_in and not audio_done:
+                if copy_audio:
+                    audio_done = copy_packet(packet, audio_out)
+                else:
+                    audio_done = encode_audio(packet.decode())
+        if not copy_video:
+            out.mux(video_out.encode(None))
+        if audio_out is not None and not copy_audio:
+            out.mux(audio_out.encode(None))
+    return output.getvalue()
+
+
+class SegmentCache(ThumbnailCache):
+    """轉好的片段 與縮圖快取相同 超過配額時刪除最久沒有使用的"""
+
+    def segment_path(self, key: str, rendition: str, index: int) -> Path:
+        return self.root / key / rendition / f"{index}.ts"
+
+    @staticmethod
+    def _quota() -> int:
+        return load_setting().hls_cache_mb * 1024 * 1024
+
+
+segment_cache = SegmentCache(HLS_DIR)
+
+
+class SegmentJob:
+    def __init__(self, future: Future, cancel: Event):
+        self.future = future
+        self.cancel = cancel
+        # 有請求在等待結果時不會因為跳轉而取消
+        self.requested = False
+
+
+class HlsTranscoder:
+    """
+    隨選轉檔 請求片段時才轉 並先轉之後的 LOOKAHEAD 個片段
+    跳轉時取消還沒開始的預先轉檔 超過 IDLE_TIMEOUT 沒有請求時停止轉檔
+    使用:
+    path = await hls_transcoder.segment(plan, "720p", 3)
+    """
+
+    def __init__(self, workers: int = HLS_WORKERS):
+        self.workers = workers
+        self.lock = Lock()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.jobs: dict[tuple[str, str, int], SegmentJob] = {}
+        # (plan key, 畫質) -> 最後一次請求的時間
+        self.last_seen: dict[tuple[str, str], float] = {}
+
+    async def segment(self, plan: HlsPlan, rendition: str, index: int) -> Path:
+        self._forget_idle()
+        self._watch(plan, rendition, index)
+        path = segment_cache.segment_path(plan.key, rendition, index)
+        with self.lock:
+            job = self._submit(plan, rendition, index)
+            if job is not None:
+                job.requested = True
+            for ahead in range(
+                index + 1, min(index + 1 + LOOKAHEAD, plan.segment_count)
+            ):
+                self._submit(plan, rendition, ahead)
+        if job is None:
+            return path
+        # 請求中斷時不取消 轉好的片段之後還會用到
+        return await asyncio.shield(asyncio.wrap_future(job.future))
+
+    def _watch(self, plan: HlsPlan, rendition: str, index: int) -> None:
+        """記錄播放位置 取消播放位置之外還沒開始的預先轉檔"""
+        with self.lock:
+            self.last_seen[(plan.key, rendition)] = time.monotonic()
+            for (key, name, ahead), job in list(self.jobs.items()):
+                if (key, name) != (plan.key, rendition) or job.requested:
+                    continue
+                if not index <= ahead <= index + LOOKAHEAD and job.future.cancel():
+                    del self.jobs[(key, name, ahead)]
+
+    def _submit(
+        self, plan: HlsPlan, rendition: str, index: int
+    ) -> Optional[SegmentJob]:
+        """已經轉好時回傳 None 需要在 lock 中呼叫"""
+        job_key = (plan.key, rendition, index)
+        job = self.jobs.get(job_key)
+        if job is not None:
+            return job
+        path = segment_cache.segment_path(plan.key, rendition, index)
+        try:
+            segment_cache.touch(path, path.stat().st_mtime)
+            return None
+        except FileNotFoundError:
+            pass
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="hls"
+            )
+        cancel = Event()
+        job = SegmentJob(
+            self.executor.submit(self._run, plan, rendition, index, cancel), cancel
+        )
+        self.jobs[job_key] = job
+        job.future.add_done_callback(lambda done: self._done(job_key, done))
+        return job
+
+    def _done(self, job_key: tuple[str, str, int], future: Future) -> None:
+        with self.lock:
+            job = self.jobs.get(job_key)
+            if job is not None and job.future is future:
+                del self.jobs[job_key]
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None and not isinstance(error, SegmentCancelled):
+            logger.error(f"HLS segment {job_key} failed: {error}")
+
+    def _idle(self, plan: HlsPlan, rendition: str) -> bool:
+        with self.lock:
+            last_seen = self.last_seen.get((plan.key, rendition), 0)
+        return time.monotonic() - last_seen > IDLE_TIMEOUT
+
+    def _run(self, plan: HlsPlan, rendition: str, index: int, cancel: Event) -> Path:
+        path = segment_cache.segment_path(plan.key, rendition, index)
+        if path.exists():
+            return path
+        if self._idle(plan, rendition):
+            raise SegmentCancelled()
+        start, end = plan.segment_range(index)
+        width, height = plan.renditions[rendition]
+        copy_video = rendition == plan.copy_rendition
+        began = time.monotonic()
+        data = transcode_segment(
+            plan.source,
+            start,
+            end,
+            width,
+            height,
+            lambda: cancel.is_set() or self._idle(plan, rendition),
+            copy_video=copy_video,
+            copy_audio=plan.copy_audio,
+        )
+        segment_cache.write(path, data)
+        logger.debug(
+            f"HLS {plan.key} {rendition} #{index} "
+            f"({end - start:.1f}s) in {time.monotonic() - began:.2f}s"
+        )
+        return path
+
+    def _forget_idle(self) -> None:
+        """沒有人在看的影片 轉檔中的工作會自己停止 這裡只清掉紀錄"""
+        with self.lock:
+            now = time.monotonic()
+            for watched, last_seen in list(self.last_seen.items()):
+                if now - last_seen > IDLE_TIMEOUT:
+                    del self.last_seen[watched]
+
+    def shutdown(self) -> None:
+        with self.lock:
+            executor, self.executor = self.executor, None
+            for job in self.jobs.values():
+                job.cancel.set()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+hls_transcoder = HlsTranscoder()
@@ -0,0 +1,266 @@
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from threading import BoundedSemaphore, Condition, Lock
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# (連線, 讀取) 秒數
+TIMEOUT = (5, 20)
+# 同一個主機最多同時幾個請求
+HOST_CONCURRENCY = 4
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Retry-After 最多等待的秒數 避免 worker 被卡住太久
+MAX_RETRY_AFTER = 60
+
+# 每秒請求數, 可累積的額度 (MusicBrainz 規定每個客戶端每秒 1 次)
+RATE_LIMITS = {
+    "musicbrainz": (1.0, 1),
+}
+
+PROVIDERS = {
+    "musicbrainz.org": "musicbrainz",
+    "coverartarchive.org": "coverartarchive",
+    "api.bgm.tv": "bangumi",
+    "lrclib.net": "lrclib",
+    "api.themoviedb.org": "tmdb",
+    "image.tmdb.org": "tmdb_image",
+}
+
+
+def provider_of(url: str) -> str:
+    """用主機名稱對應到提供者 其他的主機直接用主機名稱"""
+    host = urlsplit(url).hostname or ""
+    for domain, provider in PROVIDERS.items():
+        if host == domain or host.endswith("." + domain):
+            return provider
+    return host
+
+
+class ProviderStats:
+    """每個提供者的請求數 / 錯誤數 / 延遲 / 快取命中數"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stats: dict[str, dict] = {}
+
+    def _stat(self, provider: str) -> dict:
+        return self.stats.setdefault(
+            provider,
+            {
+                "requests": 0,
+                "errors": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "last_error": None,
+                "cache_hits": 0,
+                "cache_misses": 0,
+            },
+        )
+
+    def record(
+        self, provider: str, elapsed: float, error: Optional[str] = None
+    ) -> None:
+        with self.lock:
+            stat = self._stat(provider)
+            elapsed_ms = elapsed * 1000
+            stat["requests"] += 1
+            stat["total_ms"] += elapsed_ms
+            stat["max_ms"] = max(stat["max_ms"], elapsed_ms)
+            if error:
+                stat["errors"] += 1
+                stat["last_error"] = error
+
+    def record_cache(self, provider: str, hit: bool) -> None:
+        with self.lock:
+            self._stat(provider)["cache_hits" if hit else "cache_misses"] += 1
+
+    def snapshot(self) -> dict[str, dict]:
+        with self.lock:
+            return {
+                provider: {
+                    "requests": stat["requests"],
+                    "errors": stat["errors"],
+                    "avg_ms": round(stat["total_ms"] / stat["requests"], 1)
+                    if stat["requests"]
+                    else 0.0,
+                    "max_ms": round(stat["max_ms"], 1),
+                    "last_error": stat["last_error"],
+                    "cache_hits": stat["cache_hits"],
+                    "cache_misses": stat["cache_misses"],
+                }
+                for provider, stat in self.stats.items()
+            }
+
+
+provider_stats = ProviderStats()
+
+
+class RateLimiter:
+    """
+    Token bucket 額度不足時排隊等待 priority 高的請求先拿到額度
+    使用:
+    limiter.acquire(priority)
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.cond = Condition()
+        self.waiters: list[tuple[int, int]] = []
+        self.counter = itertools.count()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority: int = 0) -> None:
+        with self.cond:
+            entry = (-priority, next(self.counter))
+            heapq.heappush(self.waiters, entry)
+            while True:
+                self._refill()
+                if self.waiters[0] is entry:
+                    if self.tokens >= 1:
+                        heapq.heappop(self.waiters)
+                        self.tokens -= 1
+                        self.cond.notify_all()
+                        return
+                    self.cond.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.cond.wait()
+
+    def pause(self, seconds: float) -> None:
+        """接下來 seconds 秒內不發出額度 (伺服器回應 429 / 503 時)"""
+        with self.cond:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+            self.cond.notify_all()
+
+
+rate_limiters = {
+    provider: RateLimiter(rate, burst)
+    for provider, (rate, burst) in RATE_LIMITS.items()
+}
+
+# 目前查詢的優先順序 (使用者正在開啟的項目較高)
+lookup_priority: ContextVar[int] = ContextVar("lookup_priority", default=0)
+
+
+@contextmanager
+def priority(value: int):
+    """在這個區塊內發出的請求使用指定的優先順序"""
+    token = lookup_priority.set(value)
+    try:
+        yield
+    finally:
+        lookup_priority.reset(token)
+
+
+def _status_error(status_code: int) -> Optional[str]:
+    if status_code in RETRY_STATUS:
+        return f"HTTP {status_code}"
+    return None
+
+
+def _retry_delay(headers, attempt: int) -> float:
+    """依 Retry-After (秒數或日期) 決定重試前的等待時間 沒有時以指數退避"""
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = 0
+        if delay > 0:
+            return min(delay, MAX_RETRY_AFTER)
+    return BACKOFF_FACTOR * (2**attempt)
+
+
+class HttpClient:
+    """
+    所有線上資料提供者共用的 HTTP 連線
+    連線池 + keep-alive, 預設 timeout, 429/5xx 退避重試, 每個主機限制同時請求數
+    有速率限制的提供者 (RATE_LIMITS) 依 priority() 排隊取得額度
+    每次重試都重新取得額度 Retry-After 期間整個提供者暫停發出額度
+    使用:
+    response = http.get(url, params=...)
+    async 的路由中以 run_in_threadpool 呼叫
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=len(PROVIDERS),
+            pool_maxsize=HOST_CONCURRENCY,
+            # 只重試連線失敗 (請求沒有送到伺服器) 429/5xx 在 get 中重試
+            # 這樣每次重試都會經過速率限制
+            max_retries=Retry(
+                total=MAX_RETRIES,
+                connect=MAX_RETRIES,
+                read=0,
+                status=0,
+                other=0,
+                backoff_factor=BACKOFF_FACTOR,
+                allowed_methods=["GET", "HEAD"],
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = Lock()
+        self.host_limits: dict[str, BoundedSemaphore] = {}
+
+    def _host_limit(self, host: str) -> BoundedSemaphore:
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = BoundedSemaphore(HOST_CONCURRENCY)
+            return self.host_limits[host]
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", TIMEOUT)
+        provider = provider_of(url)
+        limiter = rate_limiters.get(provider)
+        start = time.monotonic()
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                if limiter:
+                    limiter.acquire(lookup_priority.get())
+                with self._host_limit(urlsplit(url).hostname or ""):
+                    response = self.session.get(url, **kwargs)
+                if response.status_code not in RETRY_STATUS or attempt == MAX_RETRIES:
+                    break
+                delay = _retry_delay(response.headers, attempt)
+                response.close()
+                if limiter:
+                    # 下一次 acquire 會等到暫停結束
+                    limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+        except requests.RequestException as e:
+            provider_stats.record(provider, time.monotonic() - start, str(e))
+            raise
+        provider_stats.record(
+            provider, time.monotonic() - start, _status_error(response.status_code)
+        )
+        return response
+
+    def close(self) -> None:
+        self.session.close()
+
+
+http = HttpClient()
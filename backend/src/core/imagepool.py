@@ -0,0 +1,98 @@
+import asyncio
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Hashable, Optional
+
+from core.logger import logger
+
+# Pillow 解碼 / 縮放 / 編碼時會釋放 GIL 執行緒就能使用多核心
+IMAGE_WORKERS = min(4, os.cpu_count() or 1)
+# 等待中的工作超過這個數量時直接拒絕 (503) 不讓請求無限堆積
+IMAGE_QUEUE_LIMIT = 64
+# 503 時建議用戶端等待的秒數
+RETRY_AFTER = 1
+
+
+class ImagePoolBusy(Exception):
+    """圖片處理佇列已滿"""
+
+
+class ImagePool:
+    """
+    圖片處理專用的執行緒池 與 FastAPI 的共用執行緒池分開
+    佇列有上限 相同 key 的工作同時只會執行一次 (single-flight)
+    使用:
+    path = await image_pool.run(("thumbnail", image_id, 200, "webp"), render, ...)
+    """
+
+    def __init__(
+        self, workers: int = IMAGE_WORKERS, queue_limit: int = IMAGE_QUEUE_LIMIT
+    ):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.lock = Lock()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        # 執行中與等待中的工作
+        self.inflight: dict[Hashable, Future] = {}
+        self.rejected = 0
+
+    def submit(self, key: Hashable, fn: Callable, *args) -> Future:
+        """送出工作 相同 key 正在處理時回傳同一個 Future 佇列已滿時丟出 ImagePoolBusy"""
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                return future
+            if len(self.inflight) >= self.workers + self.queue_limit:
+                self.rejected += 1
+                raise ImagePoolBusy()
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="image"
+                )
+            future = self.executor.submit(fn, *args)
+            self.inflight[key] = future
+        future.add_done_callback(lambda done: self._done(key, done))
+        return future
+
+    def try_submit(self, key: Hashable, fn: Callable, *args) -> Optional[Future]:
+        """
+        只在有閒置的執行緒時送出 否則回傳 None
+        給可以略過的背景工作 (預先產生縮圖) 使用 不佔用請求的佇列
+        """
+        with self.lock:
+            if key not in self.inflight and len(self.inflight) >= self.workers:
+                return None
+        try:
+            return self.submit(key, fn, *args)
+        except ImagePoolBusy:
+            return None
+
+    def _done(self, key: Hashable, future: Future) -> None:
+        with self.lock:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Image task {key} failed: {future.exception()}")
+
+    async def run(self, key: Hashable, fn: Callable, *args):
+        # 請求中斷時不取消工作 其他等待同一個 key 的請求仍需要結果
+        return await asyncio.shield(asyncio.wrap_future(self.submit(key, fn, *args)))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "inflight": len(self.inflight),
+                "queue_limit": self.queue_limit,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self) -> None:
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+image_pool = ImagePool()
@@ -0,0 +1,208 @@
+import hashlib
+import io
+import os
+import re
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Iterable, Optional, Union
+from uuid import uuid4
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, delete, select, union
+
+from db import engine
+from core.imagepool import image_pool
+from core.logger import logger
+from core.thumbnail import render_placeholder, thumbnail_cache
+from models import Album, AnimeSeries, ImagePlaceholder, MusicTrack, Video
+
+IMAGES_DIR = Path("data/images")
+# 剛寫入但還沒 commit 的圖片不能被清掉
+GC_GRACE = timedelta(hours=1)
+
+HASH_ID = re.compile(r"^[0-9a-f]{40}\.jpg$")
+# 舊版用 uuid4 命名 直接放在 data/images 底下
+LEGACY_ID = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.jpg$"
+)
+
+
+def image_path(image_id: str) -> Optional[Path]:
+    """圖片 ID 對應的檔案路徑 ID 格式不正確時回傳 None"""
+    if HASH_ID.match(image_id):
+        return IMAGES_DIR / image_id[:2] / image_id[2:4] / image_id
+    if LEGACY_ID.match(image_id):
+        return IMAGES_DIR / image_id
+    return None
+
+
+def image_exists(image_id: str) -> bool:
+    path = image_path(image_id)
+    return path is not None and path.exists()
+
+
+def save_image(image_data: bytes) -> str:
+    """
+    以內容雜湊存放圖片 相同內容只會存一份
+    data/images/ab/cd/abcd....jpg
+    只寫入檔案 可以在掃描的子程序中執行 預覽 / 縮圖由主程序處理 (image_placeholders)
+    """
+    image_id = hashlib.blake2b(image_data, digest_size=20).hexdigest() + ".jpg"
+    path = image_path(image_id)
+    if path.exists():
+        # 更新時間 避免被同時執行的 GC 當作沒有引用的圖片
+        os.utime(path)
+        return image_id
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{uuid4()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(image_data)
+    os.replace(tmp_path, path)
+    return image_id
+
+
+def image_placeholders(*image_ids: Optional[str]) -> dict[str, str]:
+    """
+    產生已存放圖片的預覽 只運算不寫資料庫 可以在子程序中執行
+    圖片 ID -> 預覽 data URI 失敗時只記錄
+    """
+    placeholders = {}
+    for image_id in image_ids:
+        path = image_id and image_path(image_id)
+        if not path:
+            continue
+        try:
+            placeholders[image_id] = render_placeholder(path)
+        except Exception as e:
+            logger.error(f"Error creating placeholder of {image_id}: {str(e)}")
+    return placeholders
+
+
+def save_placeholders(placeholders: dict[str, str], db: Session) -> None:
+    """寫入預覽 (不 commit) 已經有預覽的圖片略過"""
+    if not placeholders:
+        return
+    db.exec(
+        pg_insert(ImagePlaceholder).on_conflict_do_nothing(),
+        params=[
+            {"image_id": image_id, "placeholder": placeholder}
+            for image_id, placeholder in placeholders.items()
+        ],
+    )
+
+
+def save_placeholder(image_id: str, source: Union[Path, io.BytesIO]) -> Optional[str]:
+    """產生並儲存圖片的預覽 失敗時只記錄"""
+    try:
+        placeholder = render_placeholder(source)
+        with Session(engine) as db:
+            save_placeholders({image_id: placeholder}, db)
+            db.commit()
+        return placeholder
+    except Exception as e:
+        logger.error(f"Error creating placeholder of {image_id}: {str(e)}")
+        return None
+
+
+def _pregenerate(image_id: str) -> None:
+    thumbnail_cache.pregenerate(image_id, image_path(image_id).read_bytes())
+
+
+def pregenerate_thumbnails(image_ids: Iterable[str]) -> None:
+    """圖片執行緒池閒置時預先產生常用尺寸的縮圖 忙碌時略過 (請求時才產生)"""
+    for image_id in image_ids:
+        if image_path(image_id) is None:
+            continue
+        if (
+            image_pool.try_submit(("pregenerate", image_id), _pregenerate, image_id)
+            is None
+        ):
+            return
+
+
+def get_placeholders(image_ids: Iterable[Optional[str]], db: Session) -> dict[str, str]:
+    """圖片 ID -> 預覽 data URI 沒有預覽的圖片不會出現"""
+    ids = {image_id for image_id in image_ids if image_id}
+    if not ids:
+        return {}
+    rows = db.exec(
+        select(ImagePlaceholder.image_id, ImagePlaceholder.placeholder).where(
+            ImagePlaceholder.image_id.in_(ids)
+        )
+    ).all()
+    return {image_id: placeholder for image_id, placeholder in rows}
+
+
+def backfill_placeholders(referenced: set[str], db: Session) -> int:
+    """替預覽功能加入之前存的圖片補上預覽"""
+    existing = set(get_placeholders(referenced, db))
+    created = 0
+    for image_id in referenced - existing:
+        if image_exists(image_id) and save_placeholder(image_id, image_path(image_id)):
+            created += 1
+    return created
+
+
+def referenced_images(db: Session) -> set[str]:
+    query = union(
+        select(MusicTrack.cover_art).where(MusicTrack.cover_art.is_not(None)),
+        select(Album.cover_art).where(Album.cover_art.is_not(None)),
+        select(Video.thumbnail).where(Video.thumbnail.is_not(None)),
+        select(AnimeSeries.cover_image).where(AnimeSeries.cover_image.is_not(None)),
+    )
+    return {row[0] for row in db.exec(query).all()}
+
+
+def collect_garbage(db: Session, grace: timedelta = GC_GRACE) -> dict:
+    """刪除沒有被任何資料引用的圖片"""
+    referenced = referenced_images(db)
+    deadline = time.time() - grace.total_seconds()
+    removed, freed = 0, 0
+    removed_ids = []
+    if not IMAGES_DIR.exists():
+        return {
+            "removed": removed,
+            "freed_bytes": freed,
+            "thumbnails": 0,
+            "placeholders": 0,
+        }
+    for root, dirs, files in os.walk(IMAGES_DIR, topdown=False):
+        for name in files:
+            path = Path(root) / name
+            try:
+                stat = path.stat()
+                if name in referenced or stat.st_mtime > deadline:
+                    continue
+                if image_path(name) != path and not name.endswith(".tmp"):
+                    continue
+                path.unlink()
+            except OSError as e:
+                logger.error(f"Error removing image {path}: {str(e)}")
+                continue
+            removed += 1
+            freed += stat.st_size
+            removed_ids.append(name)
+        if Path(root) != IMAGES_DIR:
+            try:
+                # 只會刪除空的分層目錄
+                os.rmdir(root)
+            except OSError:
+                pass
+    thumbnails = thumbnail_cache.remove_orphans(image_exists)
+    if removed_ids:
+        db.exec(
+            delete(ImagePlaceholder).where(ImagePlaceholder.image_id.in_(removed_ids))
+        )
+        db.commit()
+    placeholders = backfill_placeholders(referenced, db)
+    logger.info(
+        f"Image GC removed {removed} files, freed {freed} bytes, "
+        f"{thumbnails} thumbnails, created {placeholders} placeholders"
+    )
+    return {
+        "removed": removed,
+        "freed_bytes": freed,
+        "thumbnails": thumbnails,
+        "placeholders": placeholders,
+    }
@@ -0,0 +1,217 @@
+import os
+import struct
+from bisect import bisect_right
+from datetime import datetime
+from fractions import Fraction
+from threading import Event, Thread
+from typing import Optional
+
+import av
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, select
+
+from db import engine
+from core.logger import logger
+from models import VideoFile, VideoKeyframeIndex
+
+# (pts, 位元組位置, 封包大小) 每筆 20 bytes 兩小時的影片 (每 2 秒一個關鍵影格) 約 70KB
+KEYFRAME_ENTRY = struct.Struct("<qqI")
+# 沒有需要建立索引的影片時 多久檢查一次
+IDLE_SECONDS = 30
+
+
+class KeyframeIndex:
+    """
+    依時間排序的關鍵影格 時間 -> 檔案位置只需要二分搜尋
+    使用:
+    index = keyframe_index(path, stat.st_size, stat.st_mtime_ns)
+    time, offset = index.locate(120.0)
+    """
+
+    def __init__(self, time_base: Fraction, entries: bytes):
+        self.time_base = time_base
+        self.entries = entries
+        self.pts = [pts for pts, _, _ in KEYFRAME_ENTRY.iter_unpack(entries)]
+
+    @classmethod
+    def scan(cls, source: str) -> "KeyframeIndex":
+        """只讀取封包不解碼 整個檔案讀一次"""
+        keyframes = []
+        with av.open(source) as container:
+            stream = container.streams.video[0]
+            for packet in container.demux(stream):
+                if packet.is_keyframe and packet.pts is not None:
+                    keyframes.append(
+                        (
+                            packet.pts,
+                            packet.pos if packet.pos is not None else -1,
+                            packet.size,
+                        )
+                    )
+            time_base = stream.time_base
+        keyframes.sort()
+        return cls(
+            time_base, b"".join(KEYFRAME_ENTRY.pack(*entry) for entry in keyframes)
+        )
+
+    def __len__(self) -> int:
+        return len(self.pts)
+
+    def entry(self, index: int) -> tuple[int, int, int]:
+        return KEYFRAME_ENTRY.unpack_from(self.entries, index * KEYFRAME_ENTRY.size)
+
+    def times(self) -> list[float]:
+        return [float(pts * self.time_base) for pts in self.pts]
+
+    def floor(self, seconds: float) -> Optional[tuple[int, int, int]]:
+        """seconds 之前 (含) 最近的關鍵影格 沒有關鍵影格時回傳 None"""
+        if not self.pts:
+            return None
+        target = int(Fraction(seconds) / self.time_base)
+        return self.entry(max(bisect_right(self.pts, target) - 1, 0))
+
+    def locate(self, seconds: float) -> Optional[tuple[float, int]]:
+        """回傳 seconds 之前 (含) 最近的關鍵影格 (時間, 位元組位置)"""
+        entry = self.floor(seconds)
+        if entry is None:
+            return None
+        pts, offset, _ = entry
+        return float(pts * self.time_base), offset
+
+
+def _stored_index(
+    source: str, size: int, mtime_ns: int
+) -> tuple[Optional[int], Optional[KeyframeIndex]]:
+    """(影片檔案 ID, 資料庫中的索引) 不在資料庫中 / 沒有索引 / 檔案已經改變時為 None"""
+    with Session(engine) as db:
+        video_file_id = db.exec(
+            select(VideoFile.id).where(VideoFile.filepath == source)
+        ).first()
+        if video_file_id is None:
+            return None, None
+        row = db.get(VideoKeyframeIndex, video_file_id)
+        if row is None or row.file_size != size or row.mtime_ns != mtime_ns:
+            return video_file_id, None
+        return video_file_id, KeyframeIndex(
+            Fraction(row.time_base_num, row.time_base_den), row.entries
+        )
+
+
+def stored_keyframe_index(
+    source: str, size: int, mtime_ns: int
+) -> Optional[KeyframeIndex]:
+    """只讀取資料庫中的索引 不掃描檔案 沒有時回傳 None"""
+    return _stored_index(source, size, mtime_ns)[1]
+
+
+def keyframe_index(source: str, size: int, mtime_ns: int) -> KeyframeIndex:
+    """
+    讀取資料庫中的索引 沒有或檔案已經改變時掃描一次並存回
+    不在資料庫中的檔案只掃描不儲存
+    索引平常由 keyframe_indexer 在影片加入資料庫後建立 這裡的掃描只是備用
+    """
+    video_file_id, index = _stored_index(source, size, mtime_ns)
+    if index is not None:
+        return index
+
+    index = KeyframeIndex.scan(source)
+    if video_file_id is None:
+        return index
+    values = {
+        "file_size": size,
+        "mtime_ns": mtime_ns,
+        "time_base_num": index.time_base.numerator,
+        "time_base_den": index.time_base.denominator,
+        "entries": index.entries,
+    }
+    try:
+        with Session(engine) as db:
+            db.exec(
+                pg_insert(VideoKeyframeIndex)
+                .values(video_file_id=video_file_id, **values)
+                .on_conflict_do_update(
+                    index_elements=["video_file_id"],
+                    set_={**values, "updated_at": datetime.now()},
+                )
+            )
+            db.commit()
+    except Exception as e:
+        logger.error(f"Error saving keyframe index of {source}: {str(e)}")
+    return index
+
+
+class KeyframeIndexer:
+    """
+    在背景為還沒有索引的影片建立關鍵影格索引 第一次播放 / 跳轉時不需要等待整個檔案讀完
+    影片加入或更新 (會刪除舊的索引) 後呼叫 notify
+    使用:
+    keyframe_indexer.start()
+    keyframe_indexer.notify()
+    keyframe_indexer.stop()
+    """
+
+    def __init__(self):
+        self.stop_event = Event()
+        self.wakeup = Event()
+        self.thread: Optional[Thread] = None
+        # 無法讀取的檔案 這次執行期間不再重試 (播放時仍會嘗試)
+        self.failed: set[int] = set()
+
+    def start(self) -> None:
+        stop_event = self.stop_event = Event()
+        self.thread = Thread(
+            target=self._worker, args=(stop_event,), daemon=True, name="keyframes"
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+            self.thread = None
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def run_once(self) -> bool:
+        """為一個沒有索引的影片建立索引 沒有時回傳 False"""
+        query = (
+            select(VideoFile.id, VideoFile.filepath)
+            .outerjoin(
+                VideoKeyframeIndex, VideoKeyframeIndex.video_file_id == VideoFile.id
+            )
+            .where(VideoKeyframeIndex.video_file_id.is_(None))
+            .order_by(VideoFile.id.desc())
+            .limit(1)
+        )
+        if self.failed:
+            query = query.where(VideoFile.id.not_in(self.failed))
+        with Session(engine) as db:
+            row = db.exec(query).first()
+        if row is None:
+            return False
+        video_file_id, filepath = row
+        try:
+            stat = os.stat(filepath)
+            keyframe_index(filepath, stat.st_size, stat.st_mtime_ns)
+        except Exception as e:
+            logger.error(f"Error indexing keyframes of {filepath}: {str(e)}")
+        with Session(engine) as db:
+            # 讀取或儲存失敗 避免一直重新掃描同一個檔案
+            if db.get(VideoKeyframeIndex, video_file_id) is None:
+                self.failed.add(video_file_id)
+        return True
+
+    def _worker(self, stop_event: Event) -> None:
+        while not stop_event.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                logger.error(f"Keyframe indexer failed: {str(e)}")
+            self.wakeup.wait(IDLE_SECONDS)
+            self.wakeup.clear()
+
+
+keyframe_indexer = KeyframeIndexer()
@@ -1,14 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import av
 import subprocess
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import math
 
+from core.logger import logger
+
+# 片段長度 每個片段的開頭都強制為關鍵影格 分段轉檔時切點才會對齊
+HLS_TIME = 10
+# 分段轉檔時每段至少的長度 太短時啟動 ffmpeg 的成本比轉檔還高
+MIN_SHARD_DURATION = 300
+# 瀏覽器可以直接播放的編碼 (8-bit 4:2:0 H.264 / AAC) 不需要重新編碼
+COPY_VIDEO_CODECS = ("h264",)
+COPY_PIX_FMTS = ("yuv420p", "yuvj420p")
+COPY_AUDIO_CODECS = ("aac",)
+# 重新編碼的畫質共用同一個音訊 (只編碼一次) 播放列表放在這個目錄
+AUDIO_GROUP = "audio"
+
 
 def get_video_info(video: av.container.InputContainer) -> Tuple[int, int, float]:
     """獲取影片資訊"""
     stream = video.streams.video[0]
-    return stream.width, stream.height, float(stream.duration * stream.time_base)
+    if video.duration:
+        duration = video.duration / av.time_base
+    else:
+        duration = float((stream.duration or 0) * stream.time_base)
+    return stream.width, stream.height, duration
 
 
 def create_resolutions(width: int, height: int) -> List[Tuple[int, int]]:
@@ -31,66 +49,320 @@ def create_resolutions(width: int, height: int) -> List[Tuple[int, int]]:
     return resolutions
 
 
-def create_hls(videopath: Path, output_dir: Path) -> Path:
-    """將影片轉換為 HLS 格式"""
-    video = av.open(str(videopath))
-    width, height, duration = get_video_info(video)
-    resolutions = create_resolutions(width, height)
+def copyable_streams(
+    video: av.container.InputContainer, codec: Optional[str] = None
+) -> Tuple[bool, bool]:
+    """
+    回傳 (影片可以直接複製, 音訊可以直接複製)
+    codec 為資料庫中的 VideoFile.codec 有提供時以它為準
+    """
+    stream = video.streams.video[0]
+    copy_video = (codec or stream.codec_context.name) in COPY_VIDEO_CODECS and (
+        stream.codec_context.pix_fmt in COPY_PIX_FMTS
+    )
+    audio = video.streams.audio
+    copy_audio = not audio or audio[0].codec_context.name in COPY_AUDIO_CODECS
+    return copy_video, copy_audio
 
-    output_dir.mkdir(parents=True, exist_ok=True)
 
-    master_playlist = "#EXTM3U\n"
+def split_shards(duration: float, shards: int) -> List[Tuple[float, float]]:
+    """把影片依時間切成 shards 段 切點對齊片段長度"""
+    shards = max(1, min(shards, math.ceil(duration / MIN_SHARD_DURATION)))
+    length = math.ceil(duration / shards / HLS_TIME) * HLS_TIME
+    ranges = []
+    start = 0
+    while start < duration:
+        ranges.append((start, min(start + length, duration)))
+        start += length
+    return ranges or [(0, duration)]
+
+
+def build_command(
+    videopath: Path,
+    output_dir: Path,
+    resolutions: List[Tuple[int, int]],
+    has_audio: bool,
+    shard: int = 0,
+    time_range: Optional[Tuple[float, float]] = None,
+) -> List[str]:
+    """
+    解碼一次 以 split 產生所有解析度 一個 ffmpeg 輸出所有畫質
+    音訊只編碼一次 輸出到 AUDIO_GROUP 各畫質以 agroup 引用
+    time_range 只轉換這段時間 時間戳接在前一段之後 片段以 shard 編號開頭
+    """
+    cmd = ["ffmpeg", "-y", "-hwaccel", "auto"]
+    if time_range is not None:
+        start, end = time_range
+        cmd += ["-ss", f"{start:.3f}", "-t", f"{end - start:.3f}"]
+    cmd += ["-i", str(videopath)]
 
-    for res_width, res_height in resolutions:
-        variant_name = f"{res_height}p"
-        variant_dir = output_dir / variant_name
-        variant_dir.mkdir(exist_ok=True)
-
-        cmd = [
-            "ffmpeg",
-            "-hwaccel",
-            "auto",
-            "-i",
-            str(videopath),
-            "-vf",
-            f"scale={res_width}:{res_height}",
-            "-c:v",
+    outputs = "".join(f"[v{i}]" for i in range(len(resolutions)))
+    filters = [f"[0:v:0]split={len(resolutions)}{outputs}"]
+    for i, (res_width, res_height) in enumerate(resolutions):
+        filters.append(f"[v{i}]scale={res_width}:{res_height}[v{i}out]")
+    cmd += ["-filter_complex", ";".join(filters)]
+
+    stream_map = []
+    for i, (_, res_height) in enumerate(resolutions):
+        cmd += [
+            "-map",
+            f"[v{i}out]",
+            f"-c:v:{i}",
             "h264",
-            "-c:a",
-            "aac",
-            "-b:v",
+            f"-b:v:{i}",
             f"{res_height * 2}k",
-            "-hls_time",
-            "10",
-            "-hls_playlist_type",
-            "vod",
+        ]
+        variant = f"v:{i}"
+        if has_audio:
+            variant += f",agroup:{AUDIO_GROUP}"
+        stream_map.append(f"{variant},name:{res_height}p")
+    if has_audio:
+        cmd += ["-map", "0:a:0", "-c:a", "aac"]
+        stream_map.append(f"a:0,agroup:{AUDIO_GROUP},name:{AUDIO_GROUP}")
+
+    cmd += [
+        "-force_key_frames",
+        f"expr:gte(t,n_forced*{HLS_TIME})",
+        "-f",
+        "hls",
+        "-hls_time",
+        str(HLS_TIME),
+        "-hls_playlist_type",
+        "vod",
+        "-var_stream_map",
+        " ".join(stream_map),
+    ]
+    if time_range is None:
+        cmd += [
+            "-hls_segment_filename",
+            f"{output_dir}/%v/%03d.ts",
+            f"{output_dir}/%v/playlist.m3u8",
+        ]
+    else:
+        cmd += [
+            "-output_ts_offset",
+            f"{time_range[0]:.3f}",
             "-hls_segment_filename",
-            f"{variant_dir}/%03d.ts",
-            f"{variant_dir}/playlist.m3u8",
+            f"{output_dir}/%v/{shard:03d}-%03d.ts",
+            f"{output_dir}/%v/shard{shard:03d}.m3u8",
         ]
+    return cmd
+
+
+def build_remux_command(
+    videopath: Path, variant_dir: Path, has_audio: bool, copy_audio: bool
+) -> List[str]:
+    """原始解析度直接複製影片串流 輸出 fMP4 片段 音訊不相容時只轉換音訊"""
+    cmd = ["ffmpeg", "-y", "-i", str(videopath), "-map", "0:v:0", "-c:v", "copy"]
+    if has_audio:
+        cmd += ["-map", "0:a:0", "-c:a", "copy" if copy_audio else "aac"]
+    cmd += [
+        "-f",
+        "hls",
+        "-hls_time",
+        str(HLS_TIME),
+        "-hls_playlist_type",
+        "vod",
+        "-hls_segment_type",
+        "fmp4",
+        "-hls_fmp4_init_filename",
+        "init.mp4",
+        "-hls_segment_filename",
+        f"{variant_dir}/%03d.m4s",
+        f"{variant_dir}/playlist.m3u8",
+    ]
+    return cmd
+
+
+def read_playlist(playlist: Path) -> List[Tuple[float, str]]:
+    """讀出播放列表中每個片段的 (長度, 檔名)"""
+    segments = []
+    duration = None
+    for line in playlist.read_text().splitlines():
+        if line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:") :].split(",")[0])
+        elif line and not line.startswith("#") and duration is not None:
+            segments.append((duration, line))
+            duration = None
+    return segments
+
 
-        try:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
-            print(f"處理 {res_height}p 解析度完成")
+def write_playlist(playlist: Path, shards: List[List[Tuple[float, str]]]) -> None:
+    """
+    把各段的片段合併成一個播放列表
+    段與段之間的時間戳不保證連續 接合處加上 EXT-X-DISCONTINUITY
+    """
+    segments = [segment for shard in shards for segment in shard]
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{math.ceil(max(d for d, _ in segments))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for index, shard in enumerate(shards):
+        if index > 0 and shard:
+            lines.append("#EXT-X-DISCONTINUITY")
+        for duration, name in shard:
+            lines += [f"#EXTINF:{duration:.6f},", name]
+    lines.append("#EXT-X-ENDLIST")
+    playlist.write_text("\n".join(lines) + "\n")
 
-            if not (variant_dir / "playlist.m3u8").exists():
-                raise Exception(f"無法產生 {res_height}p 的播放列表")
 
-            master_playlist += f"#EXT-X-STREAM-INF:BANDWIDTH={res_height * 2000},RESOLUTION={res_width}x{res_height}\n"
-            master_playlist += f"{variant_name}/playlist.m3u8\n"
+def measure_bandwidth(
+    variant_dir: Path, segments: List[Tuple[float, str]]
+) -> Tuple[int, int]:
+    """依實際的片段大小計算 (最高, 平均) 位元率"""
+    peak = 0
+    total_bits = 0
+    total_duration = 0.0
+    for duration, name in segments:
+        bits = (variant_dir / name).stat().st_size * 8
+        total_bits += bits
+        total_duration += duration
+        if duration > 0:
+            peak = max(peak, math.ceil(bits / duration))
+    average = math.ceil(total_bits / total_duration) if total_duration else 0
+    return peak, average
 
-        except subprocess.CalledProcessError as e:
-            print(f"處理 {res_height}p 時發生錯誤:")
-            print(f"錯誤輸出: {e.stderr}")
-            continue
-        except Exception as e:
-            print(f"發生錯誤: {str(e)}")
-            continue
+
+def run_ffmpeg(cmd: List[str]) -> None:
+    try:
+        subprocess.run(cmd, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"ffmpeg 執行失敗: {e.stderr[-2000:]}")
+
+
+def merge_playlist(variant_dir: Path) -> Optional[List[Tuple[float, str]]]:
+    """合併分段轉檔的播放列表 回傳所有片段 沒有產生播放列表時回傳 None"""
+    playlist = variant_dir / "playlist.m3u8"
+    shard_playlists = sorted(variant_dir.glob("shard*.m3u8"))
+    if shard_playlists:
+        write_playlist(playlist, [read_playlist(shard) for shard in shard_playlists])
+        for shard in shard_playlists:
+            shard.unlink()
+    if not playlist.exists():
+        logger.error(f"無法產生 {variant_dir.name} 的播放列表")
+        return None
+    return read_playlist(playlist)
+
+
+def audio_media(output_dir: Path) -> Optional[Tuple[str, int, int]]:
+    """共用音訊的 EXT-X-MEDIA 項目與 (最高, 平均) 位元率"""
+    audio_dir = output_dir / AUDIO_GROUP
+    segments = merge_playlist(audio_dir)
+    if segments is None:
+        return None
+    peak, average = measure_bandwidth(audio_dir, segments)
+    media = (
+        f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="{AUDIO_GROUP}",NAME="{AUDIO_GROUP}",'
+        f'DEFAULT=YES,AUTOSELECT=YES,URI="{AUDIO_GROUP}/playlist.m3u8"\n'
+    )
+    return media, peak, average
+
+
+def variant_stream(
+    output_dir: Path,
+    width: int,
+    height: int,
+    audio: Optional[Tuple[int, int]] = None,
+) -> Optional[str]:
+    """
+    合併分段轉檔的播放列表 回傳 master 中這個畫質的項目
+    依實際的片段大小計算位元率 audio 為共用音訊的 (最高, 平均) 位元率
+    沒有產生播放列表時回傳 None
+    """
+    variant_name = f"{height}p"
+    variant_dir = output_dir / variant_name
+    segments = merge_playlist(variant_dir)
+    if segments is None:
+        return None
+
+    peak, average = measure_bandwidth(variant_dir, segments)
+    attributes = ""
+    if audio is not None:
+        peak += audio[0]
+        average += audio[1]
+        attributes = f',AUDIO="{AUDIO_GROUP}"'
+    return (
+        f"#EXT-X-STREAM-INF:BANDWIDTH={peak},AVERAGE-BANDWIDTH={average},"
+        f"RESOLUTION={width}x{height}{attributes}\n"
+        f"{variant_name}/playlist.m3u8\n"
+    )
+
+
+def create_hls(
+    videopath: Path, output_dir: Path, shards: int = 1, codec: Optional[str] = None
+) -> Path:
+    """
+    將影片轉換為 HLS 格式 回傳 master.m3u8
+    H.264 的影片原始解析度只重新封裝 (音訊不是 AAC 時只轉換音訊) 較低的解析度才重新編碼
+    重新封裝的畫質沿用原始的關鍵影格 (fMP4) 片段切點與重新編碼的畫質 (TS) 不同
+    不放進 master.m3u8 的 ABR 清單 另外寫成 source.m3u8 (沒有較低的畫質時才放進 master)
+    shards > 1 時依時間切成多段 由多個 ffmpeg 程序同時轉換 (長片使用)
+    codec 為資料庫中的 VideoFile.codec
+    """
+    video = av.open(str(videopath))
+    width, height, duration = get_video_info(video)
+    has_audio = bool(video.streams.audio)
+    copy_video, copy_audio = copyable_streams(video, codec)
+    video.close()
+    resolutions = create_resolutions(width, height)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for _, res_height in resolutions:
+        (output_dir / f"{res_height}p").mkdir(exist_ok=True)
+
+    commands = []
+    encoded = resolutions
+    if copy_video:
+        encoded = resolutions[1:]
+    if encoded and has_audio:
+        (output_dir / AUDIO_GROUP).mkdir(exist_ok=True)
+        commands.append(
+            build_remux_command(
+                videopath, output_dir / f"{height}p", has_audio, copy_audio
+            )
+        )
+    if encoded:
+        time_ranges = split_shards(duration, shards)
+        if len(time_ranges) == 1:
+            commands.append(build_command(videopath, output_dir, encoded, has_audio))
+        else:
+            commands += [
+                build_command(
+                    videopath, output_dir, encoded, has_audio, shard, time_range
+                )
+                for shard, time_range in enumerate(time_ranges)
+            ]
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        list(executor.map(run_ffmpeg, commands))
+    logger.info(
+        f"處理 {videopath} 的 {len(resolutions)} 種解析度完成"
+        f" (重新封裝: {copy_video}, 複製音訊: {copy_audio})"
+    )
+
+    master_playlist = "#EXTM3U\n"
+    audio = None
+    if encoded and has_audio:
+        media = audio_media(output_dir)
+        if media is not None:
+            master_playlist += media[0]
+            audio = media[1:]
+    for res_width, res_height in encoded:
+        master_playlist += (
+            variant_stream(output_dir, res_width, res_height, audio) or ""
+        )
+    if copy_video:
+        source_stream = variant_stream(output_dir, width, height) or ""
+        with open(output_dir / "source.m3u8", "w") as f:
+            f.write("#EXTM3U\n" + source_stream)
+        if not encoded:
+            master_playlist += source_stream
 
     with open(output_dir / "master.m3u8", "w") as f:
         f.write(master_playlist)
 
-    video.close()
     return output_dir / "master.m3u8"
 
 
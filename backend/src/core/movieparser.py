@@ -1,4 +1,6 @@
 import requests
+from core.httpclient import http
+from core.providercache import provider_cache
 from typing import Optional
 from pydantic import BaseModel
 
@@ -36,68 +38,77 @@ class TMDBApi:
             "Authorization": f"Bearer {api_key}",
         }
 
+    @provider_cache.cached("tmdb", skip_args=1)
+    def lookup_movie(self, query: str, language: str) -> Optional[dict]:
+        """查詢電影資料 查詢失敗時拋出例外 不快取 找不到時回傳 None"""
+        r = http.get(
+            f"{self.BASE_URL}/search/movie",
+            headers=self.headers,
+            params={"query": query, "language": language},
+        )
+        r.raise_for_status()
+        data = r.json()
+        if len(data["results"]) == 0:
+            return None
+
+        movie_id = data["results"][0]["id"]
+        return self._movie_details(movie_id, language).model_dump()
+
     def search_movie(self, query: str, language: str = "zh-TW") -> Optional[MovieInfo]:
         try:
-            r = requests.get(
-                f"{self.BASE_URL}/search/movie",
-                headers=self.headers,
-                params={"query": query, "language": language},
-            )
-            r.raise_for_status()
-            data = r.json()
-            if len(data["results"]) == 0:
-                return None
-
-            movie_id = data["results"][0]["id"]
-            return self.get_movie_details(movie_id, language)
+            data = self.lookup_movie(query, language)
+            return MovieInfo.model_validate(data) if data else None
 
         except requests.RequestException as e:
             print(f"搜尋錯誤: {str(e)}")
             return None
 
+    def _movie_details(self, movie_id: int, language: str) -> MovieInfo:
+        r = http.get(
+            f"{self.BASE_URL}/movie/{movie_id}",
+            headers=self.headers,
+            params={"language": language},
+        )
+        r.raise_for_status()
+        data = r.json()
+        credits_response = http.get(
+            f"{self.BASE_URL}/movie/{movie_id}/credits", headers=self.headers
+        )
+        credits_response.raise_for_status()
+        credits_data = credits_response.json()
+
+        cast = []
+        for actor in credits_data.get("cast", [])[:5]:
+            profile_path = actor.get("profile_path")
+            cast.append(
+                CastInfo(
+                    name=actor["name"],
+                    character=actor["character"],
+                    profile_path=profile_path,
+                    profile_url=f"https://image.tmdb.org/t/p/w185{profile_path}"
+                    if profile_path
+                    else None,
+                )
+            )
+        return MovieInfo(
+            title=data["title"],
+            original_title=data["original_title"],
+            release_date=data["release_date"],
+            overview=data["overview"],
+            poster_path=data.get("poster_path"),
+            backdrop_path=data.get("backdrop_path"),
+            vote_average=data["vote_average"],
+            genres=[genre["name"] for genre in data["genres"]],
+            backdrop_url=f"{self.BG_URL}{data['backdrop_path']}",
+            poster_url=f"{self.POSTER_URL}{data['poster_path']}",
+            cast=cast,
+        )
+
     def get_movie_details(
         self, movie_id: int, language: str = "zh-TW"
     ) -> Optional[MovieInfo]:
         try:
-            r = requests.get(
-                f"{self.BASE_URL}/movie/{movie_id}",
-                headers=self.headers,
-                params={"language": language},
-            )
-            r.raise_for_status()
-            data = r.json()
-            credits_response = requests.get(
-                f"{self.BASE_URL}/movie/{movie_id}/credits", headers=self.headers
-            )
-            credits_response.raise_for_status()
-            credits_data = credits_response.json()
-
-            cast = []
-            for actor in credits_data.get("cast", [])[:5]:
-                profile_path = actor.get("profile_path")
-                cast.append(
-                    CastInfo(
-                        name=actor["name"],
-                        character=actor["character"],
-                        profile_path=profile_path,
-                        profile_url=f"https://image.tmdb.org/t/p/w185{profile_path}"
-                        if profile_path
-                        else None,
-                    )
-                )
-            return MovieInfo(
-                title=data["title"],
-                original_title=data["original_title"],
-                release_date=data["release_date"],
-                overview=data["overview"],
-                poster_path=data.get("poster_path"),
-                backdrop_path=data.get("backdrop_path"),
-                vote_average=data["vote_average"],
-                genres=[genre["name"] for genre in data["genres"]],
-                backdrop_url=f"{self.BG_URL}{data['backdrop_path']}",
-                poster_url=f"{self.POSTER_URL}{data['poster_path']}",
-                cast=cast,
-            )
+            return self._movie_details(movie_id, language)
 
         except requests.RequestException as e:
             print(f"獲取詳細資訊錯誤: {str(e)}")
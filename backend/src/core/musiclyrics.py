@@ -1,8 +1,38 @@
 import requests
+
+from core.httpclient import http
+from core.providercache import provider_cache
 from models import MusicTrack
 from typing import Optional, overload
 
 HEADERS = {"User-Agent": "Lithium-player (https://github.com/cl0udlab/Lithium-player)"}
+LRCLIB_URL = "https://lrclib.net/api/get"
+
+
+def _lrclib_params(arg1, arg2=None, arg3=None) -> dict:
+    if isinstance(arg1, MusicTrack):
+        music = arg1
+        return {
+            "artist_name": music.album_artist,
+            "track_name": music.title,
+            "album_name": music.album,
+        }
+    album, artist, title = arg1, arg2, arg3
+    return {"artist_name": artist, "track_name": title, "album_name": album}
+
+
+def _synced_lyrics(response: requests.Response) -> Optional[str]:
+    """
+    找不到 (404) 或沒有同步歌詞時回傳 None (會被快取)
+    其他錯誤 (5xx / 429) 拋出例外 不會被當成找不到快取起來
+    """
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    lyrics = response.json()
+    if lyrics.get("statusCode") == 404:
+        return None
+    return lyrics.get("syncedLyrics") or None
 
 
 @overload
@@ -14,22 +44,17 @@ def get_lrclib(album: str, artist: str, title: str) -> Optional[str]: ...
 
 
 def get_lrclib(arg1, arg2=None, arg3=None) -> Optional[str]:
-    if isinstance(arg1, MusicTrack):
-        music = arg1
-        response = requests.get(
-            f"https://lrclib.net/api/get?artist_name={music.album_artist}&track_name={music.title}&album_name={music.album}",
-            headers=HEADERS,
-        )
-    else:
-        album, artist, title = arg1, arg2, arg3
-        response = requests.get(
-            f"https://lrclib.net/api/get?artist_name={artist}&track_name={title}&album_name={album}",
-            headers=HEADERS,
-        )
-
-    lyrics = response.json()
-    if "statusCode" in lyrics and lyrics["statusCode"] == 404:
-        return None
-    if "syncedLyrics" not in lyrics:
-        return None
-    return lyrics["syncedLyrics"]
+    params = _lrclib_params(arg1, arg2, arg3)
+    return _get_lrclib(
+        params["album_name"], params["artist_name"], params["track_name"]
+    )
+
+
+@provider_cache.cached("lrclib", name="get")
+def _get_lrclib(album: str, artist: str, title: str) -> Optional[str]:
+    response = http.get(
+        LRCLIB_URL,
+        params={"artist_name": artist, "track_name": title, "album_name": album},
+        headers=HEADERS,
+    )
+    return _synced_lyrics(response)
@@ -1,6 +1,8 @@
 from pydantic import BaseModel
 import requests
+from core.httpclient import http
 from core.logger import logger
+from core.providercache import NoCache, provider_cache
 from typing import Optional, Any
 
 
@@ -53,43 +55,59 @@ class AlbumInfo(BaseModel):
     tracks: list[AlbumTrack] = []
 
 
-def search_track(title: str, artist: str) -> Optional[dict[str, Any]]:
-    if not title or not artist:
+@provider_cache.cached("musicbrainz")
+def lookup_track(title: str, artist: str) -> Optional[dict[str, Any]]:
+    """
+    查詢 MusicBrainz 錄音資料 找不到時回傳 None
+    查詢失敗時拋出例外 不快取 只有封面查詢失敗時回傳沒有封面的結果 但不快取
+    """
+    params = {"query": f"recording:{title} AND artist:{artist}", "fmt": "json"}
+    response = http.get(f"{BASE_URL}/recording", headers=HEADERS, params=params)
+    response.raise_for_status()
+    data = response.json()
+
+    if not data.get("recordings"):
+        logger.info(f"找不到歌曲: {title}")
         return None
-    try:
-        params = {"query": f"recording:{title} AND artist:{artist}", "fmt": "json"}
-        response = requests.get(f"{BASE_URL}/recording", headers=HEADERS, params=params)
-        response.raise_for_status()
-        data = response.json()
-
-        if not data.get("recordings"):
-            logger.info(f"找不到歌曲: {title}")
-            return None
-
-        recording_id = data["recordings"][0]["id"]
-        detail_params = {
-            "fmt": "json",
-            "inc": "artists+artist-credits+artist-rels+work-rels+recording-rels+releases",
-        }
-        detail_response = requests.get(
-            f"{BASE_URL}/recording/{recording_id}",
-            headers=HEADERS,
-            params=detail_params,
-        )
-        detail_response.raise_for_status()
-        recording = detail_response.json()
-        if "releases" in recording and recording["releases"]:
-            release_id = recording["releases"][0]["id"]
-            cover_art_response = requests.get(
+
+    recording_id = data["recordings"][0]["id"]
+    detail_params = {
+        "fmt": "json",
+        "inc": "artists+artist-credits+artist-rels+work-rels+recording-rels+releases",
+    }
+    detail_response = http.get(
+        f"{BASE_URL}/recording/{recording_id}",
+        headers=HEADERS,
+        params=detail_params,
+    )
+    detail_response.raise_for_status()
+    recording = detail_response.json()
+    if "releases" in recording and recording["releases"]:
+        release_id = recording["releases"][0]["id"]
+        try:
+            cover_art_response = http.get(
                 f"https://coverartarchive.org/release/{release_id}", headers=HEADERS
             )
-            if cover_art_response.status_code == 200:
-                cover_art_data = cover_art_response.json()
-                if cover_art_data.get("images"):
-                    recording["cover_art"] = cover_art_data["images"][0]["image"]
+        except requests.exceptions.RequestException as e:
+            logger.error(f"封面查詢失敗: {str(e)}")
+            return NoCache(recording)
+        if cover_art_response.status_code == 200:
+            cover_art_data = cover_art_response.json()
+            if cover_art_data.get("images"):
+                recording["cover_art"] = cover_art_data["images"][0]["image"]
+        elif cover_art_response.status_code != 404:
+            # 404 代表這個發行沒有封面 其他錯誤下次再查
+            logger.error(f"封面查詢失敗: HTTP {cover_art_response.status_code}")
+            return NoCache(recording)
+
+    return recording
 
-        return recording
 
+def search_track(title: str, artist: str) -> Optional[dict[str, Any]]:
+    if not title or not artist:
+        return None
+    try:
+        return lookup_track(title, artist)
     except requests.exceptions.RequestException as e:
         logger.error(f"API請求錯誤: {str(e)}")
         return None
@@ -155,27 +173,32 @@ def parse_track_info(data: dict) -> Optional[TrackInfo]:
         return None
 
 
+@provider_cache.cached("musicbrainz")
+def _search_album(album: str, artist: str) -> Optional[dict[str, Any]]:
+    """查詢失敗時拋出例外 不快取"""
+    params = {"query": f"release:{album} AND artist:{artist}", "fmt": "json"}
+    response = http.get(f"{BASE_URL}/release", headers=HEADERS, params=params)
+    response.raise_for_status()
+    data = response.json()
+
+    if data["releases"] and len(data["releases"]) > 0:
+        release_id = data["releases"][0]["id"]
+        response = http.get(
+            f"{BASE_URL}/release/{release_id}",
+            headers=HEADERS,
+            params={"fmt": "json", "inc": "recordings+artists"},
+        )
+        response.raise_for_status()
+        return response.json()
+    logger.info(f"找不到專輯: {album}")
+    return None
+
+
 def search_album(album: str, artist: str) -> Optional[dict[str, Any]]:
     if not album or not artist:
         return None
     try:
-        params = {"query": f"release:{album} AND artist:{artist}", "fmt": "json"}
-        response = requests.get(f"{BASE_URL}/release", headers=HEADERS, params=params)
-        response.raise_for_status()
-        data = response.json()
-
-        if data["releases"] and len(data["releases"]) > 0:
-            release_id = data["releases"][0]["id"]
-            response = requests.get(
-                f"{BASE_URL}/release/{release_id}",
-                headers=HEADERS,
-                params={"fmt": "json", "inc": "recordings+artists"},
-            )
-            response.raise_for_status()
-            return response.json()
-        logger.info(f"找不到專輯: {album}")
-        return None
-
+        return _search_album(album, artist)
     except requests.exceptions.RequestException as e:
         logger.error(f"API請求錯誤: {str(e)}")
         return None
@@ -0,0 +1,188 @@
+import inspect
+import json
+import sqlite3
+import time
+import unicodedata
+from concurrent.futures import Future
+from functools import wraps
+from pathlib import Path
+from threading import Lock, local
+from typing import Any, Callable, Optional
+
+from core.httpclient import provider_stats
+from core.logger import logger
+
+CACHE_PATH = Path("data") / "provider_cache.sqlite"
+# 找到資料的結果保留 30 天, 找不到的結果保留 1 天
+DEFAULT_TTL = 30 * 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+
+_MISS = object()
+
+
+class NoCache:
+    """
+    包住回傳值 這次的結果照常回傳但不寫入快取 (例如次要的查詢失敗 結果不完整)
+    使用:
+    return NoCache(partial_result)
+    """
+
+    def __init__(self, value: Any):
+        self.value = value
+
+
+def normalize_query(*parts: Any) -> str:
+    """相同查詢不論全半形 / 大小寫 / 多餘空白都對應到同一個 key"""
+    normalized = []
+    for part in parts:
+        text = unicodedata.normalize("NFKC", "" if part is None else str(part))
+        normalized.append(" ".join(text.casefold().split()))
+    return "\x1f".join(normalized)
+
+
+class ProviderCache:
+    """
+    線上資料提供者的回應快取 存在 SQLite 與主資料庫分開 重建資料庫也不會消失
+    使用:
+    @provider_cache.cached("bangumi")
+    def search(title): ...
+    """
+
+    def __init__(self, path: Path = CACHE_PATH):
+        self.path = path
+        self.local = local()
+        # 正在查詢中的 key 相同的查詢等待同一個結果
+        self.inflight_lock = Lock()
+        self.inflight: dict[tuple[str, str], Future] = {}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS response ("
+                " provider TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " PRIMARY KEY (provider, key))"
+            )
+            self.local.conn = conn
+        return conn
+
+    def get(self, provider: str, key: str) -> Any:
+        """回傳快取的值 沒有或過期時回傳 _MISS"""
+        try:
+            row = (
+                self._conn()
+                .execute(
+                    "SELECT value FROM response"
+                    " WHERE provider = ? AND key = ? AND expires_at > ?",
+                    (provider, key, time.time()),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Provider cache read failed: {str(e)}")
+            return _MISS
+        return _MISS if row is None else json.loads(row[0])
+
+    def set(self, provider: str, key: str, value: Any, ttl: int) -> None:
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?)",
+                    (provider, key, json.dumps(value), time.time() + ttl),
+                )
+        except (sqlite3.Error, TypeError) as e:
+            logger.error(f"Provider cache write failed: {str(e)}")
+
+    def prune(self) -> int:
+        """刪除過期的項目"""
+        with self._conn() as conn:
+            return conn.execute(
+                "DELETE FROM response WHERE expires_at <= ?", (time.time(),)
+            ).rowcount
+
+    def clear(self, provider: Optional[str] = None) -> int:
+        with self._conn() as conn:
+            if provider is None:
+                return conn.execute("DELETE FROM response").rowcount
+            return conn.execute(
+                "DELETE FROM response WHERE provider = ?", (provider,)
+            ).rowcount
+
+    def cached(
+        self,
+        provider: str,
+        ttl: int = DEFAULT_TTL,
+        negative_ttl: int = NEGATIVE_TTL,
+        skip_args: int = 0,
+        name: Optional[str] = None,
+    ) -> Callable:
+        """
+        快取函式結果 key 為 name (預設為函式名稱) 加上正規化後的參數
+        (略過前 skip_args 個, 例如 self)
+        回傳 None 視為找不到 以 negative_ttl 快取
+        函式拋出例外 (網路錯誤等) 或回傳 NoCache 時不快取
+        同時有相同的查詢時只送出一次 其他的等待結果
+        結果必須能轉成 JSON 只支援同步函式
+        """
+
+        def decorator(func: Callable) -> Callable:
+            def make_key(args: tuple, kwargs: dict) -> str:
+                return normalize_query(
+                    name or func.__name__,
+                    *args[skip_args:],
+                    *(f"{k}={v}" for k, v in sorted(kwargs.items())),
+                )
+
+            def lookup(key: str) -> Any:
+                value = self.get(provider, key)
+                provider_stats.record_cache(provider, value is not _MISS)
+                return value
+
+            def store(key: str, value: Any) -> Any:
+                """寫入快取 回傳要給呼叫端的值"""
+                if isinstance(value, NoCache):
+                    return value.value
+                self.set(provider, key, value, negative_ttl if value is None else ttl)
+                return value
+
+            if inspect.iscoroutinefunction(func):
+                # 查詢 sqlite 會阻塞 event loop 也沒有 single-flight
+                # async 的路由以 run_in_threadpool 呼叫同步的版本
+                raise TypeError(f"{func.__name__}: 只支援同步函式")
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                key = make_key(args, kwargs)
+                value = lookup(key)
+                if value is not _MISS:
+                    return value
+                with self.inflight_lock:
+                    future = self.inflight.get((provider, key))
+                    owner = future is None
+                    if owner:
+                        future = self.inflight[(provider, key)] = Future()
+                if not owner:
+                    return future.result()
+                try:
+                    value = store(key, func(*args, **kwargs))
+                    future.set_result(value)
+                    return value
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                finally:
+                    with self.inflight_lock:
+                        del self.inflight[(provider, key)]
+
+            return wrapper
+
+        return decorator
+
+
+provider_cache = ProviderCache()
@@ -0,0 +1,157 @@
+import os
+from fractions import Fraction
+from typing import Iterator, Optional
+
+import av
+
+from core.keyframes import keyframe_index
+from core.makehls import copyable_streams
+
+# 累積到這個大小才送出 避免每個封包都送一次
+CHUNK_SIZE = 256 * 1024
+AUDIO_SAMPLE_RATE = 48000
+AUDIO_BITRATE = 128_000
+# 片段化的 MP4 不需要在結尾回頭寫 moov 可以邊轉邊送
+FMP4_OPTIONS = {"movflags": "frag_keyframe+empty_moov+default_base_moof"}
+
+
+class _ChunkWriter:
+    """給 muxer 寫入的檔案物件 沒有 seek 輸出只能依序寫入"""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        return data
+
+
+class Fmp4Remux:
+    """
+    即時把 MKV / AVI / FLV 重新封裝成 fragmented MP4 影片封包直接複製
+    音訊不是 AAC 時只轉換音訊 從 start 之前最近的關鍵影格開始
+    使用:
+    remux = Fmp4Remux(path, start=120)  # 會阻塞 需要在執行緒中建立
+    remux.start  # 實際的起點 (關鍵影格)
+    return StreamingResponse(iter(remux), media_type="video/mp4")
+    """
+
+    def __init__(
+        self,
+        source: str,
+        start: float = 0,
+        codec: Optional[str] = None,
+        stat: Optional[os.stat_result] = None,
+    ):
+        self.container = av.open(source)
+        try:
+            if not self.container.streams.video:
+                raise ValueError("沒有影片串流")
+            copy_video, self.copy_audio = copyable_streams(self.container, codec)
+            if not copy_video:
+                raise ValueError("影片編碼瀏覽器無法直接播放")
+            self.video_in = self.container.streams.video[0]
+            self.audio_in = (
+                self.container.streams.audio[0]
+                if self.container.streams.audio
+                else None
+            )
+            if start > 0:
+                # 以關鍵影格索引對齊 直接跳到關鍵影格 不需要 demuxer 往回找
+                stat = stat or os.stat(source)
+                keyframe = keyframe_index(source, stat.st_size, stat.st_mtime_ns).floor(
+                    start
+                )
+                self.container.seek(
+                    keyframe[0] if keyframe else int(start / self.video_in.time_base),
+                    stream=self.video_in,
+                    backward=True,
+                )
+            self.packets = self.container.demux(
+                *[s for s in (self.video_in, self.audio_in) if s is not None]
+            )
+            # 讀到第一個關鍵影格 它的時間就是實際的起點
+            self.first_packet = None
+            for packet in self.packets:
+                if packet.stream is self.video_in and packet.is_keyframe:
+                    if packet.pts is not None:
+                        self.first_packet = packet
+                        break
+            if self.first_packet is None:
+                raise ValueError("找不到關鍵影格")
+            self.start = float(self.first_packet.pts * self.video_in.time_base)
+        except Exception:
+            self.container.close()
+            raise
+
+    def close(self) -> None:
+        self.container.close()
+
+    def _offset(self, stream: av.stream.Stream) -> int:
+        return int(Fraction(self.start) / stream.time_base)
+
+    def __iter__(self) -> Iterator[bytes]:
+        writer = _ChunkWriter()
+        try:
+            with av.open(
+                writer, "w", format="mp4", container_options=FMP4_OPTIONS
+            ) as out:
+                video_out = out.add_stream(template=self.video_in)
+                audio_out = resampler = None
+                if self.audio_in is not None and self.copy_audio:
+                    audio_out = out.add_stream(template=self.audio_in)
+                elif self.audio_in is not None:
+                    audio_out = out.add_stream("aac", rate=AUDIO_SAMPLE_RATE)
+                    audio_out.layout = "stereo"
+                    audio_out.bit_rate = AUDIO_BITRATE
+                    resampler = av.AudioResampler(
+                        format="fltp", layout="stereo", rate=AUDIO_SAMPLE_RATE
+                    )
+                video_offset = self._offset(self.video_in)
+                audio_offset = (
+                    self._offset(self.audio_in) if self.audio_in is not None else 0
+                )
+                audio_pts = 0
+
+                def packets():
+                    yield self.first_packet
+                    yield from self.packets
+
+                # 輸出的時間從 0 開始 (對應原始影片的 self.start)
+                for packet in packets():
+                    if packet.dts is None or packet.pts is None:
+                        continue
+                    if packet.stream is self.video_in:
+                        packet.pts -= video_offset
+                        packet.dts -= video_offset
+                        packet.stream = video_out
+                        out.mux(packet)
+                    elif packet.pts - audio_offset < 0:
+                        continue
+                    elif resampler is None:
+                        packet.pts -= audio_offset
+                        packet.dts -= audio_offset
+                        packet.stream = audio_out
+                        out.mux(packet)
+                    else:
+                        for frame in packet.decode():
+                            for resampled in resampler.resample(frame):
+                                resampled.pts = audio_pts
+                                resampled.time_base = Fraction(1, AUDIO_SAMPLE_RATE)
+                                audio_pts += resampled.samples
+                                out.mux(audio_out.encode(resampled))
+                    if writer.size >= CHUNK_SIZE:
+                        yield writer.take()
+                if resampler is not None:
+                    out.mux(audio_out.encode(None))
+            yield writer.take()
+        finally:
+            self.close()
@@ -0,0 +1,166 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+
+from sqlmodel import Session, select
+
+from db import engine
+from core.logger import logger
+from core.scanner import (
+    ScanControl,
+    active_scans,
+    open_scan_job,
+    release_root,
+    reserve_root,
+    scan_reserved_root,
+)
+from models import ScanJob, ScanJobStatus
+
+# 解析本身已經用 process pool 平行處理 同時掃描的目錄不需要太多
+SCAN_WORKERS = 2
+
+scan_lock = Lock()
+scan_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _submit(control: ScanControl) -> None:
+    """排入背景執行 超過 SCAN_WORKERS 的工作會排隊"""
+    global scan_executor
+    with scan_lock:
+        if scan_executor is None:
+            scan_executor = ThreadPoolExecutor(
+                max_workers=SCAN_WORKERS, thread_name_prefix="scan"
+            )
+        scan_executor.submit(_run_scan, control.root, control)
+
+
+def start_scan(dir_path: Path) -> int:
+    """在背景掃描目錄 立即回傳工作 ID"""
+    root = reserve_root(dir_path)
+    try:
+        with Session(engine) as db:
+            job = open_scan_job(root, db)
+    except Exception:
+        release_root(root)
+        raise
+    control = ScanControl(job.id)
+    control.root = root
+    active_scans[job.id] = control
+    _submit(control)
+    return job.id
+
+
+def _run_scan(root: str, control: ScanControl) -> None:
+    try:
+        scan_reserved_root(root, control)
+    except Exception as e:
+        logger.error(f"Scan job {control.job_id} failed: {str(e)}")
+        raise
+    finally:
+        release_root(root)
+
+
+def job_status(job_id: int) -> Optional[dict]:
+    """資料庫中的工作狀態 進行中的工作加上即時進度"""
+    with Session(engine) as db:
+        job = db.get(ScanJob, job_id)
+    if job is None:
+        return None
+    status = job.model_dump()
+    control = active_scans.get(job_id)
+    if control:
+        status.update(control.progress())
+        if control.cancelled.is_set():
+            status["status"] = "cancelling"
+        elif not control.started.is_set():
+            status["status"] = "queued"
+        elif not control.running.is_set():
+            status["status"] = ScanJobStatus.PAUSED
+        else:
+            status["status"] = ScanJobStatus.RUNNING
+    status["active"] = control is not None
+    return status
+
+
+def list_jobs(limit: int = 20) -> list[dict]:
+    with Session(engine) as db:
+        job_ids = db.exec(
+            select(ScanJob.id).order_by(ScanJob.id.desc()).limit(limit)
+        ).all()
+    return [job_status(job_id) for job_id in job_ids]
+
+
+def pause_scan(job_id: int) -> bool:
+    control = active_scans.get(job_id)
+    if control is None:
+        return False
+    control.pause()
+    return True
+
+
+def resume_scan(job_id: int) -> bool:
+    """繼續暫停的工作 伺服器重新啟動過的工作會重新排入背景"""
+    control = active_scans.get(job_id)
+    if control is not None:
+        control.resume()
+        return True
+    with Session(engine) as db:
+        job = db.get(ScanJob, job_id)
+        if job is None or job.status == ScanJobStatus.DONE:
+            return False
+        latest = db.exec(
+            select(ScanJob.id)
+            .where(ScanJob.root == job.root)
+            .order_by(ScanJob.id.desc())
+        ).first()
+    if latest != job_id:
+        # 同一個目錄已經有較新的工作
+        return False
+    start_scan(Path(job.root))
+    return True
+
+
+def cancel_scan(job_id: int) -> bool:
+    control = active_scans.get(job_id)
+    if control is not None:
+        control.cancel()
+        return True
+    with Session(engine) as db:
+        job = db.get(ScanJob, job_id)
+        if job is None or job.status == ScanJobStatus.DONE:
+            return False
+        job.status = ScanJobStatus.CANCELLED
+        db.add(job)
+        db.commit()
+    return True
+
+
+def resume_scan_jobs() -> None:
+    """繼續上次關閉時還沒完成的掃描"""
+    with Session(engine) as db:
+        roots = db.exec(
+            select(ScanJob.root).where(ScanJob.status == ScanJobStatus.RUNNING)
+        ).all()
+    for root in set(roots):
+        try:
+            start_scan(Path(root))
+        except Exception as e:
+            logger.error(f"Error resuming scan of {root}: {str(e)}")
+
+
+def stop_scans() -> None:
+    """伺服器關閉時停止掃描 等待寫入檢查點 下次啟動時繼續"""
+    global scan_executor
+    controls = list(active_scans.values())
+    for control in controls:
+        control.cancel(resume_later=True)
+    with scan_lock:
+        executor, scan_executor = scan_executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+    # 排隊中被取消的工作 資料庫中仍是 RUNNING 下次啟動時繼續
+    for control in controls:
+        if not control.started.is_set():
+            active_scans.pop(control.job_id, None)
+            release_root(control.root)
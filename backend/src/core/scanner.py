@@ -0,0 +1,610 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from pathlib import Path
+from queue import Full, Queue
+from threading import Event, Lock, Thread
+from typing import Callable, Iterable, Iterator, Optional
+
+from pydantic import BaseModel
+from sqlalchemy import exists, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, select, union
+
+from db import engine, get_db
+from core.bulkwriter import BulkWriter
+from core.fileparser import FileParser
+from core.fingerprint import file_fingerprint, is_changed
+from core.logger import logger
+from core.setting import load_setting
+from core.syncfile import retire_file
+from models import (
+    FileFingerprint,
+    FileModal,
+    MusicTrackFile,
+    ScanJob,
+    ScanJobStatus,
+    VideoFile,
+)
+
+# 每處理幾個沒有變動的檔案就記錄一次檢查點
+CHECKPOINT_FILES = 1000
+# 走訪與比對之間最多暫存幾個檔案
+WALK_QUEUE_SIZE = 1000
+
+_active_lock = Lock()
+# 正在掃描的目錄 同一個目錄同時只能有一個掃描
+_active_roots: set[str] = set()
+
+
+class ScanReport(BaseModel):
+    scanned: int = 0
+    added: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    failed: int = 0
+    removed: list[str] = []
+
+
+def _parse_worker(file_path: str, with_hash: bool) -> dict:
+    """在子程序中解析檔案"""
+    # 指紋要在解析之前取得 解析途中檔案被修改時下次掃描才會再處理
+    fingerprint = file_fingerprint(file_path, with_hash)
+    metadata = FileParser.parse_file(file_path)
+    metadata["fingerprint"] = fingerprint
+    return metadata
+
+
+class LibraryScanner:
+    """
+    使用 process pool 平行解析檔案, 資料庫寫入只在呼叫端的執行緒進行
+    子程序當掉 (解碼器 segfault / OOM) 時 進行中的檔案記為失敗 重建 pool 後繼續
+    使用:
+    scanner = LibraryScanner()
+    scanner.run(paths, on_parsed, on_error)
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        max_inflight: Optional[int] = None,
+        with_hash: bool = False,
+        worker: Callable[[str, bool], dict] = _parse_worker,
+    ):
+        setting = load_setting()
+        self.with_hash = with_hash
+        # 在子程序中執行 必須是模組層級的函式
+        self.worker = worker
+        self.max_workers = max_workers or setting.scan_workers or os.cpu_count() or 1
+        self.max_inflight = (
+            max_inflight or setting.scan_max_inflight or self.max_workers * 4
+        )
+
+    def run(
+        self,
+        paths: Iterable[Path],
+        on_parsed: Callable[[dict], None],
+        on_error: Optional[Callable[[Path, BaseException], None]] = None,
+    ) -> None:
+        """
+        解析 paths 中的所有檔案
+        同時進行中的檔案數量不會超過 max_inflight
+        on_parsed / on_error 都在目前的執行緒被呼叫
+        """
+        inflight: dict[Future, Path] = {}
+        pool = self._new_pool()
+        try:
+            for file_path in paths:
+                if len(inflight) >= self.max_inflight:
+                    self._drain(inflight, on_parsed, on_error)
+                try:
+                    future = pool.submit(self.worker, str(file_path), self.with_hash)
+                except BrokenProcessPool:
+                    pool = self._restart(pool, inflight, on_parsed, on_error)
+                    future = pool.submit(self.worker, str(file_path), self.with_hash)
+                inflight[future] = file_path
+            while inflight:
+                self._drain(inflight, on_parsed, on_error)
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # spawn 避免 fork 時複製到其他執行緒持有的 lock
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def _restart(
+        self,
+        pool: ProcessPoolExecutor,
+        inflight: dict[Future, Path],
+        on_parsed: Callable[[dict], None],
+        on_error: Optional[Callable[[Path, BaseException], None]],
+    ) -> ProcessPoolExecutor:
+        """pool 已經損壞 進行中的檔案都會以 BrokenProcessPool 結束"""
+        logger.error(
+            f"Scan worker process died, {len(inflight)} files in flight are marked"
+            " as failed, restarting the process pool"
+        )
+        while inflight:
+            self._drain(inflight, on_parsed, on_error)
+        pool.shutdown(cancel_futures=True)
+        return self._new_pool()
+
+    @staticmethod
+    def _drain(
+        inflight: dict[Future, Path],
+        on_parsed: Callable[[dict], None],
+        on_error: Optional[Callable[[Path, BaseException], None]],
+    ) -> None:
+        done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+        for future in done:
+            file_path = inflight.pop(future)
+            error = future.exception()
+            if error is not None:
+                logger.error(f"Error parsing file {file_path} : {str(error)}")
+                if on_error:
+                    on_error(file_path, error)
+                continue
+            on_parsed(future.result())
+
+
+class ScanControl:
+    """
+    掃描工作的即時進度 與 暫停 / 取消
+    使用:
+    control = ScanControl()
+    sync_dir_file(path, control)
+    control.pause() / control.resume() / control.cancel()
+    control.progress()
+    """
+
+    def __init__(self, job_id: Optional[int] = None):
+        self.job_id = job_id
+        self.root: Optional[str] = None
+        self.cancelled = Event()
+        self.resume_later = False
+        self.running = Event()
+        self.running.set()
+        # 排隊中的工作還沒開始
+        self.started = Event()
+        self.report = ScanReport()
+        self.parsed = 0
+        self.written = 0
+        self.walk_done = False
+        self.started_at = time.monotonic()
+
+    def pause(self) -> None:
+        self.running.clear()
+
+    def resume(self) -> None:
+        self.running.set()
+
+    def cancel(self, resume_later: bool = False) -> None:
+        """resume_later: 伺服器關閉時使用 工作保持 RUNNING 下次啟動時繼續"""
+        self.resume_later = resume_later
+        self.cancelled.set()
+        self.running.set()
+
+    def progress(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        queued = self.report.added + self.report.updated
+        throughput = self.parsed / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.walk_done and throughput > 0:
+            eta = round(max(queued - self.parsed, 0) / throughput, 1)
+        return {
+            "job_id": self.job_id,
+            "root": self.root,
+            "paused": not self.running.is_set(),
+            "cancelled": self.cancelled.is_set(),
+            "discovered": self.report.scanned,
+            "unchanged": self.report.unchanged,
+            "queued": queued,
+            "parsed": self.parsed,
+            "written": self.written,
+            "failed": self.report.failed,
+            "removed": len(self.report.removed),
+            "throughput": round(throughput, 2),
+            "eta_seconds": eta,
+            "walk_done": self.walk_done,
+        }
+
+
+# 進行中的掃描 job_id -> ScanControl
+active_scans: dict[int, ScanControl] = {}
+
+
+def reserve_root(dir_path: Path) -> str:
+    """同一個目錄同時只能有一個掃描"""
+    if not dir_path.is_dir():
+        raise ValueError("Invalid directory path")
+    root = str(dir_path.resolve())
+    with _active_lock:
+        if root in _active_roots:
+            raise ValueError("Scan already running")
+        _active_roots.add(root)
+    return root
+
+
+def release_root(root: str) -> None:
+    with _active_lock:
+        _active_roots.discard(root)
+
+
+def open_scan_job(root: str, db: Session) -> ScanJob:
+    """取得同一個目錄上次沒有完成的工作 或建立新的工作"""
+    job = db.exec(
+        select(ScanJob).where(ScanJob.root == root).order_by(ScanJob.id.desc())
+    ).first()
+    if job is None or job.status == ScanJobStatus.DONE:
+        job = ScanJob(root=root)
+    else:
+        logger.info(f"Resume scan job {job.id} of {root} after {job.last_file}")
+        job.status = ScanJobStatus.RUNNING
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def sync_dir_file(dir_path: Path, control: Optional[ScanControl] = None) -> ScanReport:
+    """
+    增量掃描目錄 進度記錄在 ScanJob
+    同一個目錄上次的掃描沒有完成時 從檢查點繼續
+    """
+    root = reserve_root(dir_path)
+    try:
+        return scan_reserved_root(root, control or ScanControl())
+    finally:
+        release_root(root)
+
+
+def scan_reserved_root(root: str, control: ScanControl) -> ScanReport:
+    """掃描已經用 reserve_root 保留的目錄"""
+    control.started.set()
+    db: Session = next(get_db())
+    job = db.get(ScanJob, control.job_id) if control.job_id else None
+    if job is None:
+        job = open_scan_job(root, db)
+    control.job_id, control.root = job.id, root
+    active_scans[job.id] = control
+    try:
+        return _run_scan_job(job, Path(root), db, control)
+    except Exception as e:
+        db.rollback()
+        job.status = ScanJobStatus.FAILED
+        job.error = str(e)
+        job.updated_at = datetime.now()
+        db.add(job)
+        db.commit()
+        raise
+    finally:
+        active_scans.pop(job.id, None)
+
+
+def walk_media_files(
+    root: str,
+    out: Queue,
+    stop: Event,
+    after: Optional[str] = None,
+) -> None:
+    """
+    依完整路徑的字元順序 (與資料庫 COLLATE "C" 相同) 走訪目錄
+    放入 out: ("file", path, stat) / ("error", dirpath) / None 代表結束
+    after: 略過路徑小於等於 after 的檔案 (從檢查點繼續)
+    """
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def entries(dirpath: str) -> list[os.DirEntry]:
+        try:
+            with os.scandir(dirpath) as it:
+                items = list(it)
+        except OSError as e:
+            put(("error", dirpath))
+            logger.error(f"Error reading directory {dirpath} : {str(e)}")
+            return []
+        # 目錄底下的路徑都是 "name/..." 用 name + "/" 排序才會與完整路徑的順序一致
+        return sorted(
+            items,
+            key=lambda e: e.name + "/" if e.is_dir(follow_symlinks=False) else e.name,
+        )
+
+    try:
+        stack = [iter(entries(root))]
+        while stack:
+            if stop.is_set():
+                return
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
+            path = entry.path
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subtree = path + "/"
+                    # 整個子目錄都在檢查點之前
+                    if after and after > subtree and not after.startswith(subtree):
+                        continue
+                    stack.append(iter(entries(path)))
+                    continue
+                if not entry.is_file() or (after and path <= after):
+                    continue
+                FileParser.get_file_type(path)
+                stat = entry.stat()
+            except ValueError:
+                continue
+            except OSError as e:
+                logger.error(f"Error reading file {path} : {str(e)}")
+                stat = None
+            if not put(("file", path, stat)):
+                return
+    except Exception as e:
+        logger.error(f"Error walking {root} : {str(e)}")
+        put(("error", root))
+    finally:
+        # 讓合併端結束等待
+        put(None)
+
+
+def adopt_legacy_files(prefix: str, db: Session, with_hash: bool = False) -> int:
+    """在指紋表建立之前就索引過的檔案 補上指紋 不重新解析"""
+    indexed = union(
+        select(VideoFile.filepath).where(
+            VideoFile.filepath.startswith(prefix, autoescape=True)
+        ),
+        select(MusicTrackFile.filepath).where(
+            MusicTrackFile.filepath.startswith(prefix, autoescape=True)
+        ),
+        select(FileModal.filepath).where(
+            FileModal.filepath.startswith(prefix, autoescape=True)
+        ),
+    ).subquery()
+    query = select(indexed.c.filepath).where(
+        ~exists().where(FileFingerprint.filepath == indexed.c.filepath)
+    )
+    adopted = 0
+    batch: list[dict] = []
+
+    def write() -> None:
+        db.exec(pg_insert(FileFingerprint).on_conflict_do_nothing(), params=batch)
+        db.commit()
+        batch.clear()
+
+    with engine.connect() as conn:
+        for (path,) in conn.execution_options(yield_per=1000).execute(query):
+            try:
+                fingerprint = file_fingerprint(path, with_hash)
+                file_type = FileParser.get_file_type(path).value
+            except (OSError, ValueError):
+                continue
+            batch.append({"filepath": path, "file_type": file_type, **fingerprint})
+            adopted += 1
+            if len(batch) >= 1000:
+                write()
+    if batch:
+        write()
+    if adopted:
+        logger.info(f"Adopted {adopted} files indexed before fingerprints")
+    return adopted
+
+
+def _run_scan_job(
+    job: ScanJob, dir_path: Path, db: Session, control: ScanControl
+) -> ScanReport:
+    """
+    走訪 -> (bounded queue) -> 與資料庫指紋合併比對 -> process pool 解析 -> 批次寫入
+    每個階段都只保留固定數量的項目 記憶體用量與檔案總數無關
+    """
+    with_hash = load_setting().scan_partial_hash
+    root = str(dir_path)
+    prefix = os.path.join(root, "")
+    adopt_legacy_files(prefix, db, with_hash)
+
+    report = ScanReport(
+        **job.model_dump(include={"scanned", "added", "updated", "unchanged", "failed"})
+    )
+    control.report = report
+    removed_before = job.removed
+    after = job.last_file
+    walk_errors: list[str] = []
+    skip_removal = False
+    # 解析 / 寫入中的檔案 (依走訪順序) 與它之前已處理完的最後一個路徑
+    inflight: deque[list] = deque()
+    done_paths: set[str] = set()
+    last_handled = after
+    handled_since_checkpoint = 0
+
+    def retire(path: str) -> None:
+        try:
+            retire_file(path, db)
+            report.removed.append(path)
+        except Exception as e:
+            logger.error(str(e))
+
+    def watermark() -> Optional[str]:
+        """這個路徑 (含) 之前的檔案都已經寫入資料庫"""
+        while inflight and inflight[0][0] in done_paths:
+            done_paths.discard(inflight.popleft()[0])
+        return inflight[0][1] if inflight else last_handled
+
+    def checkpoint() -> None:
+        nonlocal handled_since_checkpoint
+        job.sqlmodel_update(report.model_dump(exclude={"removed"}))
+        job.removed = removed_before + len(report.removed)
+        job.last_file = watermark()
+        job.updated_at = datetime.now()
+        db.add(job)
+        db.commit()
+        handled_since_checkpoint = 0
+
+    def handled(path: str) -> None:
+        nonlocal last_handled, handled_since_checkpoint
+        last_handled = path
+        handled_since_checkpoint += 1
+        if handled_since_checkpoint >= CHECKPOINT_FILES:
+            checkpoint()
+
+    def gone(record) -> None:
+        """資料庫中有 但走訪時沒有出現的檔案"""
+        path = record.filepath
+        if not skip_removal and not any(
+            path.startswith(os.path.join(d, "")) for d in walk_errors
+        ):
+            retire(path)
+        handled(path)
+
+    def stopped() -> bool:
+        """暫停時在這裡等待 回傳是否被取消"""
+        if not control.running.is_set():
+            job.status = ScanJobStatus.PAUSED
+            checkpoint()
+            control.running.wait()
+            job.status = ScanJobStatus.RUNNING
+        return control.cancelled.is_set()
+
+    def pending_files(walked: Queue, records: Iterator):
+        nonlocal skip_removal, last_handled
+        record = next(records, None)
+        first = True
+        while True:
+            item = walked.get()
+            if item is None:
+                break
+            if first and after is None and record is not None:
+                # 第一個項目就是目錄讀取錯誤 多半是儲存空間沒有掛載 不要刪除資料
+                skip_removal = item == ("error", root)
+            first = False
+            if item[0] == "error":
+                walk_errors.append(item[1])
+                continue
+            _, path, stat = item
+            while record is not None and record.filepath < path:
+                gone(record)
+                record = next(records, None)
+            known = None
+            if record is not None and record.filepath == path:
+                known, record = record, next(records, None)
+            report.scanned += 1
+            if stat is None:
+                report.failed += 1
+                handled(path)
+                continue
+            if known is not None and not is_changed(known, path, stat, with_hash):
+                if known.mtime_ns != stat.st_mtime_ns or known.inode != stat.st_ino:
+                    # 內容相同只是被 touch 或搬移過 更新指紋避免下次重新計算雜湊
+                    db.exec(
+                        update(FileFingerprint)
+                        .where(FileFingerprint.filepath == path)
+                        .values(
+                            **file_fingerprint(path, with_hash, stat),
+                            updated_at=datetime.now(),
+                        )
+                    )
+                report.unchanged += 1
+                handled(path)
+            else:
+                if known is None:
+                    report.added += 1
+                else:
+                    report.updated += 1
+                inflight.append([path, last_handled])
+                last_handled = path
+                yield Path(path)
+            if stopped():
+                return
+        if not walk_errors and report.scanned == 0 and after is None:
+            # 整個目錄都是空的 多半是儲存空間沒有掛載 不要刪除資料
+            logger.warning(f"No files found in {dir_path}, skip removing files")
+            skip_removal = True
+        while record is not None:
+            gone(record)
+            record = next(records, None)
+        control.walk_done = True
+
+    def file_done(path: str) -> None:
+        done_paths.add(path)
+
+    def on_flush(batch: list[dict]) -> None:
+        control.written += len(batch)
+        for metadata in batch:
+            file_done(metadata["file_path"])
+        checkpoint()
+
+    def on_parsed(metadata: dict) -> None:
+        control.parsed += 1
+        writer.add(metadata)
+
+    def parse_failed(file_path: Path, error: BaseException) -> None:
+        control.parsed += 1
+        report.failed += 1
+        file_done(str(file_path))
+
+    def write_failed(*args) -> None:
+        report.failed += 1
+
+    query = select(
+        FileFingerprint.filepath,
+        FileFingerprint.size,
+        FileFingerprint.mtime_ns,
+        FileFingerprint.inode,
+        FileFingerprint.device,
+        FileFingerprint.partial_hash,
+    ).where(FileFingerprint.filepath.startswith(prefix, autoescape=True))
+    if after:
+        query = query.where(FileFingerprint.filepath.collate("C") > after)
+    query = query.order_by(FileFingerprint.filepath.collate("C"))
+
+    walked: Queue = Queue(maxsize=WALK_QUEUE_SIZE)
+    stop_walk = Event()
+    walker = Thread(
+        target=walk_media_files,
+        args=(root, walked, stop_walk, after),
+        daemon=True,
+        name="scan-walker",
+    )
+    # 指紋用另一個連線以 server-side cursor 依序讀取 寫入端 commit 不會中斷它
+    with engine.connect() as conn:
+        records = iter(conn.execution_options(yield_per=1000).execute(query))
+        walker.start()
+        try:
+            writer = BulkWriter(db, on_error=write_failed, on_flush=on_flush)
+            LibraryScanner(with_hash=with_hash).run(
+                pending_files(walked, records), on_parsed, parse_failed
+            )
+            writer.flush()
+        finally:
+            stop_walk.set()
+            walker.join()
+
+    if control.cancelled.is_set():
+        # 保留檢查點 下次掃描同一個目錄時繼續
+        job.status = (
+            ScanJobStatus.RUNNING if control.resume_later else ScanJobStatus.CANCELLED
+        )
+        checkpoint()
+        logger.info(f"Scan {dir_path} cancelled")
+        return report
+
+    job.status = ScanJobStatus.DONE
+    job.finished_at = datetime.now()
+    job.error = None
+    checkpoint()
+    logger.info(
+        f"Scan {dir_path} finished: {report.model_dump(exclude={'removed'})}, "
+        f"removed {len(report.removed)}"
+    )
+    return report
@@ -47,6 +47,17 @@ class Setting(BaseModel):
     scan_interval: int = 3600
     log_level: str = "info"
     tmd_api_key: str = ""
+    # 0 代表自動 (依 CPU 數量)
+    scan_workers: int = 0
+    scan_max_inflight: int = 0
+    scan_batch_size: int = 500
+    enrich_workers: int = 4
+    # 檔案大小相同但時間改變時 用頭尾區塊雜湊確認內容是否真的改變
+    scan_partial_hash: bool = False
+    # 縮圖快取的大小上限
+    thumbnail_cache_mb: int = 512
+    # 隨選轉檔的 HLS 片段快取大小上限
+    hls_cache_mb: int = 4096
 
     model_config = {
         "json_encoders": {Path: str, StorageType: str},
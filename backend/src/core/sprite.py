@@ -0,0 +1,146 @@
+import hashlib
+import json
+import math
+import re
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image
+from pydantic import BaseModel
+
+from core.imagestore import image_path
+from core.thumbnail import (
+    SPRITES_DIR,
+    THUMBNAIL_FORMATS,
+    encode_image,
+    snap_size,
+    thumbnail_cache,
+)
+
+# 一張合併圖最多的圖片數
+MAX_SPRITE_IMAGES = 200
+# 合併圖最多的像素數 (RGB 約 48MB) 圖片數 x 尺寸超過時拒絕 例如 200 張最大 256px
+MAX_SPRITE_PIXELS = 4096 * 4096
+SPRITE_KEY = re.compile(r"^[0-9a-f]{32}$")
+
+
+class SpriteTile(BaseModel):
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+class SpriteLayout(BaseModel):
+    key: str
+    size: int
+    width: int
+    height: int
+    # 圖片 ID -> 在合併圖中的位置 不存在的圖片不會出現
+    images: dict[str, SpriteTile] = {}
+
+
+def sprite_key(image_ids: list[str], size: int) -> str:
+    """同一組圖片 (不分順序) 與尺寸得到同一個 key"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(size).encode())
+    for image_id in sorted(set(image_ids)):
+        digest.update(b"\0" + image_id.encode())
+    return digest.hexdigest()
+
+
+def sprite_grid(count: int) -> tuple[int, int]:
+    """count 張圖片排成接近正方形的 (欄數, 列數)"""
+    columns = max(math.ceil(math.sqrt(count)), 1)
+    return columns, max(math.ceil(count / columns), 1)
+
+
+def check_sprite_size(image_ids: list[str], size: Optional[int]) -> int:
+    """回傳對齊後的尺寸 合併圖會超過 MAX_SPRITE_PIXELS 時拋出 ValueError"""
+    size = snap_size(size)
+    columns, rows = sprite_grid(len(set(image_ids)))
+    if columns * rows * size * size > MAX_SPRITE_PIXELS:
+        raise ValueError(
+            f"合併圖太大: {len(set(image_ids))} 張 {size}px 的圖片"
+            f" 超過 {MAX_SPRITE_PIXELS} 像素 請減少圖片數或尺寸"
+        )
+    return size
+
+
+def _layout_path(key: str) -> Path:
+    return SPRITES_DIR / f"{key}.json"
+
+
+def load_layout(key: str) -> Optional[SpriteLayout]:
+    path = _layout_path(key)
+    try:
+        layout = SpriteLayout.model_validate_json(path.read_bytes())
+    except (FileNotFoundError, ValueError):
+        return None
+    thumbnail_cache.touch(path, path.stat().st_mtime)
+    return layout
+
+
+def sprite_layout(image_ids: list[str], size: Optional[int]) -> SpriteLayout:
+    """
+    依圖片 ID 排出合併圖 每張縮圖放在 size x size 格子的左上角
+    位置表以 key 快取 合併圖在第一次以 sprite_sheet 請求時才產生
+    合併圖太大時拋出 ValueError
+    """
+    size = check_sprite_size(image_ids, size)
+    key = sprite_key(image_ids, size)
+    layout = load_layout(key)
+    if layout is not None:
+        return layout
+
+    sources = {}
+    for image_id in sorted(set(image_ids)):
+        source = image_path(image_id)
+        if source is not None and source.exists():
+            sources[image_id] = source
+    columns, rows = sprite_grid(len(sources))
+    layout = SpriteLayout(key=key, size=size, width=columns * size, height=rows * size)
+    for index, (image_id, source) in enumerate(sources.items()):
+        thumbnail = thumbnail_cache.get(image_id, source, size)
+        with Image.open(thumbnail) as image:
+            width, height = image.size
+        row, column = divmod(index, columns)
+        layout.images[image_id] = SpriteTile(
+            x=column * size, y=row * size, width=width, height=height
+        )
+    thumbnail_cache.write(_layout_path(key), json.dumps(layout.model_dump()).encode())
+    return layout
+
+
+def _sheet_path(key: str, fmt: str) -> Path:
+    return SPRITES_DIR / f"{key}.{THUMBNAIL_FORMATS[fmt].extension}"
+
+
+def cached_sprite_sheet(key: str, fmt: str = "jpeg") -> Optional[Path]:
+    path = _sheet_path(key, fmt)
+    try:
+        thumbnail_cache.touch(path, path.stat().st_mtime)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def sprite_sheet(key: str, fmt: str = "jpeg") -> Optional[Path]:
+    """回傳合併圖路徑 沒有時產生 位置表已經不存在時回傳 None (需要重新請求位置表)"""
+    path = cached_sprite_sheet(key, fmt)
+    if path is not None:
+        return path
+    path = _sheet_path(key, fmt)
+    layout = load_layout(key)
+    if layout is None or layout.width * layout.height > MAX_SPRITE_PIXELS:
+        return None
+    sheet = Image.new("RGB", (layout.width, layout.height))
+    for image_id, tile in layout.images.items():
+        source = image_path(image_id)
+        if source is None or not source.exists():
+            continue
+        thumbnail = thumbnail_cache.get(image_id, source, layout.size)
+        with Image.open(thumbnail) as image:
+            sheet.paste(image.convert("RGB"), (tile.x, tile.y))
+    thumbnail_cache.write(path, encode_image(sheet, fmt))
+    return path
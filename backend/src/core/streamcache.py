@@ -0,0 +1,80 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+# 影片拖動時會連續送出很多 range 請求 短時間內不需要重新查詢
+STREAM_CACHE_TTL = 30
+STREAM_CACHE_SIZE = 1024
+
+# (檔案路徑, stat, MIME type)
+StreamTarget = tuple[str, os.stat_result, Optional[str]]
+
+
+class StreamCache:
+    """
+    串流端點 ID -> 檔案的 LRU 快取 命中時不需要查詢資料庫與 stat
+    檔案同步 / 刪除時以路徑失效
+    使用:
+    target = stream_cache.get("music", track_id)
+    stream_cache.put("music", track_id, (path, stat, "audio/flac"))
+    stream_cache.invalidate(path)
+    """
+
+    def __init__(
+        self, max_entries: int = STREAM_CACHE_SIZE, ttl: int = STREAM_CACHE_TTL
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries: OrderedDict[tuple[str, int], tuple[float, StreamTarget]] = (
+            OrderedDict()
+        )
+        self.keys_by_path: dict[str, set[tuple[str, int]]] = {}
+
+    def get(self, kind: str, record_id: int) -> Optional[StreamTarget]:
+        key = (kind, record_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, target = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return target
+
+    def put(self, kind: str, record_id: int, target: StreamTarget) -> None:
+        key = (kind, record_id)
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, target)
+            self.keys_by_path.setdefault(target[0], set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, filepath: str) -> None:
+        with self.lock:
+            for key in self.keys_by_path.pop(str(filepath), set()):
+                self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_path.clear()
+
+    def _remove(self, key: tuple[str, int]) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        path = entry[1][0]
+        keys = self.keys_by_path.get(path)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_path[path]
+
+
+stream_cache = StreamCache()
@@ -1,12 +1,15 @@
+from datetime import datetime
 from pathlib import Path
-import os
+from typing import Optional
 
 from sqlalchemy import func
 from db import get_db
-from core.fileparser import FileParser, FileType
-from sqlmodel import Session, select, union
+from core.fileparser import UNKNOWN_ARTIST, FileParser, FileType
+from core.fingerprint import file_fingerprint, is_changed
+from sqlmodel import Session, delete, select, union
 from models import (
     VideoFile,
+    VideoKeyframeIndex,
     MusicTrackFile,
     Video,
     MusicTrack,
@@ -14,25 +17,137 @@ from models import (
     FileModal,
     AnimeSeries,
     AnimeTag,
+    FileFingerprint,
+    EnrichmentKind,
+    EnrichmentTask,
+    PlaylistTrack,
+    PlayHistory,
+    UserLikes,
+    UserDislikes,
+    VideoTagsLink,
 )
+from core.enrichment import enqueue
+from core.imagestore import pregenerate_thumbnails, save_placeholders
+from core.keyframes import keyframe_indexer
 from core.logger import logger
+from core.setting import load_setting
+from core.streamcache import stream_cache
+
+
+def save_fingerprint(
+    file_path: str, file_type: str, db: Session, fingerprint: Optional[dict] = None
+) -> FileFingerprint:
+    """記錄檔案指紋 (不 commit)"""
+    if fingerprint is None:
+        fingerprint = file_fingerprint(file_path, load_setting().scan_partial_hash)
+    record = db.exec(
+        select(FileFingerprint).where(FileFingerprint.filepath == file_path)
+    ).first()
+    if record:
+        record.updated_at = datetime.now()
+    else:
+        record = FileFingerprint(filepath=file_path, file_type=file_type, **fingerprint)
+    record.sqlmodel_update({"file_type": file_type, **fingerprint})
+    db.add(record)
+    return record
+
+
+def text_file_values(metadata: dict) -> dict:
+    return {
+        "filename": metadata.get("filename"),
+        "filepath": metadata.get("file_path"),
+        "name": metadata.get("filename"),
+        "file_format": metadata.get("format"),
+        "size": metadata.get("file_size"),
+        "pages": metadata.get("pages"),
+        "author": metadata.get("author"),
+        "publisher": metadata.get("publisher"),
+    }
+
+
+def video_file_values(metadata: dict) -> dict:
+    return {
+        "filename": metadata.get("filename"),
+        "filepath": metadata.get("file_path"),
+        "file_size": metadata.get("file_size", 0),
+        "codec": metadata.get("codec", "unknown"),
+        "format": metadata.get("format", "unknown"),
+        "width": metadata.get("width", 0),
+        "height": metadata.get("height", 0),
+        "frame_rate": metadata.get("frame_rate", 0),
+    }
+
+
+def video_values(metadata: dict) -> dict:
+    return {
+        "title": metadata.get("title") or metadata["filename"],
+        "duration": metadata.get("duration", 0),
+        "description": metadata.get("description"),
+        "subtitles": metadata.get("subtitles", []),
+        "audio_tracks": metadata.get("audio_tracks", []),
+        "thumbnail": metadata.get("thumbnail"),
+        "episode_number": metadata.get("episode_number", 0),
+    }
+
+
+def music_track_values(metadata: dict) -> dict:
+    return {
+        "title": metadata.get("title"),
+        "duration": metadata.get("duration"),
+        "artist": metadata.get("artist"),
+        "album_artist": metadata.get("album_artist"),
+        "album": metadata.get("album"),
+        "release_date": metadata.get("date"),
+        "composer": metadata.get("composer"),
+        "genre": metadata.get("genre"),
+        "track_number": metadata.get("track_number"),
+        "disc_number": metadata.get("disc_number"),
+        "cover_art": metadata.get("cover_art"),
+        "vocals": metadata.get("vocals"),
+        "arrangers": metadata.get("arrangers"),
+        "mixers": metadata.get("mixers"),
+        "lyrics": metadata.get("lyrics"),
+    }
+
+
+def album_values(metadata: dict) -> dict:
+    return {
+        "title": metadata["album"],
+        "album_artist": metadata.get("album_artist") or UNKNOWN_ARTIST,
+        "genre": metadata.get("genre"),
+        "release_date": metadata.get("date"),
+        "cover_art": metadata.get("cover_art"),
+    }
+
+
+def music_file_values(metadata: dict) -> dict:
+    return {
+        "filename": metadata.get("filename"),
+        "filepath": metadata.get("file_path"),
+        "codec": metadata.get("codec", "unknown"),
+        "bitrate": metadata.get("bitrate", 0),
+        "sample_rate": metadata.get("sample_rate", 0),
+        "file_size": metadata.get("file_size", 0),
+        "audio_type": metadata.get("audio_type", "unknown"),
+    }
 
 
 def sync_text_file(metadata: dict, db: Session):
     """同步文字檔案到資料庫"""
-    filem = FileModal(
-        filename=metadata.get("filename"),
-        filepath=metadata.get("file_path"),
-        file_size=metadata.get("file_size"),
-        name=metadata.get("filename"),
-        file_format=metadata.get("format"),
-        size=metadata.get("file_size"),
-        pages=metadata.get("pages"),
-        author=metadata.get("author"),
-        publisher=metadata.get("publisher"),
-    )
+    values = text_file_values(metadata)
+    filem = db.exec(
+        select(FileModal).where(FileModal.filepath == metadata.get("file_path"))
+    ).first()
+    if filem:
+        filem.sqlmodel_update(values)
+        filem.updated_at = datetime.now()
+    else:
+        filem = FileModal(**values)
     try:
         db.add(filem)
+        save_fingerprint(
+            metadata["file_path"], FileType.TEXT.value, db, metadata.get("fingerprint")
+        )
         db.commit()
         return filem
     except Exception as e:
@@ -44,17 +159,8 @@ def sync_video_file(metadata: dict, db: Session):
     """同步影片檔案到資料庫"""
     try:
         logger.debug(f"Syncing video file: {metadata}")
-        logger.info(f"Syncing video file: {metadata}")
-        video_file = VideoFile(
-            filename=metadata.get("filename"),
-            filepath=metadata.get("file_path"),
-            file_size=metadata.get("file_size", 0),
-            codec=metadata.get("codec", "unknown"),
-            format=metadata.get("format", "unknown"),
-            width=metadata.get("width", 0),
-            height=metadata.get("height", 0),
-            frame_rate=metadata.get("frame_rate", 0),
-        )
+        logger.info(f"Syncing video file: {metadata.get('file_path')}")
+        file_values = video_file_values(metadata)
 
         anime = None
         if metadata.get("isanime"):
@@ -77,22 +183,36 @@ def sync_video_file(metadata: dict, db: Session):
                     if anime_tag not in anime.tags:
                         anime.tags.append(anime_tag)
 
-        video = Video(
-            title=metadata.get("title") or metadata["filename"]
-            if metadata.get("isanime")
-            else metadata.get("titme") + " - " + metadata.get("season_number", 1),
-            duration=metadata.get("duration", 0),
-            description=metadata.get("description"),
-            subtitles=metadata.get("subtitles", []),
-            audio_tracks=metadata.get("audio_tracks", []),
-            thumbnail=metadata.get("thumbnail"),
-            file=video_file,
-            series=anime,
-            episode_number=metadata.get("episode_number", 0),
-        )
+        values = {**video_values(metadata), "series": anime}
+
+        video_file = db.exec(
+            select(VideoFile).where(VideoFile.filepath == metadata.get("file_path"))
+        ).first()
+        if video_file:
+            # 檔案內容有變動 直接更新原本的資料 保留播放紀錄
+            video_file.sqlmodel_update(file_values)
+            video_file.updated_at = datetime.now()
+            # 舊的關鍵影格索引已經不能用 由 keyframe_indexer 重新建立
+            db.exec(
+                delete(VideoKeyframeIndex).where(
+                    VideoKeyframeIndex.video_file_id == video_file.id
+                )
+            )
+            video = video_file.video
+            for key, value in values.items():
+                setattr(video, key, value)
+            video.updated_at = datetime.now()
+        else:
+            video = Video(**values, file=VideoFile(**file_values))
 
         db.add(video)
+        save_fingerprint(
+            metadata["file_path"], FileType.VIDEO.value, db, metadata.get("fingerprint")
+        )
+        db.flush()
+        enqueue(EnrichmentKind.VIDEO, [video.id], db)
         db.commit()
+        keyframe_indexer.notify()
         return video
 
     except Exception as e:
@@ -119,60 +239,54 @@ def sync_album_data(album_id: int, db: Session):
 
 def sync_music_file(metadata: dict, db: Session):
     """同步音樂檔案到資料庫"""
-    track = MusicTrack(
-        title=metadata.get("title"),
-        duration=metadata.get("duration"),
-        artist=metadata.get("artist"),
-        album_artist=metadata.get("album_artist"),
-        album=metadata.get("album"),
-        release_date=metadata.get("date"),
-        composer=metadata.get("composer"),
-        genre=metadata.get("genre"),
-        track_number=metadata.get("track_number"),
-        disc_number=metadata.get("disc_number"),
-        cover_art=metadata.get("cover_art"),
-        vocals=metadata.get("vocals"),
-        arrangers=metadata.get("arrangers"),
-        mixers=metadata.get("mixers"),
-        lyrics=metadata.get("lyrics"),
-    )
+    track_values = music_track_values(metadata)
+    file_values = music_file_values(metadata)
 
-    track_file = MusicTrackFile(
-        filename=metadata.get("filename"),
-        filepath=metadata.get("file_path"),
-        codec=metadata.get("codec", "unknown"),
-        bitrate=metadata.get("bitrate", 0),
-        sample_rate=metadata.get("sample_rate", 0),
-        file_size=metadata.get("file_size", 0),
-        audio_type=metadata.get("audio_type", "unknown"),
-        track=track,
-    )
+    track_file = db.exec(
+        select(MusicTrackFile).where(
+            MusicTrackFile.filepath == metadata.get("file_path")
+        )
+    ).first()
+    old_album_id = None
+    if track_file:
+        # 檔案內容有變動 直接更新原本的資料 保留播放清單與喜好
+        track = track_file.track
+        old_album_id = track.album_id
+        track.sqlmodel_update(track_values)
+        track.updated_at = datetime.now()
+        track.album_ref = None
+        track_file.sqlmodel_update(file_values)
+        track_file.updated_at = datetime.now()
+    else:
+        track = MusicTrack(**track_values)
+        track_file = MusicTrackFile(**file_values, track=track)
 
     try:
         if metadata.get("album"):
+            values = album_values(metadata)
             album = db.exec(
                 select(Album).where(
-                    Album.title == metadata["album"],
-                    Album.album_artist
-                    == metadata.get("album_artist", "Unknown Artist"),
+                    Album.title == values["title"],
+                    Album.album_artist == values["album_artist"],
                 )
             ).first()
 
             if not album:
-                album = Album(
-                    title=metadata["album"],
-                    album_artist=metadata.get("album_artist", "Unknown Artist"),
-                    genre=metadata.get("genre"),
-                    release_date=metadata.get("date"),
-                    cover_art=metadata.get("cover_art"),
-                )
+                album = Album(**values)
                 db.add(album)
             track.album_ref = album
         db.add(track_file)
+        save_fingerprint(
+            metadata["file_path"], FileType.MUSIC.value, db, metadata.get("fingerprint")
+        )
+        db.flush()
+        enqueue(EnrichmentKind.MUSIC, [track.id], db)
         db.commit()
 
         if track.album_id:
             sync_album_data(track.album_id, db)
+        if old_album_id and old_album_id != track.album_id:
+            sync_album_data(old_album_id, db)
 
         return track_file
 
@@ -181,32 +295,93 @@ def sync_music_file(metadata: dict, db: Session):
         raise Exception(f"Failed to sync music file: {str(e)}")
 
 
-def sync_dir_file(dir_path: Path) -> list:
-    db: Session = next(get_db())
-    if not dir_path.is_dir():
-        raise ValueError("Invalid directory path")
-    query = union(select(VideoFile.filepath), select(MusicTrackFile.filepath))
-    exist_files = db.exec(query).all()
-    files = []
-    for root, _, files in os.walk(dir_path):
-        for file in files:
-            file_path = Path(root) / file
-            if file_path in exist_files:
-                logger.debug(f"File {file_path} already exists")
-                continue
-            try:
-                files.append(FileParser().parse_file(file_path))
-            except Exception as e:
-                logger.error(f"Error parsing file {file_path} : {str(e)}")
-                pass
-    for file in files:
-        if file.get("file_type") == FileType.MUSIC:
-            sync_music_file(metadata=file, db=db)
-        elif file.get("file_type") == FileType.VIDEO:
-            sync_video_file(metadata=file, db=db)
-        elif file.get("file_type") == FileType.TEXT:
-            sync_text_file(metadata=file, db=db)
-    return files
+def sync_metadata(metadata: dict, db: Session):
+    """依照檔案類型同步到資料庫"""
+    result = None
+    if metadata.get("file_type") == FileType.MUSIC:
+        result = sync_music_file(metadata=metadata, db=db)
+    elif metadata.get("file_type") == FileType.VIDEO:
+        result = sync_video_file(metadata=metadata, db=db)
+    elif metadata.get("file_type") == FileType.TEXT:
+        result = sync_text_file(metadata=metadata, db=db)
+    placeholders = metadata.get("placeholders")
+    if placeholders:
+        save_placeholders(placeholders, db)
+        db.commit()
+        pregenerate_thumbnails(placeholders)
+    # 寫入後才讓快取失效 避免同時進行的請求把舊資料放回快取
+    stream_cache.invalidate(metadata.get("file_path"))
+    return result
+
+
+def retire_file(filepath: str, db: Session) -> None:
+    """移除已被刪除的檔案在資料庫中的資料"""
+    album_id = None
+    try:
+        track_file = db.exec(
+            select(MusicTrackFile).where(MusicTrackFile.filepath == filepath)
+        ).first()
+        if track_file:
+            track = track_file.track
+            album_id = track.album_id
+            for model in (PlaylistTrack, PlayHistory, UserLikes, UserDislikes):
+                db.exec(delete(model).where(model.track_id == track.id))
+            db.exec(
+                delete(EnrichmentTask).where(
+                    EnrichmentTask.kind == EnrichmentKind.MUSIC,
+                    EnrichmentTask.record_id == track.id,
+                )
+            )
+            db.delete(track_file)
+            db.delete(track)
+
+        video_file = db.exec(
+            select(VideoFile).where(VideoFile.filepath == filepath)
+        ).first()
+        if video_file:
+            video = video_file.video
+            for model in (PlayHistory, VideoTagsLink):
+                db.exec(delete(model).where(model.video_id == video.id))
+            db.exec(
+                delete(EnrichmentTask).where(
+                    EnrichmentTask.kind == EnrichmentKind.VIDEO,
+                    EnrichmentTask.record_id == video.id,
+                )
+            )
+            db.exec(
+                delete(VideoKeyframeIndex).where(
+                    VideoKeyframeIndex.video_file_id == video_file.id
+                )
+            )
+            db.delete(video_file)
+            db.delete(video)
+
+        db.exec(delete(FileModal).where(FileModal.filepath == filepath))
+        db.exec(delete(FileFingerprint).where(FileFingerprint.filepath == filepath))
+        db.commit()
+        stream_cache.invalidate(filepath)
+    except Exception as e:
+        db.rollback()
+        raise Exception(f"Failed to retire file {filepath}: {str(e)}")
+
+    if album_id:
+        sync_album_data(album_id, db)
+
+
+def indexed_paths(prefix: str, db: Session) -> set[str]:
+    """取得 prefix 底下所有已在資料庫中的檔案路徑"""
+    query = union(
+        select(VideoFile.filepath).where(
+            VideoFile.filepath.startswith(prefix, autoescape=True)
+        ),
+        select(MusicTrackFile.filepath).where(
+            MusicTrackFile.filepath.startswith(prefix, autoescape=True)
+        ),
+        select(FileModal.filepath).where(
+            FileModal.filepath.startswith(prefix, autoescape=True)
+        ),
+    )
+    return {row[0] for row in db.exec(query).all()}
 
 
 def sync_one_file(file_path: Path):
@@ -214,19 +389,25 @@ def sync_one_file(file_path: Path):
     if not file_path.is_file():
         raise ValueError("Invalid file path")
     file_path = file_path.resolve()
-    query = union(select(VideoFile.filepath), select(MusicTrackFile.filepath))
-    exist_files = [Path(f[0]).resolve() for f in db.exec(query).all()]
-    if file_path in exist_files:
+    path = str(file_path)
+    with_hash = load_setting().scan_partial_hash
+    record = db.exec(
+        select(FileFingerprint).where(FileFingerprint.filepath == path)
+    ).first()
+    if record is None and path in indexed_paths(path, db):
+        save_fingerprint(path, FileParser.get_file_type(file_path).value, db)
+        db.commit()
+        raise ValueError("File already exists")
+    if record is not None and not is_changed(
+        record, file_path, file_path.stat(), with_hash
+    ):
         raise ValueError("File already exists")
     try:
+        fingerprint = file_fingerprint(file_path, with_hash)
         file = FileParser().parse_file(file_path)
+        file["fingerprint"] = fingerprint
     except Exception as e:
         logger.error(f"Error parsing file {file_path}: {str(e)}")
         return
-    if file.get("file_type") == FileType.MUSIC:
-        sync_music_file(metadata=file, db=db)
-    elif file.get("file_type") == FileType.VIDEO:
-        sync_video_file(metadata=file, db=db)
-    elif file.get("file_type") == FileType.TEXT:
-        sync_text_file(metadata=file, db=db)
+    sync_metadata(file, db)
     return file
@@ -0,0 +1,311 @@
+import base64
+import io
+import os
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Optional, Union
+from uuid import uuid4
+
+from PIL import Image, features
+from pydantic import BaseModel
+
+from core.logger import logger
+from core.setting import load_setting
+
+THUMBNAILS_DIR = Path("data/thumbnails")
+# 多張縮圖合併的圖片 與縮圖使用同一個配額
+SPRITES_DIR = THUMBNAILS_DIR / "sprites"
+# 允許的尺寸 請求的尺寸往上取到最接近的一個 避免每個尺寸都產生一份
+THUMBNAIL_SIZES = (64, 128, 200, 320, 480, 640, 1024)
+DEFAULT_SIZE = 200
+# 新增圖片時先產生的尺寸 (封面列表使用的預設尺寸) 與格式
+PREGENERATE_SIZES = (DEFAULT_SIZE,)
+PREGENERATE_FORMATS = ("webp", "jpeg")
+# 預覽圖只需要顏色分布 越小越好
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_QUALITY = 40
+# 命中時超過這個時間才更新修改時間 (LRU 依修改時間淘汰)
+TOUCH_INTERVAL = 3600
+# 超過配額時刪到配額的這個比例 避免每次寫入都要掃描目錄
+EVICT_TARGET = 0.9
+# 剛寫入的縮圖可能正要送出 不會被淘汰
+# 沒有可以淘汰的縮圖時 也等這段時間才再掃描一次
+EVICT_MIN_AGE = 60
+# 掃描的子程序也會寫入縮圖 各程序的計數都不完整 超過這個時間就重新計算總大小
+RECOUNT_SECONDS = 300
+
+
+def snap_size(size: Optional[int]) -> int:
+    if not size:
+        return DEFAULT_SIZE
+    for allowed in THUMBNAIL_SIZES:
+        if size <= allowed:
+            return allowed
+    return THUMBNAIL_SIZES[-1]
+
+
+class ThumbnailFormat(BaseModel):
+    name: str
+    media_type: str
+    extension: str
+    options: dict = {}
+
+
+# 依偏好順序 JPEG 為所有瀏覽器都支援的預設格式
+THUMBNAIL_FORMATS = {
+    "avif": ThumbnailFormat(
+        name="AVIF", media_type="image/avif", extension="avif", options={"quality": 50}
+    ),
+    "webp": ThumbnailFormat(
+        name="WEBP", media_type="image/webp", extension="webp", options={"quality": 75}
+    ),
+    "jpeg": ThumbnailFormat(
+        name="JPEG",
+        media_type="image/jpeg",
+        extension="jpg",
+        options={"progressive": True, "optimize": True},
+    ),
+}
+
+
+def _supported(fmt: str) -> bool:
+    if fmt == "jpeg":
+        return True
+    try:
+        return features.check(fmt)
+    except ValueError:
+        # 舊版 Pillow 沒有這個格式
+        return False
+
+
+SUPPORTED_FORMATS = [fmt for fmt in THUMBNAIL_FORMATS if _supported(fmt)]
+
+
+def negotiate_format(accept: Optional[str]) -> str:
+    """
+    依 Accept 選擇格式 只有明確列出 (不是 */* 或 image/*) 的新格式才會使用
+    例: "image/avif,image/webp,*/*;q=0.8" -> avif
+    """
+    accepted = set()
+    for media_range in (accept or "").lower().split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media_type)
+    for fmt in SUPPORTED_FORMATS:
+        if THUMBNAIL_FORMATS[fmt].media_type in accepted:
+            return fmt
+    return "jpeg"
+
+
+def _resize(source: Union[Path, io.BytesIO], size: int) -> Image.Image:
+    with Image.open(source) as image:
+        # JPEG 解碼時直接縮小 不需要解出完整尺寸
+        image.draft("RGB", (size, size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.thumbnail((size, size))
+        image.load()
+        return image
+
+
+def encode_image(image: Image.Image, fmt: str, **options) -> bytes:
+    thumbnail_format = THUMBNAIL_FORMATS[fmt]
+    image_io = io.BytesIO()
+    image.save(
+        image_io,
+        format=thumbnail_format.name,
+        **{**thumbnail_format.options, **options},
+    )
+    return image_io.getvalue()
+
+
+def render_thumbnail(
+    source: Union[Path, io.BytesIO], size: int, fmt: str = "jpeg"
+) -> bytes:
+    return encode_image(_resize(source, size), fmt)
+
+
+def render_placeholder(source: Union[Path, io.BytesIO]) -> str:
+    """圖片載入前顯示的模糊預覽 回傳可以直接放在 img src 的 data URI"""
+    fmt = "webp" if "webp" in SUPPORTED_FORMATS else "jpeg"
+    data = encode_image(
+        _resize(source, PLACEHOLDER_SIZE), fmt, quality=PLACEHOLDER_QUALITY
+    )
+    media_type = THUMBNAIL_FORMATS[fmt].media_type
+    return f"data:{media_type};base64,{base64.b64encode(data).decode()}"
+
+
+class ThumbnailCache:
+    """
+    縮圖的磁碟快取 依 (圖片 ID, 尺寸, 格式) 存放 超過配額時刪除最久沒有使用的
+    data/thumbnails/200/ab/abcd....webp
+    使用:
+    path = thumbnail_cache.get(image_id, source_path, 200, "webp")
+    """
+
+    def __init__(self, root: Path = THUMBNAILS_DIR):
+        self.root = root
+        self.lock = Lock()
+        # 目前快取的總大小 第一次寫入時才計算 之後每 RECOUNT_SECONDS 重新計算
+        self.total_bytes: Optional[int] = None
+        self.counted_at = 0.0
+        # 同時只有一個執行緒掃描目錄 上次淘汰不夠時 這個時間之前不再嘗試
+        self.evicting = False
+        self.evict_after = 0.0
+
+    def path(self, image_id: str, size: int, fmt: str = "jpeg") -> Path:
+        stem = Path(image_id).stem
+        extension = THUMBNAIL_FORMATS[fmt].extension
+        return self.root / str(size) / stem[:2] / f"{stem}.{extension}"
+
+    def cached(self, image_id: str, size: int, fmt: str = "jpeg") -> Optional[Path]:
+        """已經產生過時回傳縮圖路徑"""
+        path = self.path(image_id, size, fmt)
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        self.touch(path, mtime)
+        return path
+
+    def get(self, image_id: str, source: Path, size: int, fmt: str = "jpeg") -> Path:
+        """回傳縮圖路徑 沒有時產生"""
+        path = self.cached(image_id, size, fmt)
+        if path is None:
+            path = self.path(image_id, size, fmt)
+            self.write(path, render_thumbnail(source, size, fmt))
+        return path
+
+    @staticmethod
+    def touch(path: Path, mtime: float) -> None:
+        """命中時更新修改時間 (LRU)"""
+        if time.time() - mtime > TOUCH_INTERVAL:
+            os.utime(path)
+
+    def pregenerate(self, image_id: str, image_data: bytes) -> None:
+        """新增圖片時先產生常用尺寸 已經有的略過 失敗時只記錄"""
+        for size in PREGENERATE_SIZES:
+            formats = [
+                fmt
+                for fmt in PREGENERATE_FORMATS
+                if fmt in SUPPORTED_FORMATS
+                and not self.path(image_id, size, fmt).exists()
+            ]
+            if not formats:
+                continue
+            try:
+                # 每個尺寸只解碼一次 再編碼成各種格式
+                image = _resize(io.BytesIO(image_data), size)
+                for fmt in formats:
+                    self.write(self.path(image_id, size, fmt), encode_image(image, fmt))
+            except Exception as e:
+                logger.error(f"Error creating thumbnail of {image_id}: {str(e)}")
+
+    def write(self, path: Path, data: bytes) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{uuid4()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        quota = self._quota()
+        with self.lock:
+            now = time.monotonic()
+            stale = self.total_bytes is None or now - self.counted_at > RECOUNT_SECONDS
+            if not stale:
+                self.total_bytes += len(data)
+            due = not self.evicting and (
+                stale or (self.total_bytes > quota and now >= self.evict_after)
+            )
+        if due:
+            self.evict()
+
+    @staticmethod
+    def _quota() -> int:
+        return load_setting().thumbnail_cache_mb * 1024 * 1024
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        entries = []
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                # 正在寫入的暫存檔
+                if name.startswith("."):
+                    continue
+                path = Path(root) / name
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self) -> dict:
+        """
+        超過配額時從最久沒有使用的縮圖開始刪除
+        在 lock 外掃描目錄 不會阻塞其他寫入 同時只有一個執行緒在淘汰
+        """
+        with self.lock:
+            if self.evicting:
+                return {"removed": 0, "freed_bytes": 0}
+            self.evicting = True
+        try:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            quota = self._quota()
+            removed, freed = 0, 0
+            if total > quota:
+                entries.sort()
+                min_age = time.time() - EVICT_MIN_AGE
+                for mtime, size, path in entries:
+                    if total <= quota * EVICT_TARGET or mtime > min_age:
+                        break
+                    try:
+                        path.unlink()
+                    except OSError:
+                        continue
+                    total -= size
+                    removed += 1
+                    freed += size
+                logger.info(
+                    f"Thumbnail cache evicted {removed} files, freed {freed} bytes"
+                )
+            now = time.monotonic()
+            with self.lock:
+                # 掃描期間其他執行緒的寫入 在下次重新計算時補上
+                self.total_bytes = total
+                self.counted_at = now
+                # 剩下的都太新 等它們夠舊了再淘汰
+                self.evict_after = now + EVICT_MIN_AGE if total > quota else 0.0
+        finally:
+            with self.lock:
+                self.evicting = False
+        return {"removed": removed, "freed_bytes": freed}
+
+    def remove_orphans(self, source_exists: Callable[[str], bool]) -> int:
+        """刪除原圖已經不存在的縮圖"""
+        removed, freed = 0, 0
+        for _, size, path in self._entries():
+            # 合併圖包含多張圖片 交給 LRU 淘汰
+            if path.parent == SPRITES_DIR or source_exists(f"{path.stem}.jpg"):
+                continue
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            removed += 1
+            freed += size
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes -= freed
+        return removed
+
+
+thumbnail_cache = ThumbnailCache()
@@ -0,0 +1,245 @@
+import os
+import time
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Optional
+
+from sqlmodel import Session, select, or_
+from watchfiles import Change, DefaultFilter, watch
+
+from db import engine
+from core.fileparser import FileParser
+from core.logger import logger
+from core.setting import Setting, load_setting
+from core.scanner import sync_dir_file
+from core.syncfile import retire_file, sync_one_file
+from models import FileFingerprint
+
+# inotify 收不到其他機器寫入的事件 這些檔案系統改用定期比對
+POLL_ONLY_FS = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "9p",
+    "fuse.sshfs",
+    "fuse.rclone",
+}
+# 檔案最後一次變動後要安靜多久才處理 (複製整張專輯時會連續收到事件)
+SETTLE_SECONDS = 2.0
+# 這些設定改變時才需要重新啟動監看
+WATCH_SETTINGS = ("storages", "scan_interval")
+
+
+def filesystem_type(path: Path) -> Optional[str]:
+    """從 /proc/self/mounts 找出路徑所在的檔案系統"""
+    try:
+        with open("/proc/self/mounts") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path_str = str(path.resolve())
+    best, fs_type = "", None
+    for mount_point, mount_type in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        if (
+            path_str == mount_point
+            or path_str.startswith(os.path.join(mount_point, ""))
+        ) and len(mount_point) > len(best):
+            best, fs_type = mount_point, mount_type
+    return fs_type
+
+
+class MediaFilter(DefaultFilter):
+    """只關心支援的檔案類型 與目錄"""
+
+    SUPPORT = (
+        FileParser.SUPPORT_MUSIC | FileParser.SUPPORT_VIDEO | FileParser.SUPPORT_TEXT
+    )
+
+    def __call__(self, change: Change, path: str) -> bool:
+        if not super().__call__(change, path):
+            return False
+        if Path(path).suffix.lower() in self.SUPPORT:
+            return True
+        # 被刪除的路徑無法判斷是否為目錄
+        return change == Change.deleted or os.path.isdir(path)
+
+
+class LibraryWatcher:
+    """
+    監看所有 Storage.path 的檔案變動, 只同步有變動的路徑
+    inotify 無法使用的儲存空間 以 scan_interval 定期做增量比對
+    使用:
+    watcher = LibraryWatcher()
+    watcher.start()
+    if watcher.affected_by(old_setting, new_setting):
+        watcher.reload()  # 會等待執行緒結束 不要在 event loop 中呼叫
+    watcher.stop()
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reload_lock = Lock()
+        self.pending: dict[str, float] = {}
+        self.new_dirs: set[str] = set()
+        self.stop_event = Event()
+        self.threads: list[Thread] = []
+
+    def start(self) -> None:
+        setting = load_setting()
+        watch_paths, poll_paths = [], []
+        for storage in setting.storages:
+            path = Path(storage.path)
+            if not path.is_dir():
+                logger.warning(f"Storage path {path} not found, skip watching")
+                continue
+            if filesystem_type(path) in POLL_ONLY_FS:
+                poll_paths.append(path)
+            else:
+                watch_paths.append(path)
+
+        # 每次啟動使用新的 Event 並傳給執行緒 停止時沒有及時結束的舊執行緒
+        # 仍然等待已經 set 的舊 Event 不會與新的執行緒同時處理事件
+        stop_event = self.stop_event = Event()
+        self.threads = [
+            Thread(
+                target=self._flush_loop,
+                args=(stop_event,),
+                daemon=True,
+                name="watcher-flush",
+            )
+        ]
+        if watch_paths:
+            self.threads.append(
+                Thread(
+                    target=self._watch_loop,
+                    args=(watch_paths, poll_paths, stop_event),
+                    daemon=True,
+                    name="watcher-inotify",
+                )
+            )
+        if poll_paths:
+            self.threads.append(
+                Thread(
+                    target=self._reconcile_loop,
+                    args=(poll_paths, setting.scan_interval, stop_event),
+                    daemon=True,
+                    name="watcher-reconcile",
+                )
+            )
+        for thread in self.threads:
+            thread.start()
+        logger.info(f"Watching {watch_paths}, polling {poll_paths}")
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=10)
+        self.threads = []
+
+    @staticmethod
+    def affected_by(old: Setting, new: Setting) -> bool:
+        """設定變更是否需要重新啟動監看"""
+        return any(getattr(old, name) != getattr(new, name) for name in WATCH_SETTINGS)
+
+    def reload(self) -> None:
+        """設定變更後重新啟動 會阻塞到舊的執行緒結束"""
+        with self.reload_lock:
+            self.stop()
+            self.start()
+
+    def _watch_loop(
+        self, paths: list[Path], poll_paths: list[Path], stop_event: Event
+    ) -> None:
+        try:
+            for changes in watch(
+                *paths,
+                watch_filter=MediaFilter(),
+                stop_event=stop_event,
+                yield_on_timeout=True,
+                rust_timeout=1000,
+                raise_interrupt=False,
+                ignore_permission_denied=True,
+            ):
+                now = time.monotonic()
+                with self.lock:
+                    for change, path in changes:
+                        self.pending[path] = now
+                        if change == Change.added and os.path.isdir(path):
+                            self.new_dirs.add(path)
+        except Exception as e:
+            # inotify 無法使用 (例如超過 max_user_watches) 改用定期比對
+            logger.error(f"File watcher failed, fallback to periodic scan: {str(e)}")
+            if not stop_event.is_set():
+                self._reconcile_loop(
+                    [*paths, *poll_paths], load_setting().scan_interval, stop_event
+                )
+
+    def _flush_loop(self, stop_event: Event) -> None:
+        while not stop_event.wait(SETTLE_SECONDS / 2):
+            now = time.monotonic()
+            with self.lock:
+                ready = [
+                    path
+                    for path, changed_at in self.pending.items()
+                    if now - changed_at >= SETTLE_SECONDS
+                ]
+                for path in ready:
+                    del self.pending[path]
+                new_dirs = self.new_dirs.intersection(ready)
+                self.new_dirs -= new_dirs
+            for path in sorted(ready):
+                try:
+                    self.sync_path(Path(path), path in new_dirs)
+                except Exception as e:
+                    logger.error(f"Error syncing {path}: {str(e)}")
+
+    def _reconcile_loop(
+        self, paths: list[Path], interval: int, stop_event: Event
+    ) -> None:
+        while not stop_event.wait(interval):
+            for path in paths:
+                try:
+                    sync_dir_file(path)
+                except Exception as e:
+                    logger.error(f"Error scanning {path}: {str(e)}")
+
+    @staticmethod
+    def sync_path(path: Path, new_dir: bool = False) -> None:
+        """依照路徑目前的狀態 新增/更新/移除資料"""
+        if path.is_file():
+            try:
+                FileParser.get_file_type(path)
+            except ValueError:
+                return
+            try:
+                sync_one_file(path)
+            except ValueError as e:
+                logger.debug(f"Skip {path}: {str(e)}")
+        elif path.is_dir():
+            if new_dir:
+                # 整個資料夾被搬進來時 inotify 不會對裡面的檔案發出事件
+                sync_dir_file(path)
+        else:
+            # 資料庫存的是 resolve 後的路徑
+            path = path.resolve()
+            with Session(engine) as db:
+                prefix = os.path.join(str(path), "")
+                removed = db.exec(
+                    select(FileFingerprint.filepath).where(
+                        or_(
+                            FileFingerprint.filepath == str(path),
+                            FileFingerprint.filepath.startswith(
+                                prefix, autoescape=True
+                            ),
+                        )
+                    )
+                ).all()
+                for filepath in removed:
+                    retire_file(filepath, db)
+                logger.info(f"Removed {len(removed)} files under {path}")
+
+
+watcher = LibraryWatcher()
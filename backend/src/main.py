@@ -2,6 +2,7 @@ from dotenv import load_dotenv
 
 load_dotenv()
 import os
+from contextlib import asynccontextmanager
 from db import engine, SQLModel
 from fastapi import FastAPI
 import json
@@ -15,6 +16,14 @@ from routers.setting import setting_router
 from routers.playlist import playlist_router
 from routers.video import video_router
 from core.logger import logger
+from core.watcher import watcher
+from core.enrichment import enrichment
+from core.keyframes import keyframe_indexer
+from core.httpclient import http
+from core.hls import hls_transcoder
+from core.imagepool import image_pool
+from core.providercache import provider_cache
+from core.scanjobs import resume_scan_jobs, stop_scans
 from starlette.middleware.cors import CORSMiddleware
 
 
@@ -28,7 +37,24 @@ if not (data_path / "settings.json").exists():
         json.dump(Setting().model_dump(), f, indent=4)
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    provider_cache.prune()
+    watcher.start()
+    enrichment.start()
+    keyframe_indexer.start()
+    resume_scan_jobs()
+    yield
+    stop_scans()
+    watcher.stop()
+    enrichment.stop()
+    keyframe_indexer.stop()
+    image_pool.shutdown()
+    hls_transcoder.shutdown()
+    http.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/ping")
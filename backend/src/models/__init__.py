@@ -2,4 +2,5 @@ from .common import *  # noqa: F403
 from .music import * # noqa: F403
 from .video import * # noqa: F403
 from .user import * # noqa: F403
-from .file import * # noqa: F403
\ No newline at end of file
+from .file import * # noqa: F403
+from .scan import * # noqa: F403
\ No newline at end of file
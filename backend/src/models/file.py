@@ -2,7 +2,7 @@ from typing import Optional
 from sqlmodel import Field
 from enum import Enum
 
-from .common import BasicFileModel
+from .common import BaseModel, BasicFileModel
 
 
 class FileFormat(str, Enum):
@@ -20,3 +20,10 @@ class FileModal(BasicFileModel, table=True):
     pages: Optional[int] = Field(default=None)
     author: Optional[str] = Field(default=None)
     publisher: Optional[str] = Field(default=None)
+
+
+class ImagePlaceholder(BaseModel, table=True):
+    """圖片載入前顯示的模糊預覽 (16px data URI) 依圖片 ID 存放"""
+
+    image_id: str = Field(primary_key=True)
+    placeholder: str
@@ -0,0 +1,72 @@
+from datetime import datetime
+from enum import StrEnum
+from typing import Optional
+from sqlalchemy import UniqueConstraint
+from sqlmodel import Field, BigInteger
+
+from .common import BaseModel
+
+
+class FileFingerprint(BaseModel, table=True):
+    """已索引檔案的指紋 用來判斷重新掃描時檔案是否有變動"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    filepath: str = Field(unique=True, index=True)
+    file_type: str
+    size: int = Field(sa_type=BigInteger)
+    mtime_ns: int = Field(sa_type=BigInteger)
+    inode: int = Field(sa_type=BigInteger)
+    device: int = Field(sa_type=BigInteger)
+    partial_hash: Optional[str] = Field(default=None)
+
+
+class EnrichmentKind(StrEnum):
+    MUSIC = "music"
+    VIDEO = "video"
+
+
+class EnrichmentStatus(StrEnum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class EnrichmentTask(BaseModel, table=True):
+    """等待補上線上資料 (MusicBrainz / Bangumi / TMDB / 歌詞) 的項目"""
+
+    __table_args__ = (UniqueConstraint("kind", "record_id"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: EnrichmentKind
+    record_id: int
+    status: EnrichmentStatus = Field(default=EnrichmentStatus.PENDING, index=True)
+    priority: int = Field(default=0)
+    attempts: int = Field(default=0)
+    last_error: Optional[str] = Field(default=None)
+    next_attempt_at: datetime = Field(default_factory=datetime.now)
+
+
+class ScanJobStatus(StrEnum):
+    RUNNING = "running"
+    PAUSED = "paused"
+    CANCELLED = "cancelled"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class ScanJob(BaseModel, table=True):
+    """目錄掃描工作 記錄進度 重新啟動後從中斷的地方繼續"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    root: str = Field(index=True)
+    status: ScanJobStatus = Field(default=ScanJobStatus.RUNNING, index=True)
+    scanned: int = Field(default=0)
+    added: int = Field(default=0)
+    updated: int = Field(default=0)
+    unchanged: int = Field(default=0)
+    failed: int = Field(default=0)
+    removed: int = Field(default=0)
+    # 檢查點 依路徑順序 這個檔案 (含) 之前的檔案都已經寫入資料庫
+    last_file: Optional[str] = Field(default=None)
+    error: Optional[str] = Field(default=None)
+    finished_at: Optional[datetime] = Field(default=None)
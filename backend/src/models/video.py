@@ -1,5 +1,5 @@
 from typing import Optional
-from sqlmodel import Field, Relationship, ARRAY, Column, String
+from sqlmodel import Field, Relationship, ARRAY, BigInteger, Column, LargeBinary, String
 from enum import Enum
 
 from .user import PlayHistory
@@ -74,6 +74,20 @@ class VideoFile(BasicFileModel, table=True):
     video: "Video" = Relationship(back_populates="file")
 
 
+class VideoKeyframeIndex(BaseModel, table=True):
+    """
+    影片串流的關鍵影格索引 每筆為 (pts, 位元組位置, 封包大小) 依 core.keyframes 的格式打包
+    檔案大小或修改時間改變時重新建立
+    """
+
+    video_file_id: int = Field(foreign_key="videofile.id", primary_key=True)
+    file_size: int = Field(sa_type=BigInteger)
+    mtime_ns: int = Field(sa_type=BigInteger)
+    time_base_num: int
+    time_base_den: int
+    entries: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+
+
 class Video(BaseModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     title: str = Field(index=True)
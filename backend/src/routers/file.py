@@ -1,21 +1,64 @@
+import asyncio
+import json
 from datetime import datetime
+from email.utils import formatdate
 from typing import Annotated, List, Optional, Union
-from fastapi import APIRouter, Query, Depends, HTTPException
+from fastapi import APIRouter, Query, Depends, HTTPException, Request
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy import literal
 from models.music import MusicTrack, Album, StreamTrack
 from models.video import Video
 from models.file import FileModal
+from models.scan import EnrichmentKind
 from sqlmodel import Session, desc, select, or_
 from sqlalchemy.orm import selectinload
 from db import get_db
-from core.syncfile import sync_one_file, sync_dir_file
+from core.syncfile import sync_one_file
+from core.scanjobs import (
+    cancel_scan,
+    job_status,
+    list_jobs,
+    pause_scan,
+    resume_scan,
+    start_scan,
+)
 from pathlib import Path
 from core.setting import load_setting
-from PIL import Image
-import io
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from core.musicstream import detect_url_type, MusicStream
+from core.enrichment import enrichment, prioritize
+from core.fileresponse import (
+    IMAGE_CACHE_CONTROL,
+    IMMUTABLE_CACHE_CONTROL,
+    SendfileResponse,
+    is_not_modified,
+    not_modified_response,
+)
+from core.imagestore import (
+    HASH_ID,
+    collect_garbage,
+    get_placeholders,
+    image_path as get_image_path,
+)
+from core.imagepool import RETRY_AFTER, ImagePoolBusy, image_pool
+from core.sprite import (
+    MAX_SPRITE_IMAGES,
+    SPRITE_KEY,
+    SpriteLayout,
+    cached_sprite_sheet,
+    check_sprite_size,
+    load_layout,
+    sprite_key,
+    sprite_layout,
+    sprite_sheet,
+)
+from core.thumbnail import (
+    THUMBNAIL_FORMATS,
+    negotiate_format,
+    snap_size,
+    thumbnail_cache,
+)
 
 
 class FilePathRequest(BaseModel):
@@ -33,6 +76,8 @@ class AlbumResponse(BaseModel):
     genre: Optional[str] = None
     year: Optional[int] = None
     cover_art: Optional[str] = None
+    # 封面載入前顯示的模糊預覽 (data URI)
+    cover_placeholder: Optional[str] = None
     description: Optional[str] = None
     tracks: List[MusicTrack] = []
 
@@ -45,11 +90,22 @@ class InfoResponse(BaseModel):
     Musics: list[MusicTrack]
     Albums: list[Album]
     Videos: list[Video]
+    # 圖片 ID -> 載入前顯示的模糊預覽 (data URI)
+    Placeholders: dict[str, str] = {}
 
     class Config:
         from_attributes = True
 
 
+class SpriteRequest(BaseModel):
+    image_ids: list[str] = Field(..., max_length=MAX_SPRITE_IMAGES)
+    image_size: Optional[int] = 200
+
+
+class SpriteResponse(SpriteLayout):
+    url: str
+
+
 file_router = APIRouter(prefix="/file", tags=["file"])
 
 # TODO: 之後再加入驗證middleware
@@ -57,21 +113,107 @@ file_router = APIRouter(prefix="/file", tags=["file"])
 SessionDep = Annotated[Session, Depends(get_db)]
 
 
+async def _process_image(key, fn, *args):
+    """在圖片處理執行緒池中執行 佇列已滿時回傳 503"""
+    try:
+        return await image_pool.run(key, fn, *args)
+    except ImagePoolBusy:
+        raise HTTPException(
+            status_code=503,
+            detail="image workers are busy",
+            headers={"Retry-After": str(RETRY_AFTER)},
+        )
+
+
 @file_router.get("/image")
 async def get_image_file(
+    request: Request,
     image_id=Query(..., description="圖片 ID"),
     image_size: Optional[int] = Query(200, description="圖片大小"),
 ):
-    """獲取圖片檔案"""
-    image_path = Path(f"data/images/{image_id}")
-    if not image_path.exists():
+    """
+    獲取圖片檔案 尺寸會取到最接近的預設尺寸
+    依 Accept 回傳 AVIF / WebP 不支援時回傳 progressive JPEG
+    """
+    image_path = get_image_path(image_id)
+    if image_path is None or not image_path.exists():
         raise HTTPException(status_code=404, detail="image not exists")
-    image = Image.open(image_path)
-    image.thumbnail((image_size, image_size))
-    image_io = io.BytesIO()
-    image.save(image_io, format="JPEG")
-    image_io.seek(0)
-    return StreamingResponse(image_io, media_type="image/jpeg")
+    size = snap_size(image_size)
+    fmt = negotiate_format(request.headers.get("accept"))
+    # 圖片 ID 寫入後內容不會再改變 ID 加上尺寸與格式就能當作 strong ETag
+    headers = {
+        "ETag": f'"{image_path.stem}-{size}-{fmt}"',
+        "Vary": "Accept",
+        "Last-Modified": formatdate(image_path.stat().st_mtime, usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL
+        if HASH_ID.match(image_id)
+        else IMAGE_CACHE_CONTROL,
+    }
+    if is_not_modified(request.headers, headers["ETag"], headers["Last-Modified"]):
+        return not_modified_response(headers)
+    thumbnail = await run_in_threadpool(thumbnail_cache.cached, image_id, size, fmt)
+    if thumbnail is None:
+        # 同一張縮圖同時被請求時只產生一次
+        thumbnail = await _process_image(
+            ("thumbnail", image_path.stem, size, fmt),
+            thumbnail_cache.get,
+            image_id,
+            image_path,
+            size,
+            fmt,
+        )
+    return SendfileResponse(
+        thumbnail, media_type=THUMBNAIL_FORMATS[fmt].media_type, headers=headers
+    )
+
+
+@file_router.post("/image/sprite", response_model=SpriteResponse)
+async def get_image_sprite(request: SpriteRequest):
+    """
+    把多張縮圖合併成一張 回傳每張圖片的位置與合併圖網址
+    列表一次載入所有封面 不需要每張圖片各送一個請求
+    """
+    try:
+        size = check_sprite_size(request.image_ids, request.image_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    key = sprite_key(request.image_ids, size)
+    layout = await run_in_threadpool(load_layout, key)
+    if layout is None:
+        layout = await _process_image(
+            ("sprite", key), sprite_layout, request.image_ids, request.image_size
+        )
+    return SpriteResponse(**layout.model_dump(), url=f"/file/image/sprite/{layout.key}")
+
+
+@file_router.get("/image/sprite/{key}")
+async def get_image_sprite_sheet(request: Request, key: str):
+    """合併圖 依 Accept 回傳 AVIF / WebP / JPEG"""
+    if not SPRITE_KEY.match(key):
+        raise HTTPException(status_code=404, detail="sprite not exists")
+    fmt = negotiate_format(request.headers.get("accept"))
+    # key 由圖片 ID 與尺寸決定 圖片 ID 的內容不會改變
+    headers = {
+        "ETag": f'"{key}-{fmt}"',
+        "Vary": "Accept",
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+    }
+    if is_not_modified(request.headers, headers["ETag"]):
+        return not_modified_response(headers)
+    sheet = await run_in_threadpool(cached_sprite_sheet, key, fmt)
+    if sheet is None:
+        sheet = await _process_image(("sprite", key, fmt), sprite_sheet, key, fmt)
+    if sheet is None:
+        raise HTTPException(status_code=404, detail="sprite not exists")
+    return SendfileResponse(
+        sheet, media_type=THUMBNAIL_FORMATS[fmt].media_type, headers=headers
+    )
+
+
+@file_router.post("/image/gc")
+async def collect_image_garbage(session: SessionDep):
+    """刪除沒有被引用的圖片 走訪 / 刪除檔案在執行緒中進行 不阻塞 event loop"""
+    return await run_in_threadpool(collect_garbage, session)
 
 
 @file_router.get("/info", response_model=InfoResponse)
@@ -98,10 +240,17 @@ async def get_info(session: SessionDep, limit: int = 20):
         .limit(limit)
     ).all()
 
+    placeholders = get_placeholders(
+        [track.cover_art for track in musics]
+        + [album.cover_art for album in albums]
+        + [video.thumbnail for video in videos],
+        session,
+    )
     return {
         "Musics": [track.model_dump() for track in musics],
         "Albums": [album.model_dump() for album in albums],
         "Videos": [video.model_dump() for video in videos],
+        "Placeholders": placeholders,
     }
 
 
@@ -123,12 +272,21 @@ async def get_albums(
                 status_code=404, detail=f"id:{album_id} album not found"
             )
 
-        return AlbumResponse.model_validate(album)
+        placeholders = get_placeholders([album.cover_art], session)
+        return AlbumResponse.model_validate(album).model_copy(
+            update={"cover_placeholder": placeholders.get(album.cover_art)}
+        )
 
     statement = select(Album).options(selectinload(Album.tracks))
     albums = session.exec(statement).all()
+    placeholders = get_placeholders([album.cover_art for album in albums], session)
 
-    return [AlbumResponse.model_validate(album) for album in albums]
+    return [
+        AlbumResponse.model_validate(album).model_copy(
+            update={"cover_placeholder": placeholders.get(album.cover_art)}
+        )
+        for album in albums
+    ]
 
 
 @file_router.get("/music", response_model=Union[MusicTrack, list[MusicTrack]])
@@ -137,6 +295,7 @@ async def get_music_file(
 ):
     """獲取音樂檔案"""
     if track_id is not None:
+        prioritize(EnrichmentKind.MUSIC, track_id, session)
         statement = (
             select(MusicTrack)
             .where(MusicTrack.id == track_id)
@@ -161,6 +320,7 @@ async def get_video_file(
 ):
     """獲取影片檔案"""
     if video_id is not None:
+        prioritize(EnrichmentKind.VIDEO, video_id, session)
         statement = (
             select(Video)
             .where(Video.id == video_id)
@@ -205,7 +365,7 @@ async def get_file(
 async def parse_one_file(request: FilePathRequest):
     """解析1個檔案"""
     try:
-        data = sync_one_file(Path(request.file_path))
+        data = await run_in_threadpool(sync_one_file, Path(request.file_path))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     return data
@@ -213,12 +373,93 @@ async def parse_one_file(request: FilePathRequest):
 
 @file_router.post("/scanall")
 async def scan_all_files(request: FilePathRequest):
-    """掃描所有檔案"""
-    if Path(request.file_path):
-        sync_dir_file(Path(request.file_path))
-    else:
-        for dir in load_setting().storages:
-            sync_dir_file(dir.path)
+    """
+    在背景掃描 回傳工作 ID 用 /file/scan/{job_id}/events 取得進度
+    掃描所有儲存空間時 無法掃描的目錄 (不存在 / 已經在掃描) 列在 skipped 不影響其他目錄
+    """
+    if request.file_path:
+        try:
+            return {"job_ids": [start_scan(Path(request.file_path))], "skipped": []}
+        except ValueError as e:
+            raise HTTPException(
+                status_code=400, detail=f"{request.file_path}: {str(e)}"
+            )
+    job_ids = []
+    skipped = []
+    for storage in load_setting().storages:
+        try:
+            job_ids.append(start_scan(Path(storage.path)))
+        except ValueError as e:
+            skipped.append({"path": str(storage.path), "reason": str(e)})
+    return {"job_ids": job_ids, "skipped": skipped}
+
+
+@file_router.get("/scan")
+async def get_scan_jobs(limit: int = Query(20, ge=1, le=200)):
+    """最近的掃描工作"""
+    return await run_in_threadpool(list_jobs, limit)
+
+
+@file_router.get("/scan/{job_id}")
+async def get_scan_job(job_id: int):
+    status = await run_in_threadpool(job_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="scan job not found")
+    return status
+
+
+@file_router.get("/scan/{job_id}/events")
+async def scan_job_events(job_id: int, interval: float = Query(1.0, ge=0.2)):
+    """以 Server-Sent Events 推送掃描進度 工作結束後關閉"""
+    status = await run_in_threadpool(job_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="scan job not found")
+
+    async def events():
+        current = status
+        while True:
+            yield f"data: {json.dumps(current, default=str)}\n\n"
+            if not current["active"]:
+                break
+            await asyncio.sleep(interval)
+            current = await run_in_threadpool(job_status, job_id)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@file_router.post("/scan/{job_id}/pause")
+async def pause_scan_job(job_id: int):
+    if not pause_scan(job_id):
+        raise HTTPException(status_code=404, detail="scan job is not running")
+    return {"message": "paused"}
+
+
+@file_router.post("/scan/{job_id}/resume")
+async def resume_scan_job(job_id: int):
+    try:
+        resumed = await run_in_threadpool(resume_scan, job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not resumed:
+        raise HTTPException(status_code=404, detail="scan job cannot be resumed")
+    return {"message": "resumed"}
+
+
+@file_router.post("/scan/{job_id}/cancel")
+async def cancel_scan_job(job_id: int):
+    if not await run_in_threadpool(cancel_scan, job_id):
+        raise HTTPException(status_code=404, detail="scan job cannot be cancelled")
+    return {"message": "cancelled"}
+
+
+@file_router.get("/enrich")
+async def get_enrich_progress():
+    """線上資料補完進度"""
+    return enrichment.progress()
 
 
 @file_router.get("/searchmusic")
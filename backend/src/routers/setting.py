@@ -4,7 +4,11 @@ from typing import Annotated, Optional
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel, Field
 from sqlmodel import Session
-from core.setting import Storage, StorageType, update_setting
+from starlette.concurrency import run_in_threadpool
+from core.setting import Storage, StorageType, load_setting, update_setting
+from core.httpclient import provider_stats
+from core.providercache import provider_cache
+from core.watcher import watcher
 from typing import Dict, List
 
 from db import get_db
@@ -58,6 +62,13 @@ class SettingUpdate(BaseModel):
     scan_interval: Optional[int] = Field(None, ge=60)
     log_level: Optional[LogLevel] = None
     tmd_api_key: Optional[str] = None
+    scan_workers: Optional[int] = Field(None, ge=0)
+    scan_max_inflight: Optional[int] = Field(None, ge=0)
+    scan_partial_hash: Optional[bool] = None
+    scan_batch_size: Optional[int] = Field(None, ge=1)
+    enrich_workers: Optional[int] = Field(None, ge=1)
+    thumbnail_cache_mb: Optional[int] = Field(None, ge=1)
+    hls_cache_mb: Optional[int] = Field(None, ge=1)
 
 
 @setting_router.post("/update")
@@ -66,7 +77,7 @@ async def update_system_setting(update: SettingUpdate) -> Dict:
         updates = {}
 
         if update.storage is not None:
-            updates["storage"] = [
+            updates["storages"] = [
                 Storage(type=s.type, LangCode=s.LangCode, path=Path(s.path))
                 for s in update.storage
             ]
@@ -80,10 +91,47 @@ async def update_system_setting(update: SettingUpdate) -> Dict:
         if update.tmd_api_key is not None:
             updates["tmd_api_key"] = update.tmd_api_key
 
+        if update.scan_workers is not None:
+            updates["scan_workers"] = update.scan_workers
+
+        if update.scan_max_inflight is not None:
+            updates["scan_max_inflight"] = update.scan_max_inflight
+
+        if update.scan_partial_hash is not None:
+            updates["scan_partial_hash"] = update.scan_partial_hash
+
+        if update.scan_batch_size is not None:
+            updates["scan_batch_size"] = update.scan_batch_size
+
+        if update.enrich_workers is not None:
+            updates["enrich_workers"] = update.enrich_workers
+
+        if update.thumbnail_cache_mb is not None:
+            updates["thumbnail_cache_mb"] = update.thumbnail_cache_mb
+
+        if update.hls_cache_mb is not None:
+            updates["hls_cache_mb"] = update.hls_cache_mb
+
+        old_setting = load_setting()
         setting = update_setting(updates)
+        if watcher.affected_by(old_setting, setting):
+            # 等待舊的監看執行緒結束 不能阻塞 event loop
+            await run_in_threadpool(watcher.reload)
         return {"message": "設定已更新", "setting": setting.model_dump()}
 
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@setting_router.get("/providers")
+async def get_provider_stats() -> dict:
+    """線上資料提供者的請求數 / 錯誤數 / 延遲"""
+    return provider_stats.snapshot()
+
+
+@setting_router.delete("/providers/cache")
+async def clear_provider_cache(provider: Optional[str] = None) -> dict:
+    """清除線上資料快取 不指定 provider 時全部清除"""
+    return {"deleted": provider_cache.clear(provider)}
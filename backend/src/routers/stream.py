@@ -1,150 +1,125 @@
-from pathlib import Path
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
-from typing import Annotated
-from fastapi.responses import FileResponse, StreamingResponse
+import os
+import requests
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Annotated, Optional
 from sqlmodel import Session, select
 from db import get_db
+from core.enrichment import prioritize
+from core.fileresponse import MEDIA_CACHE_CONTROL, SendfileResponse
+from core.hls import (
+    HlsPlan,
+    SegmentCancelled,
+    hls_plan,
+    hls_transcoder,
+    master_playlist,
+    media_playlist,
+)
+from core.keyframes import keyframe_index
+from core.makehls import COPY_VIDEO_CODECS
+from core.musiclyrics import get_lrclib
+from core.remux import Fmp4Remux
+from core.streamcache import StreamTarget, stream_cache
 from models.music import MusicTrack
-from models.video import Video
+from models.video import Video, VideoCodec, VideoFile
 from models.file import FileModal
-import re
+from models.scan import EnrichmentKind
 
 stream_router = APIRouter(prefix="/stream", tags=["stream"])
 
 SessionDep = Annotated[Session, Depends(get_db)]
+MEDIA_HEADERS = {"Cache-Control": MEDIA_CACHE_CONTROL}
+HLS_PLAYLIST_TYPE = "application/vnd.apple.mpegurl"
 
 
-@stream_router.get("/music/{track_id}")
-async def stream_music(
-    track_id: int,
-    request: Request,
-    session: SessionDep,
-):
+def _stat(filepath: str, detail: str) -> os.stat_result:
+    try:
+        return os.stat(filepath)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=detail)
+
+
+def _music_file(track_id: int, session: Session) -> StreamTarget:
     music = session.exec(select(MusicTrack).where(MusicTrack.id == track_id)).first()
     if not music or not music.file:
         raise HTTPException(status_code=404, detail="找不到音樂檔案")
+    filepath = music.file.filepath
+    target = (
+        filepath,
+        _stat(filepath, "音樂檔案不存在"),
+        f"audio/{music.file.codec.value}",
+    )
+    stream_cache.put("music", track_id, target)
+    return target
 
-    file_path = Path(music.file.filepath)
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="音樂檔案不存在")
-
-    file_size = file_path.stat().st_size
-    range_header = request.headers.get("Range")
-    if range_header:
-        range_match = re.match(r"bytes=(\d+)-(\d+)?", range_header)
-        if range_match:
-            start = int(range_match.group(1))
-            end = int(range_match.group(2)) if range_match.group(2) else file_size - 1
-        else:
-            start = 0
-            end = file_size - 1
-    else:
-        start = 0
-        end = file_size - 1
-
-    async def file_iterator(start: int, end: int):
-        chunk_size = 1024 * 1024
-        with open(file_path, "rb") as file:
-            file.seek(start)
-            while start <= end:
-                bytes_to_read = min(chunk_size, end - start + 1)
-                data = file.read(bytes_to_read)
-                if not data:
-                    break
-                start += len(data)
-                yield data
-
-    headers = {
-        "Content-Range": f"bytes {start}-{end}/{file_size}",
-        "Accept-Ranges": "bytes",
-    }
 
-    return StreamingResponse(
-        file_iterator(start, end),
-        media_type=f"audio/{music.file.codec.value}",
-        headers=headers,
-        status_code=206,
+def _video_file(video_id: int, session: Session) -> StreamTarget:
+    video = session.exec(select(Video).where(Video.id == video_id)).first()
+    if not video or not video.file:
+        raise HTTPException(status_code=404, detail="找不到影片檔案")
+    filepath = video.file.filepath
+    target = (
+        filepath,
+        _stat(filepath, "影片檔案不存在"),
+        f"video/{video.file.format.lower()}",
+    )
+    stream_cache.put("video", video_id, target)
+    return target
+
+
+def _video_codec(video_id: int, session: Session) -> Optional[str]:
+    """資料庫中的影片編碼 不知道時回傳 None (開啟檔案後再判斷)"""
+    codec = session.exec(
+        select(VideoFile.codec).where(VideoFile.video_id == video_id)
+    ).first()
+    if codec is None or VideoCodec(codec) == VideoCodec.Unknown:
+        return None
+    return VideoCodec(codec).value
+
+
+def _file_response(target: StreamTarget) -> SendfileResponse:
+    filepath, stat_result, media_type = target
+    return SendfileResponse(
+        filepath, media_type=media_type, stat_result=stat_result, headers=MEDIA_HEADERS
     )
 
 
+@stream_router.get("/music/{track_id}")
+async def stream_music(
+    track_id: int,
+    session: SessionDep,
+):
+    """串流音樂檔案 支援 Range"""
+    target = stream_cache.get("music", track_id)
+    if target is None:
+        # 快取命中時已經提高過補完資料的優先順序
+        prioritize(EnrichmentKind.MUSIC, track_id, session)
+        target = _music_file(track_id, session)
+    return _file_response(target)
+
+
 @stream_router.head("/music/{track_id}")
 async def head_music(
     track_id: int,
     session: SessionDep,
 ):
     """處理HEAD請求"""
-    music = session.exec(select(MusicTrack).where(MusicTrack.id == track_id)).first()
-    if not music or not music.file:
-        raise HTTPException(status_code=404, detail="找不到音樂檔案")
-
-    file_path = Path(music.file.filepath)
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="音樂檔案不存在")
-
-    file_size = file_path.stat().st_size
-
-    headers = {
-        "Content-Length": str(file_size),
-        "Accept-Ranges": "bytes",
-        "Content-Type": f"audio/{music.file.codec.value}",
-    }
-
-    return Response(headers=headers)
+    target = stream_cache.get("music", track_id) or _music_file(track_id, session)
+    return _file_response(target)
 
 
 @stream_router.get("/video/{video_id}")
 async def stream_video(
     video_id: int,
-    request: Request,
     session: SessionDep,
 ):
-    """串流影片檔案"""
-    video = session.exec(select(Video).where(Video.id == video_id)).first()
-    if not video or not video.file:
-        raise HTTPException(status_code=404, detail="找不到影片檔案")
-
-    file_path = Path(video.file.filepath)
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="影片檔案不存在")
-
-    file_size = file_path.stat().st_size
-    range_header = request.headers.get("Range")
-
-    if range_header:
-        range_match = re.match(r"bytes=(\d+)-(\d+)?", range_header)
-        if range_match:
-            start = int(range_match.group(1))
-            end = int(range_match.group(2)) if range_match.group(2) else file_size - 1
-        else:
-            start = 0
-            end = file_size - 1
-    else:
-        start = 0
-        end = file_size - 1
-
-    async def file_iterator(start: int, end: int):
-        chunk_size = 1024 * 1024
-        with open(file_path, "rb") as file:
-            file.seek(start)
-            while start <= end:
-                bytes_to_read = min(chunk_size, end - start + 1)
-                data = file.read(bytes_to_read)
-                if not data:
-                    break
-                start += len(data)
-                yield data
-
-    headers = {
-        "Content-Range": f"bytes {start}-{end}/{file_size}",
-        "Accept-Ranges": "bytes",
-        "Content-Type": f"video/{video.file.format.lower()}",
-    }
-
-    return StreamingResponse(
-        file_iterator(start, end),
-        headers=headers,
-        status_code=206 if range_header else 200,
-    )
+    """串流影片檔案 支援 Range"""
+    target = stream_cache.get("video", video_id)
+    if target is None:
+        prioritize(EnrichmentKind.VIDEO, video_id, session)
+        target = _video_file(video_id, session)
+    return _file_response(target)
 
 
 @stream_router.head("/video/{video_id}")
@@ -153,23 +128,102 @@ async def head_video(
     session: SessionDep,
 ):
     """處理 HEAD 請求"""
-    video = session.exec(select(Video).where(Video.id == video_id)).first()
-    if not video or not video.file:
-        raise HTTPException(status_code=404, detail="找不到影片檔案")
+    target = stream_cache.get("video", video_id) or _video_file(video_id, session)
+    return _file_response(target)
+
+
+async def _hls_plan(video_id: int, session: Session) -> HlsPlan:
+    filepath, stat_result, _ = stream_cache.get("video", video_id) or _video_file(
+        video_id, session
+    )
+    try:
+        return await run_in_threadpool(hls_plan, video_id, filepath, stat_result)
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=f"無法轉換為 HLS: {str(e)}")
+
+
+@stream_router.get("/video/{video_id}/hls/master.m3u8")
+async def hls_master_playlist(video_id: int, session: SessionDep):
+    """HLS 主播放列表 片段在請求時才轉檔"""
+    plan = await _hls_plan(video_id, session)
+    return Response(
+        master_playlist(plan), media_type=HLS_PLAYLIST_TYPE, headers=MEDIA_HEADERS
+    )
 
-    file_path = Path(video.file.filepath)
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="影片檔案不存在")
 
-    file_size = file_path.stat().st_size
+@stream_router.get("/video/{video_id}/hls/{rendition}/index.m3u8")
+async def hls_media_playlist(video_id: int, rendition: str, session: SessionDep):
+    plan = await _hls_plan(video_id, session)
+    if rendition not in plan.renditions:
+        raise HTTPException(status_code=404, detail="找不到畫質")
+    return Response(
+        media_playlist(plan), media_type=HLS_PLAYLIST_TYPE, headers=MEDIA_HEADERS
+    )
 
-    headers = {
-        "Content-Length": str(file_size),
-        "Accept-Ranges": "bytes",
-        "Content-Type": f"video/{video.file.format.lower()}",
-    }
 
-    return Response(headers=headers)
+@stream_router.get("/video/{video_id}/hls/{rendition}/{index}.ts")
+async def hls_segment(video_id: int, rendition: str, index: int, session: SessionDep):
+    plan = await _hls_plan(video_id, session)
+    if rendition not in plan.renditions or not 0 <= index < plan.segment_count:
+        raise HTTPException(status_code=404, detail="找不到片段")
+    try:
+        segment = await hls_transcoder.segment(plan, rendition, index)
+    except SegmentCancelled:
+        raise HTTPException(status_code=503, detail="轉檔已取消")
+    return SendfileResponse(segment, media_type="video/mp2t", headers=MEDIA_HEADERS)
+
+
+@stream_router.get("/video/{video_id}/remux")
+async def remux_video(
+    video_id: int,
+    session: SessionDep,
+    start: float = Query(0, ge=0, description="開始時間 (秒)"),
+):
+    """
+    把 MKV / AVI / FLV 即時重新封裝成 fragmented MP4 不轉檔
+    start 會對齊到之前最近的關鍵影格 實際的起點在 X-Start-Time
+    """
+    codec = _video_codec(video_id, session)
+    if codec is not None and codec not in COPY_VIDEO_CODECS:
+        raise HTTPException(
+            status_code=415, detail="無法重新封裝: 影片編碼瀏覽器無法直接播放"
+        )
+    filepath, stat_result, _ = stream_cache.get("video", video_id) or _video_file(
+        video_id, session
+    )
+    try:
+        remux = await run_in_threadpool(Fmp4Remux, filepath, start, codec, stat_result)
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=f"無法重新封裝: {str(e)}")
+    # 串流結束或中斷時 由 remux 的 generator 自己關閉檔案
+    return StreamingResponse(
+        iter(remux),
+        media_type="video/mp4",
+        headers={"X-Start-Time": f"{remux.start:.3f}", "Cache-Control": "no-store"},
+    )
+
+
+@stream_router.get("/video/{video_id}/seek")
+async def seek_video(
+    video_id: int,
+    session: SessionDep,
+    t: float = Query(..., ge=0, description="時間 (秒)"),
+):
+    """時間之前最近的關鍵影格與它在檔案中的位置 (給 Range 請求使用)"""
+    filepath, stat_result, _ = stream_cache.get("video", video_id) or _video_file(
+        video_id, session
+    )
+    try:
+        index = await run_in_threadpool(
+            keyframe_index, filepath, stat_result.st_size, stat_result.st_mtime_ns
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=f"無法讀取關鍵影格: {str(e)}")
+    located = index.locate(t)
+    if located is None:
+        raise HTTPException(status_code=404, detail="找不到關鍵影格")
+    time, offset = located
+    return {"time": time, "offset": offset if offset >= 0 else None}
 
 
 @stream_router.get("/file/{file_id}")
@@ -178,13 +232,14 @@ async def get_file(
     session: SessionDep,
 ):
     """獲取檔案"""
-    file = session.exec(select(FileModal).where(FileModal.id == file_id)).first()
-    if not file:
-        raise HTTPException(status_code=404, detail="找不到檔案")
-    file_path = Path(file.filepath)
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="檔案不存在")
-    return FileResponse(file_path)
+    target = stream_cache.get("file", file_id)
+    if target is None:
+        file = session.exec(select(FileModal).where(FileModal.id == file_id)).first()
+        if not file:
+            raise HTTPException(status_code=404, detail="找不到檔案")
+        target = (file.filepath, _stat(file.filepath, "檔案不存在"), None)
+        stream_cache.put("file", file_id, target)
+    return _file_response(target)
 
 
 @stream_router.get("/video/{video_id}/subtitle/{language}")
@@ -199,6 +254,20 @@ async def get_subtitle(
 @stream_router.get("/music/{track_id}/lyrics")
 async def get_lyrics(
     track_id: int,
+    session: SessionDep,
 ):
-    """獲取歌詞"""
-    ...
+    """獲取歌詞 資料庫沒有時向 lrclib 查詢"""
+    music = session.exec(select(MusicTrack).where(MusicTrack.id == track_id)).first()
+    if not music:
+        raise HTTPException(status_code=404, detail="找不到音樂")
+    if not music.lyrics:
+        try:
+            music.lyrics = await run_in_threadpool(
+                get_lrclib, music.album, music.artist, music.title
+            )
+        except requests.RequestException:
+            raise HTTPException(status_code=502, detail="無法取得歌詞")
+        if music.lyrics:
+            session.add(music)
+            session.commit()
+    return {"lyrics": music.lyrics}
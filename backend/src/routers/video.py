@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Annotated, Optional
 from fastapi import APIRouter, Depends
 from pydantic import BaseModel
@@ -5,6 +6,7 @@ from sqlmodel import Session, select
 from sqlalchemy.orm import selectinload
 
 from db import get_db
+from core.imagestore import get_placeholders
 from models import AnimeSeries, VideoFile
 from fastapi import HTTPException
 
@@ -32,6 +34,26 @@ class EpisodeResponse(BaseModel):
     episode_number: Optional[int]
 
 
+class AnimeListResponse(BaseModel):
+    id: Optional[int]
+    title: str
+    original_title: Optional[str]
+    release_date: str
+    author: Optional[str]
+    studio: Optional[str]
+    description: Optional[str]
+    season_number: Optional[int]
+    total_episodes: Optional[int]
+    cover_image: Optional[str]
+    # 封面載入前顯示的模糊預覽 (data URI)
+    cover_placeholder: Optional[str] = None
+    created_at: datetime
+    updated_at: Optional[datetime]
+
+    class Config:
+        from_attributes = True
+
+
 class AnimeResponse(BaseModel):
     id: Optional[int]
     title: str
@@ -52,12 +74,18 @@ class AnimeResponse(BaseModel):
         from_attributes = True
 
 
-@video_router.get("/anime", response_model=list[AnimeSeries])
+@video_router.get("/anime", response_model=list[AnimeListResponse])
 async def get_anime(session: SessionDep):
     """獲取動畫列表"""
     statement = select(AnimeSeries)
     animes = session.exec(statement).all()
-    return animes
+    placeholders = get_placeholders([anime.cover_image for anime in animes], session)
+    return [
+        AnimeListResponse.model_validate(anime).model_copy(
+            update={"cover_placeholder": placeholders.get(anime.cover_image)}
+        )
+        for anime in animes
+    ]
 
 
 @video_router.get("/anime/{anime_id}", response_model=AnimeResponse)
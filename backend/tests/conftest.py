@@ -0,0 +1,15 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlmodel import SQLModel
+
+
+@pytest.fixture(scope="session")
+def engine():
+    """需要 Postgres 的測試 連不上資料庫時略過"""
+    from db import engine
+
+    try:
+        SQLModel.metadata.create_all(engine)
+    except OperationalError as e:
+        pytest.skip(f"資料庫無法連線: {e}")
+    return engine
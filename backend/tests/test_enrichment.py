@@ -0,0 +1,43 @@
+from datetime import datetime
+
+import requests
+from sqlmodel import Session, delete
+
+from core import enrichment as enrichment_module
+from core.enrichment import OPEN_PRIORITY, enrichment
+from models import EnrichmentKind, EnrichmentStatus, EnrichmentTask, MusicTrack
+
+
+def test_provider_error_reschedules_task(engine, monkeypatch):
+    def unavailable(title, artist):
+        raise requests.ConnectionError("musicbrainz unavailable")
+
+    monkeypatch.setattr(enrichment_module, "lookup_track", unavailable)
+    monkeypatch.setattr(enrichment_module, "get_lrclib", lambda *args: None)
+    with Session(engine) as db:
+        track = MusicTrack(title="Fatal", artist="GEMN", duration=180)
+        db.add(track)
+        db.commit()
+        task = EnrichmentTask(
+            kind=EnrichmentKind.MUSIC,
+            record_id=track.id,
+            # 排在其他待處理的項目前面
+            priority=OPEN_PRIORITY * 10,
+        )
+        db.add(task)
+        db.commit()
+        track_id, task_id = track.id, task.id
+
+    try:
+        assert enrichment.run_once()
+        with Session(engine) as db:
+            task = db.get(EnrichmentTask, task_id)
+            assert task.status == EnrichmentStatus.PENDING
+            assert task.attempts == 1
+            assert task.next_attempt_at > datetime.now()
+            assert "musicbrainz unavailable" in task.last_error
+    finally:
+        with Session(engine) as db:
+            db.exec(delete(EnrichmentTask).where(EnrichmentTask.id == task_id))
+            db.exec(delete(MusicTrack).where(MusicTrack.id == track_id))
+            db.commit()
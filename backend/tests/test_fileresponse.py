@@ -0,0 +1,33 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from core.fileresponse import SendfileResponse
+
+FILE_SIZE = 10240
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "track.flac"
+    path.write_bytes(bytes(range(256)) * (FILE_SIZE // 256))
+    app = FastAPI()
+
+    @app.get("/file")
+    async def get_file():
+        return SendfileResponse(path, media_type="audio/flac")
+
+    return TestClient(app)
+
+
+def test_unsatisfiable_range_content_range(client):
+    response = client.get("/file", headers={"Range": f"bytes={FILE_SIZE}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{FILE_SIZE}"
+
+
+def test_single_range(client):
+    response = client.get("/file", headers={"Range": "bytes=256-511"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 256-511/{FILE_SIZE}"
+    assert response.content == bytes(range(256))
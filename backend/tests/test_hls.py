@@ -0,0 +1,55 @@
+import io
+import os
+from fractions import Fraction
+
+import av
+from PIL import Image
+
+from core import hls
+from core.hls import SEGMENT_DURATION, hls_plan, transcode_segment
+
+
+def make_vfr_video(path) -> None:
+    """前 3 秒 30fps 之後 10fps"""
+    with av.open(str(path), "w") as out:
+        stream = out.add_stream("libx264", rate=30)
+        stream.width, stream.height, stream.pix_fmt = 64, 48, "yuv420p"
+        stream.codec_context.time_base = Fraction(1, 1000)
+        pts = 0
+        for i in range(90 + 100):
+            frame = av.VideoFrame.from_image(Image.new("RGB", (64, 48), (i, 0, 0)))
+            frame.pts, frame.time_base = pts, Fraction(1, 1000)
+            pts += 33 if i < 90 else 100
+            out.mux(stream.encode(frame))
+        out.mux(stream.encode(None))
+
+
+def test_plan_without_stored_index_uses_fixed_segments(tmp_path, monkeypatch):
+    source = tmp_path / "vfr.mkv"
+    make_vfr_video(source)
+    notified = []
+    monkeypatch.setattr(hls, "stored_keyframe_index", lambda *args: None)
+    monkeypatch.setattr(hls.keyframe_indexer, "notify", lambda: notified.append(1))
+
+    plan = hls_plan(1, str(source), os.stat(source))
+
+    assert notified
+    assert plan.key.endswith("-fixed")
+    assert plan.copy_rendition is None
+    assert plan.boundaries[:-1] == [
+        i * SEGMENT_DURATION for i in range(plan.segment_count)
+    ]
+    assert plan.boundaries[-1] == plan.duration
+
+
+def test_transcode_keeps_variable_frame_timestamps(tmp_path):
+    source = tmp_path / "vfr.mkv"
+    make_vfr_video(source)
+
+    data = transcode_segment(str(source), 2.0, 6.0, 64, 48)
+
+    with av.open(io.BytesIO(data), format="mpegts") as container:
+        times = [float(frame.time) for frame in container.decode(video=0)]
+    gaps = {round(b - a, 3) for a, b in zip(times, times[1:])}
+    assert gaps == {0.033, 0.1}
+    assert round(times[0] - hls.TS_OFFSET, 3) == 2.013
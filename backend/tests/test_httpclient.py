@@ -0,0 +1,50 @@
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from core import httpclient
+from core.httpclient import HttpClient, RateLimiter
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """前兩次回應 503 之後回應 200"""
+
+    requests: list[float] = []
+
+    def do_GET(self):
+        FlakyHandler.requests.append(time.monotonic())
+        status = 503 if len(FlakyHandler.requests) <= 2 else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        if status == 503:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    FlakyHandler.requests = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}/"
+    httpd.shutdown()
+
+
+def test_retries_take_rate_limit_tokens(server, monkeypatch):
+    rate = 10.0
+    monkeypatch.setitem(httpclient.rate_limiters, "127.0.0.1", RateLimiter(rate))
+    client = HttpClient()
+    try:
+        response = client.get(server)
+    finally:
+        client.close()
+    assert response.status_code == 200
+    assert len(FlakyHandler.requests) == 3
+    gaps = [b - a for a, b in zip(FlakyHandler.requests, FlakyHandler.requests[1:])]
+    # 每次重試都要等到下一個額度
+    assert min(gaps) >= 1 / rate * 0.9
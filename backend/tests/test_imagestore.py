@@ -0,0 +1,42 @@
+import io
+
+from PIL import Image
+from sqlmodel import Session, delete
+
+from core import imagestore
+from core.imagestore import (
+    get_placeholders,
+    image_placeholders,
+    save_image,
+    save_placeholders,
+)
+from models import ImagePlaceholder
+
+
+def _jpeg() -> bytes:
+    image_io = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 40, 40)).save(image_io, "JPEG")
+    return image_io.getvalue()
+
+
+def test_save_image_leaves_placeholder_to_caller(engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(imagestore, "IMAGES_DIR", tmp_path)
+    image_id = save_image(_jpeg())
+    try:
+        # 子程序只寫檔案 不寫資料庫
+        with Session(engine) as db:
+            assert get_placeholders([image_id], db) == {}
+
+        placeholders = image_placeholders(image_id, None)
+        assert list(placeholders) == [image_id]
+        assert placeholders[image_id].startswith("data:image/")
+        with Session(engine) as db:
+            save_placeholders(placeholders, db)
+            db.commit()
+            assert get_placeholders([image_id], db) == placeholders
+    finally:
+        with Session(engine) as db:
+            db.exec(
+                delete(ImagePlaceholder).where(ImagePlaceholder.image_id == image_id)
+            )
+            db.commit()
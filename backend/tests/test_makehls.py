@@ -0,0 +1,19 @@
+from pathlib import Path
+
+from core.makehls import AUDIO_GROUP, build_command
+
+
+def test_audio_is_encoded_once_for_all_renditions():
+    cmd = build_command(
+        Path("in.mkv"), Path("out"), [(1280, 720), (854, 480), (640, 360)], True
+    )
+
+    assert cmd.count("0:a:0") == 1
+    assert [arg for arg in cmd if arg.startswith("-c:a")] == ["-c:a"]
+    stream_map = cmd[cmd.index("-var_stream_map") + 1].split()
+    assert stream_map == [
+        f"v:0,agroup:{AUDIO_GROUP},name:720p",
+        f"v:1,agroup:{AUDIO_GROUP},name:480p",
+        f"v:2,agroup:{AUDIO_GROUP},name:360p",
+        f"a:0,agroup:{AUDIO_GROUP},name:{AUDIO_GROUP}",
+    ]
@@ -0,0 +1,86 @@
+import pytest
+import requests
+
+from core import musiclyrics
+from core.providercache import NoCache, ProviderCache
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, data: dict):
+        self.status_code = status_code
+        self.data = data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {self.status_code}")
+
+    def json(self):
+        return self.data
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ProviderCache(tmp_path / "provider_cache.sqlite")
+
+
+def test_no_cache_result_is_returned_but_not_stored(cache):
+    calls = []
+
+    @cache.cached("musicbrainz")
+    def search(title):
+        calls.append(title)
+        return NoCache({"title": title})
+
+    assert search("Fatal") == {"title": "Fatal"}
+    assert search("Fatal") == {"title": "Fatal"}
+    assert len(calls) == 2
+
+
+def test_lrclib_server_error_is_not_negative_cached(cache, monkeypatch):
+    responses = [FakeResponse(503, {}), FakeResponse(200, {"syncedLyrics": "[00:01]"})]
+    monkeypatch.setattr(musiclyrics.http, "get", lambda *a, **kw: responses.pop(0))
+    get_lyrics = cache.cached("lrclib")(musiclyrics._get_lrclib.__wrapped__)
+
+    with pytest.raises(requests.HTTPError):
+        get_lyrics("album", "artist", "title")
+    assert get_lyrics("album", "artist", "title") == "[00:01]"
+
+
+def test_lrclib_not_found_is_negative_cached(cache, monkeypatch):
+    responses = [FakeResponse(404, {})]
+    monkeypatch.setattr(musiclyrics.http, "get", lambda *a, **kw: responses.pop(0))
+    get_lyrics = cache.cached("lrclib")(musiclyrics._get_lrclib.__wrapped__)
+
+    assert get_lyrics("album", "artist", "title") is None
+    assert get_lyrics("album", "artist", "title") is None
+
+
+def test_track_without_cover_art_is_not_cached_when_cover_lookup_fails(
+    cache, monkeypatch
+):
+    from core import musicparser
+
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        if "coverartarchive" in url:
+            raise requests.ConnectionError("coverartarchive unavailable")
+        if url.endswith("/recording"):
+            return FakeResponse(200, {"recordings": [{"id": "rec"}]})
+        return FakeResponse(200, {"id": "rec", "releases": [{"id": "rel"}]})
+
+    monkeypatch.setattr(musicparser.http, "get", get)
+    search = cache.cached("musicbrainz")(musicparser.lookup_track.__wrapped__)
+
+    assert search("Fatal", "GEMN")["id"] == "rec"
+    assert search("Fatal", "GEMN")["id"] == "rec"
+    assert len(calls) == 6
+
+
+def test_async_functions_are_rejected(cache):
+    with pytest.raises(TypeError):
+
+        @cache.cached("lrclib")
+        async def lookup(title):
+            return title
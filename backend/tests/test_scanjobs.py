@@ -0,0 +1,42 @@
+from threading import Event
+
+from sqlmodel import Session, delete
+
+from core import scanjobs
+from core.scanner import active_scans
+from models import ScanJob
+
+
+def test_queued_jobs_are_reported_and_joined_on_stop(engine, tmp_path, monkeypatch):
+    release = Event()
+    finished = []
+
+    def fake_scan(root, control):
+        control.started.set()
+        try:
+            release.wait(10)
+            finished.append(control.job_id)
+        finally:
+            active_scans.pop(control.job_id, None)
+            scanjobs.release_root(root)
+
+    monkeypatch.setattr(scanjobs, "SCAN_WORKERS", 1)
+    monkeypatch.setattr(scanjobs, "_run_scan", fake_scan)
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    job_ids = [scanjobs.start_scan(tmp_path / name) for name in ("a", "b")]
+    try:
+        assert scanjobs.job_status(job_ids[1])["status"] == "queued"
+        release.set()
+        # 等待執行中的工作結束 排隊中的工作取消並釋放目錄
+        scanjobs.stop_scans()
+        assert finished == job_ids[:1]
+        assert not active_scans
+        assert scanjobs.reserve_root(tmp_path / "b") == str(tmp_path / "b")
+        scanjobs.release_root(str(tmp_path / "b"))
+    finally:
+        release.set()
+        scanjobs.stop_scans()
+        with Session(engine) as db:
+            db.exec(delete(ScanJob).where(ScanJob.id.in_(job_ids)))
+            db.commit()
@@ -0,0 +1,28 @@
+import os
+from pathlib import Path
+
+from core.scanner import LibraryScanner
+
+
+def crashing_worker(file_path: str, with_hash: bool) -> dict:
+    """模擬解碼器 segfault 子程序直接結束"""
+    if Path(file_path).name == "crash.mkv":
+        os._exit(1)
+    return {"file_path": file_path}
+
+
+def test_worker_crash_does_not_abort_scan():
+    files = [Path(f"/library/{name}") for name in ("a.mkv", "crash.mkv", "b.mkv")]
+    files += [Path(f"/library/later{i}.mkv") for i in range(5)]
+    parsed: list[str] = []
+    failed: list[Path] = []
+
+    scanner = LibraryScanner(max_workers=1, max_inflight=1, worker=crashing_worker)
+    scanner.run(
+        iter(files),
+        lambda metadata: parsed.append(metadata["file_path"]),
+        lambda file_path, error: failed.append(file_path),
+    )
+
+    assert failed == [Path("/library/crash.mkv")]
+    assert sorted(parsed) == sorted(str(f) for f in files if f.name != "crash.mkv")
@@ -0,0 +1,28 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from core.sprite import MAX_SPRITE_IMAGES, check_sprite_size
+from routers.file import file_router
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(file_router)
+    return TestClient(app)
+
+
+def test_check_sprite_size_rejects_oversized_sheet():
+    image_ids = [f"image{i}" for i in range(MAX_SPRITE_IMAGES)]
+    assert check_sprite_size(image_ids, 200) == 200
+    with pytest.raises(ValueError):
+        check_sprite_size(image_ids, 1024)
+
+
+def test_sprite_endpoint_rejects_oversized_sheet(client):
+    image_ids = [f"image{i}" for i in range(MAX_SPRITE_IMAGES)]
+    response = client.post(
+        "/file/image/sprite", json={"image_ids": image_ids, "image_size": 1024}
+    )
+    assert response.status_code == 400
@@ -0,0 +1,42 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlmodel import Session, delete
+
+from models import Video, VideoFile
+from models.video import VideoCodec, VideoFormat
+from routers.stream import stream_router
+
+
+def test_remux_rejects_stored_codec_without_opening_file(engine, tmp_path):
+    with Session(engine) as db:
+        video = Video(
+            title="hevc",
+            duration=60,
+            subtitles=[],
+            audio_tracks=[],
+            file=VideoFile(
+                filename="hevc.mkv",
+                # 檔案不存在 開啟檔案前就要回傳 415
+                filepath=str(tmp_path / "hevc.mkv"),
+                file_size=1,
+                codec=VideoCodec.H265,
+                format=VideoFormat.MKV,
+                width=1920,
+                height=1080,
+                frame_rate=24,
+            ),
+        )
+        db.add(video)
+        db.commit()
+        video_id = video.id
+
+    app = FastAPI()
+    app.include_router(stream_router)
+    try:
+        response = TestClient(app).get(f"/stream/video/{video_id}/remux")
+        assert response.status_code == 415
+    finally:
+        with Session(engine) as db:
+            db.exec(delete(VideoFile).where(VideoFile.video_id == video_id))
+            db.exec(delete(Video).where(Video.id == video_id))
+            db.commit()
@@ -0,0 +1,52 @@
+import os
+import time
+
+from core import thumbnail
+from core.thumbnail import ThumbnailCache
+
+
+def _write_old(cache: ThumbnailCache, name: str, size: int) -> None:
+    path = cache.root / "200" / name[:2] / f"{name}.jpg"
+    cache.write(path, b"x" * size)
+    # 剛寫入的不會被淘汰
+    old = time.time() - 3600
+    os.utime(path, (old, old))
+
+
+def test_recount_includes_other_process_writes(tmp_path, monkeypatch):
+    monkeypatch.setattr(ThumbnailCache, "_quota", staticmethod(lambda: 1000))
+    api = ThumbnailCache(tmp_path)
+    worker = ThumbnailCache(tmp_path)  # 掃描的子程序
+    _write_old(api, "aa01", 100)
+    for i in range(9):
+        _write_old(worker, f"bb{i:02d}", 100)
+    assert api.total_bytes == 100
+
+    # 計數還沒過期 看不到其他程序寫入的縮圖
+    _write_old(api, "aa02", 100)
+    assert api.total_bytes == 200
+
+    monkeypatch.setattr(thumbnail, "RECOUNT_SECONDS", 0)
+    _write_old(api, "aa03", 100)
+    assert api.total_bytes <= 900
+    assert sum(1 for _ in tmp_path.rglob("*.jpg")) * 100 == api.total_bytes
+
+
+def test_no_rescan_when_nothing_can_be_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(ThumbnailCache, "_quota", staticmethod(lambda: 100))
+    cache = ThumbnailCache(tmp_path)
+    walks = []
+    entries = cache._entries
+    monkeypatch.setattr(cache, "_entries", lambda: walks.append(1) or entries())
+
+    # 第一次寫入時計算總大小 超過配額後嘗試淘汰一次
+    # 都是剛寫入的縮圖 不能淘汰 之後的寫入不再掃描
+    for i in range(5):
+        cache.write(tmp_path / "200" / "cc" / f"cc{i:02d}.jpg", b"x" * 100)
+    assert len(walks) == 2
+    assert cache.total_bytes == 500
+
+    # 等待時間過後再嘗試
+    cache.evict_after = 0.0
+    cache.write(tmp_path / "200" / "cc" / "cc99.jpg", b"x" * 100)
+    assert len(walks) == 3
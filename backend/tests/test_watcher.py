@@ -0,0 +1,38 @@
+from sqlmodel import Session, delete, select
+
+from core.watcher import LibraryWatcher
+from models import FileFingerprint
+
+
+def test_removed_dir_does_not_match_like_wildcards(engine, tmp_path):
+    removed_dir = tmp_path / "a_b"
+    kept = str(tmp_path / "aXb" / "kept.mp3")
+    paths = [str(removed_dir / "gone.mp3"), kept]
+    with Session(engine) as db:
+        for path in paths:
+            db.add(
+                FileFingerprint(
+                    filepath=path,
+                    file_type="music",
+                    size=1,
+                    mtime_ns=1,
+                    inode=1,
+                    device=1,
+                )
+            )
+        db.commit()
+
+    try:
+        # 資料夾已經不存在 視為刪除
+        LibraryWatcher.sync_path(removed_dir)
+        with Session(engine) as db:
+            remaining = db.exec(
+                select(FileFingerprint.filepath).where(
+                    FileFingerprint.filepath.in_(paths)
+                )
+            ).all()
+        assert remaining == [kept]
+    finally:
+        with Session(engine) as db:
+            db.exec(delete(FileFingerprint).where(FileFingerprint.filepath.in_(paths)))
+            db.commit()